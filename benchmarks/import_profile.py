@@ -0,0 +1,220 @@
+"""
+Perfil del tiempo de importación (arranque en frío) de los módulos de la app.
+
+Cada módulo se importa en un proceso nuevo con "python -X importtime", después
+de azure.functions (que el worker de Azure Functions ya tiene cargado). Se
+guardan la mediana y el mínimo del tiempo acumulado de cada módulo, los módulos
+más lentos que arrastra y la latencia de la primera petición serverInfo.
+
+Uso (desde la raíz del repositorio):
+
+    python benchmarks/import_profile.py
+    python benchmarks/import_profile.py --output nuevo.json --compare anterior.json
+    python benchmarks/import_profile.py --max-ms contentserver=50 --max-ms blob_utils=250
+
+Con --max-ms el proceso termina con código 1 si algún módulo supera su límite.
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+DEFAULT_MODULES = [
+    "contentserver",
+    "contentserver.handlers",
+    "contentserver.aio",
+    "contentserver.bulk",
+    "blob_utils",
+    "crypto_utils",
+    "compression_utils",
+    "create_connection",
+    "update_connection",
+    "delete_connection",
+    "get_all_connections",
+    "create_destination",
+    "update_destination",
+    "delete_destination",
+    "get_all_destinations",
+    "warmup",
+]
+
+ENVIRONMENT = {
+    "AzureWebJobsStorage": "memory://import-profile",
+    # Sin calentamiento en segundo plano: se mide solo la importación
+    "CONTENTSERVER_WARMUP": "off",
+    "LOG_LEVEL": "WARNING",
+}
+
+FIRST_SERVER_INFO = """
+import time
+import azure.functions as func
+started = time.perf_counter()
+import contentserver
+response = contentserver.main(func.HttpRequest(
+    method="GET", url="http://localhost/api/contentserver/receive?serverInfo",
+    params={}, body=b""))
+assert response.status_code == 200
+print((time.perf_counter() - started) * 1000)
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("modules", nargs="*", help="módulos a medir (por defecto, todos)")
+    parser.add_argument("--repeat", type=int, default=5, help="procesos por módulo")
+    parser.add_argument("--top", type=int, default=8, help="módulos más lentos a mostrar")
+    parser.add_argument("--output", default="import-profile.json")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior")
+    parser.add_argument(
+        "--max-ms",
+        action="append",
+        default=[],
+        metavar="MÓDULO=MS",
+        help="límite de la mediana para un módulo (se puede repetir)",
+    )
+    return parser.parse_args()
+
+
+def run_python(code: str, *options: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *options, "-c", code],
+        cwd=ROOT,
+        env={**os.environ, **ENVIRONMENT},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def parse_importtime(stderr: str) -> list:
+    """Líneas de -X importtime como (módulo, propio_us, acumulado_us, nivel)."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        level = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), level))
+    return entries
+
+
+def profile_module(module: str, repeat: int, top: int) -> dict:
+    totals = []
+    slowest = []
+    for _ in range(repeat):
+        # azure.functions se importa antes: en el worker ya está cargado
+        process = run_python(f"import azure.functions; import {module}", "-X", "importtime")
+        entries = parse_importtime(process.stderr)
+        module_index = max(i for i, e in enumerate(entries) if e[0] == module and e[3] == 0)
+        # Los módulos que arrastra son las líneas anteriores hasta el import previo de nivel 0
+        start = module_index
+        while start > 0 and entries[start - 1][3] > 0:
+            start -= 1
+        totals.append(entries[module_index][2] / 1000)
+        slowest = sorted(entries[start : module_index + 1], key=lambda e: -e[1])[:top]
+    return {
+        "module": module,
+        "median_ms": round(statistics.median(totals), 2),
+        "min_ms": round(min(totals), 2),
+        "slowest": [
+            {"module": name, "self_ms": round(self_us / 1000, 2)}
+            for name, self_us, _, _ in slowest
+        ],
+    }
+
+
+def first_server_info(repeat: int) -> dict:
+    latencies = [float(run_python(FIRST_SERVER_INFO).stdout) for _ in range(repeat)]
+    return {
+        "median_ms": round(statistics.median(latencies), 2),
+        "min_ms": round(min(latencies), 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_profile(profile: dict) -> None:
+    print(
+        f"{profile['module']:<28} mediana {profile['median_ms']:>8.2f} ms"
+        f"  mín {profile['min_ms']:>8.2f} ms"
+    )
+    for entry in profile["slowest"]:
+        print(f"    {entry['module']:<48} {entry['self_ms']:>8.2f} ms")
+
+
+def compare(report: dict, previous_path: str) -> None:
+    with open(previous_path) as f:
+        previous = json.load(f)
+    old_modules = {p["module"]: p for p in previous["modules"]}
+    print(f"\nComparación con {previous_path} (mediana; >1 es más lento)")
+    for profile in report["modules"]:
+        old = old_modules.get(profile["module"])
+        if old and old["median_ms"]:
+            ratio = profile["median_ms"] / old["median_ms"]
+            print(f"{profile['module']:<28} x{ratio:.2f}  ({old['median_ms']} -> {profile['median_ms']} ms)")
+    old_first = previous.get("first_server_info")
+    if old_first and old_first["median_ms"]:
+        ratio = report["first_server_info"]["median_ms"] / old_first["median_ms"]
+        print(f"{'primera serverInfo':<28} x{ratio:.2f}")
+
+
+def check_limits(report: dict, limits: list) -> list:
+    medians = {p["module"]: p["median_ms"] for p in report["modules"]}
+    exceeded = []
+    for limit in limits:
+        module, _, maximum = limit.partition("=")
+        if module in medians and medians[module] > float(maximum):
+            exceeded.append(f"{module}: {medians[module]} ms > {maximum} ms")
+    return exceeded
+
+
+def main():
+    args = parse_args()
+    modules = args.modules or DEFAULT_MODULES
+    started = datetime.now(timezone.utc).isoformat()
+    profiles = []
+    for module in modules:
+        profile = profile_module(module, args.repeat, args.top)
+        print_profile(profile)
+        profiles.append(profile)
+    first = first_server_info(args.repeat)
+    print(f"{'primera serverInfo':<28} mediana {first['median_ms']:>8.2f} ms")
+
+    report = {
+        "meta": {
+            "started": started,
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "modules": profiles,
+        "first_server_info": first,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResultados guardados en {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+    exceeded = check_limits(report, args.max_ms)
+    if exceeded:
+        print("\nLímites superados:\n  " + "\n  ".join(exceeded))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
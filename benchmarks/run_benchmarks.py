@@ -0,0 +1,616 @@
+"""
+Benchmarks del content server y de las funciones de configuración.
+
+Se ejecutan contra el almacenamiento en memoria de memory_blob.py (cadenas de
+conexión "memory://") o, con --storage file://<ruta>, contra el backend de
+ficheros de local_blob.py, llamando a los main() de las funciones con HttpRequest
+sintéticos. Por escenario se miden percentiles de latencia, rendimiento y pico
+de RSS; los resultados se guardan en JSON para comparar versiones.
+
+Uso (desde la raíz del repositorio):
+
+    python benchmarks/run_benchmarks.py                      # tamaños hasta 10 MB
+    python benchmarks/run_benchmarks.py --quick              # pasada rápida
+    python benchmarks/run_benchmarks.py --full               # incluye 100 MB y 500 MB
+    python benchmarks/run_benchmarks.py --output nuevo.json --compare anterior.json
+    python benchmarks/run_benchmarks.py --storage file:///tmp/bench  # disco local
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+STORAGE = "memory://benchmark"
+CONTAINER = "documents"
+CONNECTION_NAME = "benchmark"
+CONTREP = "BENCH"
+
+KB = 1024
+MB = 1024 * KB
+DEFAULT_SIZES = [10 * KB, MB, 10 * MB]
+FULL_SIZES = DEFAULT_SIZES + [100 * MB, 500 * MB]
+QUICK_SIZES = [10 * KB, MB]
+DEFAULT_REPOSITORY_SIZES = [0, 1000]
+FULL_REPOSITORY_SIZES = [0, 1000, 10000]
+# Tope de bytes procesados por escenario (determina las iteraciones)
+BYTES_PER_SCENARIO = 256 * MB
+COMPONENTS = 5
+# Documentos por petición en el escenario de ingesta en lote (mCreate)
+BULK_DOCUMENTS = 100
+# Destino replicado: la réplica principal tarda REPLICA_DELAY_MS más en una de
+# cada REPLICA_DELAY_EVERY lecturas (ver memory_blob.py)
+REPLICA_DELAY_MS = 50
+REPLICA_DELAY_EVERY = 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick", action="store_true", help="pocos tamaños e iteraciones")
+    parser.add_argument("--full", action="store_true", help="incluye 100 MB y 500 MB")
+    parser.add_argument("--sizes", help="tamaños en bytes separados por comas")
+    parser.add_argument(
+        "--repository-sizes", help="nº de documentos/destinos previos, separados por comas"
+    )
+    parser.add_argument("--iterations", type=int, help="iteraciones fijas por escenario")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument(
+        "--storage", default=STORAGE, help="cadena de conexión (memory://... o file://<ruta>)"
+    )
+    return parser.parse_args()
+
+
+def setup_environment(storage: str):
+    os.environ["AzureWebJobsStorage"] = storage
+    # Sin escrituras diferidas ni precalentamiento de clientes reales
+    os.environ.setdefault("DESTINATION_PROVISION_DELAY_SECONDS", "3600")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # Sin calentamiento en segundo plano mientras se mide
+    os.environ.setdefault("CONTENTSERVER_WARMUP", "off")
+
+
+def peak_rss_mb() -> float:
+    """Pico de RSS del proceso desde el último reset_peak_rss()."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / KB
+    except OSError:
+        pass
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / MB if sys.platform == "darwin" else peak / KB
+    except ImportError:
+        return 0.0
+
+
+def reset_peak_rss() -> None:
+    # En Linux, escribir 5 en clear_refs reinicia VmHWM; si no, el pico es acumulado
+    with contextlib.suppress(OSError):
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(name: str, operation, iterations: int, payload_bytes: int = 0, before=None, **labels):
+    """Ejecuta 'operation(i)' y resume latencias, rendimiento y memoria."""
+    if before:
+        before(-1)
+    check_response(name, operation(-1))  # calentamiento
+    gc.collect()
+    reset_peak_rss()
+
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        if before:
+            before(i)
+        t0 = time.perf_counter()
+        response = operation(i)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        check_response(name, response)
+    elapsed = time.perf_counter() - started
+
+    busy = sum(latencies) / 1000
+    result = {
+        "name": name,
+        **labels,
+        "iterations": iterations,
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p90_ms": round(percentile(latencies, 0.90), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "max_ms": round(max(latencies), 3),
+        "mean_ms": round(busy * 1000 / iterations, 3),
+        "ops_per_s": round(iterations / busy, 2) if busy else None,
+        "wall_s": round(elapsed, 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if payload_bytes:
+        result["mb_per_s"] = round(payload_bytes * iterations / MB / busy, 2) if busy else None
+    print_result(result)
+    return result
+
+
+def check_response(name: str, response) -> None:
+    if response.status_code >= 400:
+        raise RuntimeError(
+            f"{name}: respuesta {response.status_code}: {response.get_body()[:200]!r}"
+        )
+
+
+def print_result(result: dict) -> None:
+    label = result["name"] + "".join(
+        f" {k}={v}" for k, v in result.items() if k in ("size", "components", "documents", "cache", "replicas", "repository_size")
+    )
+    throughput = f"{result['ops_per_s']:>9} op/s"
+    if "mb_per_s" in result:
+        throughput += f" {result['mb_per_s']:>8} MB/s"
+    print(
+        f"{label:<48} p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms"
+        f"  {throughput}  rss {result['peak_rss_mb']:>7.1f} MB",
+        flush=True,
+    )
+
+
+def iterations_for(size: int, args) -> int:
+    if args.iterations:
+        return args.iterations
+    upper = 20 if args.quick else 200
+    return max(2, min(upper, BYTES_PER_SCENARIO // max(size, 1)))
+
+
+def human(size: int) -> str:
+    for unit, factor in (("MB", MB), ("KB", KB)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return f"{size}B"
+
+
+def multipart_body(files: list, boundary: str = "benchmark-boundary"):
+    """Cuerpo multipart con (filename, datos) o (campo, filename, datos) por fichero."""
+    parts = []
+    for file in files:
+        name, filename, data = file if len(file) == 3 else (file[0], *file)
+        parts.append(
+            (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                "Content-Type: application/pdf\r\n\r\n"
+            ).encode()
+        )
+        parts.append(data)
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> list:
+    import azure.functions as func
+    import blob_utils
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("azure").setLevel(logging.WARNING)
+
+    connection = {
+        "connection_name": CONNECTION_NAME,
+        "cloud": "AZURE",
+        "data": {"connection_string": args.storage, "container_name": CONTAINER},
+    }
+    blob_utils.create_config_entries("connections", {CONNECTION_NAME: connection})
+    blob_utils.create_config_entries("destinations", {CONTREP: CONNECTION_NAME})
+
+    import contentserver
+    from contentserver import doccache
+    import create_destination
+    import update_destination
+    import delete_destination
+    import get_all_destinations
+
+    def request(method, command, params=None, body=b"", headers=None, route_params=None):
+        params = {"contRep": CONTREP, **(params or {})}
+        query = "&".join([command] + [f"{k}={v}" for k, v in params.items()])
+        return func.HttpRequest(
+            method=method,
+            url=f"http://localhost/api/contentserver/receive?{query}",
+            params=params,
+            body=body,
+            headers=headers or {},
+            route_params=route_params or {},
+        )
+
+    main = contentserver.main
+    rng = random.Random(args.seed)
+    if args.sizes:
+        sizes = [int(s) for s in args.sizes.split(",")]
+    else:
+        sizes = QUICK_SIZES if args.quick else FULL_SIZES if args.full else DEFAULT_SIZES
+    if args.repository_sizes:
+        repository_sizes = [int(s) for s in args.repository_sizes.split(",")]
+    else:
+        repository_sizes = (
+            [0, 100] if args.quick else FULL_REPOSITORY_SIZES if args.full else DEFAULT_REPOSITORY_SIZES
+        )
+
+    results = []
+    results.append(
+        measure(
+            "serverInfo",
+            lambda i: main(request("GET", "serverInfo", {"pVersion": "0047"})),
+            50 if args.quick else 500,
+        )
+    )
+
+    for size in sizes:
+        data = rng.randbytes(size)
+        iterations = iterations_for(size, args)
+        # Se reutilizan docIds para no acumular más de BYTES_PER_SCENARIO en memoria
+        keep = max(1, BYTES_PER_SCENARIO // size)
+        body, headers = multipart_body([("document.pdf", data)])
+
+        def create(i, size=size, body=body, headers=headers, keep=keep):
+            return main(
+                request("POST", "create", {"docId": f"doc-{size}-{i % keep}"}, body, headers)
+            )
+
+        results.append(measure("create", create, iterations, size, size=human(size), components=1))
+
+        if size <= 10 * MB:
+            body_n, headers_n = multipart_body(
+                [(f"part{n}.pdf", data) for n in range(COMPONENTS)]
+            )
+
+            def create_n(i, size=size, body=body_n, headers=headers_n, keep=keep):
+                return main(
+                    request("POST", "create", {"docId": f"multi-{size}-{i % keep}"}, body, headers)
+                )
+
+            results.append(
+                measure(
+                    "create",
+                    create_n,
+                    max(2, iterations // COMPONENTS),
+                    size * COMPONENTS,
+                    size=human(size),
+                    components=COMPONENTS,
+                )
+            )
+            del body_n
+
+        docId = f"doc-{size}-0"
+
+        def get(i, docId=docId):
+            return main(request("GET", "get", {"docId": docId}))
+
+        results.append(
+            measure(
+                "get",
+                get,
+                iterations,
+                size,
+                before=lambda i: doccache.clear(),
+                size=human(size),
+                cache="cold",
+            )
+        )
+        results.append(measure("get", get, iterations, size, size=human(size), cache="warm"))
+
+        # Revalidación con If-None-Match: 304 sin descargar ni descifrar
+        etag = get(0).headers.get("ETag")
+
+        def get_conditional(i, docId=docId, etag=etag):
+            return main(request("GET", "get", {"docId": docId}, headers={"If-None-Match": etag}))
+
+        results.append(
+            measure(
+                "get",
+                get_conditional,
+                iterations,
+                before=lambda i: doccache.clear(),
+                size=human(size),
+                cache="conditional",
+            )
+        )
+
+        range_size = min(size, 64 * KB)
+
+        def get_range(i, docId=docId, size=size, range_size=range_size):
+            start = rng.randrange(0, size - range_size + 1)
+            return main(
+                request(
+                    "GET",
+                    "get",
+                    {"docId": docId},
+                    headers={"Range": f"bytes={start}-{start + range_size - 1}"},
+                )
+            )
+
+        results.append(
+            measure(
+                "get_range",
+                get_range,
+                iterations_for(range_size, args),
+                range_size,
+                before=lambda i: doccache.clear(),
+                size=human(size),
+            )
+        )
+        results.append(
+            measure(
+                "info",
+                lambda i, docId=docId: main(request("GET", "info", {"docId": docId})),
+                iterations_for(10 * KB, args),
+                size=human(size),
+            )
+        )
+        del data, body
+        gc.collect()
+
+    # Ingesta en lote: BULK_DOCUMENTS documentos pequeños por petición, frente a
+    # un 'create' por documento
+    small = rng.randbytes(10 * KB)
+    bulk_body, bulk_headers = multipart_body(
+        [(f"bulk-{n}", "document.pdf", small) for n in range(BULK_DOCUMENTS)]
+    )
+    results.append(
+        measure(
+            "mCreate",
+            lambda i: main(request("POST", "mCreate", body=bulk_body, headers=bulk_headers)),
+            5 if args.quick else 20,
+            BULK_DOCUMENTS * len(small),
+            size=human(len(small)),
+            documents=BULK_DOCUMENTS,
+        )
+    )
+    del bulk_body
+
+    # Append: cada petición añade 10 KB a un documento que va creciendo
+    results.append(
+        measure(
+            "append",
+            lambda i: main(request("PUT", "append", {"docId": "append-log"}, small)),
+            50 if args.quick else 500,
+            len(small),
+            size=human(len(small)),
+        )
+    )
+
+    # Lecturas con una réplica lenta: la misma conexión sola o con dos réplicas
+    # rápidas (lectura cubierta); el p99 no debería seguir a la réplica lenta
+    slow_storage = (
+        f"memory://benchmark-slow?delay_ms={REPLICA_DELAY_MS}"
+        f"&delay_ratio={1 / REPLICA_DELAY_EVERY}"
+    )
+    replicas = {
+        "replica-slow": slow_storage,
+        "replica-1": "memory://benchmark-replica-1",
+        "replica-2": "memory://benchmark-replica-2",
+    }
+    blob_utils.create_config_entries(
+        "connections",
+        {
+            name: {
+                "connection_name": name,
+                "cloud": "AZURE",
+                "data": {"connection_string": storage, "container_name": CONTAINER},
+            }
+            for name, storage in replicas.items()
+        },
+    )
+    blob_utils.create_config_entries(
+        "destinations",
+        {"BENCH1": "replica-slow", "BENCH3": {"connections": list(replicas)}},
+    )
+    body, headers = multipart_body([("document.pdf", small)])
+    for contRep, replica_count in (("BENCH1", 1), ("BENCH3", 3)):
+        results.append(
+            measure(
+                "create",
+                lambda i, contRep=contRep: main(
+                    request(
+                        "POST",
+                        "create",
+                        {"contRep": contRep, "docId": f"replicated-{i}"},
+                        body,
+                        headers,
+                    )
+                ),
+                50 if args.quick else 200,
+                len(small),
+                size=human(len(small)),
+                replicas=replica_count,
+            )
+        )
+        results.append(
+            measure(
+                "get",
+                lambda i, contRep=contRep: main(
+                    request("GET", "get", {"contRep": contRep, "docId": "replicated-0"})
+                ),
+                200 if args.quick else 1000,
+                len(small),
+                before=lambda i: doccache.clear(),
+                size=human(len(small)),
+                cache="cold",
+                replicas=replica_count,
+            )
+        )
+
+    # Escalado con el tamaño del repositorio (documentos y destinos ya existentes)
+    existing = 0
+    for repository_size in repository_sizes:
+        for n in range(existing, repository_size):
+            main(request("POST", "create", {"docId": f"repo-{n}"}, body, headers))
+        blob_utils.create_config_entries(
+            "destinations",
+            {f"REPO{n}": CONNECTION_NAME for n in range(existing, repository_size)},
+        )
+        existing = max(existing, repository_size)
+        target = f"repo-{repository_size // 2}" if repository_size else f"doc-{sizes[0]}-0"
+        iterations = 20 if args.quick else 200
+        labels = {"repository_size": repository_size}
+
+        results.append(
+            measure(
+                "get",
+                lambda i: main(request("GET", "get", {"docId": target})),
+                iterations,
+                before=lambda i: doccache.clear(),
+                cache="cold",
+                **labels,
+            )
+        )
+        results.append(
+            measure(
+                "info",
+                lambda i: main(request("GET", "info", {"docId": target})),
+                iterations,
+                **labels,
+            )
+        )
+        doc_ids = ",".join(f"repo-{n}" for n in range(min(repository_size, 100))) or target
+        results.append(
+            measure(
+                "batchInfo",
+                lambda i: main(request("GET", "batchInfo", {"docIds": doc_ids})),
+                max(2, iterations // 10),
+                **labels,
+            )
+        )
+
+        def destination(method, contRep, body=None):
+            return func.HttpRequest(
+                method=method,
+                url=f"http://localhost/api/destinations/{contRep}",
+                params={},
+                body=json.dumps(body).encode() if body is not None else b"",
+                route_params={"contRep": contRep},
+            )
+
+        results.append(
+            measure(
+                "create_destination",
+                lambda i: create_destination.main(
+                    destination(
+                        "POST",
+                        "",
+                        {"contRep": f"NEW{repository_size}-{i}", "connection_name": CONNECTION_NAME},
+                    )
+                ),
+                iterations,
+                **labels,
+            )
+        )
+        results.append(
+            measure(
+                "update_destination",
+                lambda i: update_destination.main(
+                    destination("PUT", f"NEW{repository_size}-{max(i, 0)}", {"connection_name": CONNECTION_NAME})
+                ),
+                iterations,
+                **labels,
+            )
+        )
+        results.append(
+            measure(
+                "get_all_destinations",
+                lambda i: get_all_destinations.main(destination("GET", "")),
+                max(2, iterations // 10),
+                **labels,
+            )
+        )
+        results.append(
+            measure(
+                "delete_destination",
+                lambda i: delete_destination.main(
+                    destination("DELETE", f"NEW{repository_size}-{i}")
+                ),
+                iterations,
+                **labels,
+            )
+        )
+
+    return results
+
+
+def result_key(result: dict) -> tuple:
+    return tuple(
+        (k, v)
+        for k, v in result.items()
+        if k in ("name", "size", "components", "documents", "cache", "replicas", "repository_size")
+    )
+
+
+def compare(results: list, previous_path: str) -> None:
+    with open(previous_path) as f:
+        previous = {result_key(r): r for r in json.load(f)["results"]}
+    print(f"\nComparación con {previous_path} (p50 y op/s; >1 es mejor)")
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        latency = old["p50_ms"] / result["p50_ms"] if result["p50_ms"] else None
+        throughput = (
+            result["ops_per_s"] / old["ops_per_s"] if old.get("ops_per_s") else None
+        )
+        label = " ".join(f"{v}" for _, v in result_key(result))
+        print(
+            f"{label:<48} p50 x{latency:.2f}  op/s x{throughput:.2f}"
+            if latency and throughput
+            else f"{label:<48} sin datos comparables"
+        )
+
+
+def main():
+    args = parse_args()
+    setup_environment(args.storage)
+    started = datetime.now(timezone.utc).isoformat()
+    results = run(args)
+    report = {
+        "meta": {
+            "started": started,
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResultados guardados en {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,136 +1,665 @@
 import os
+import copy
 import json
+import time
 import logging
 import hashlib
-import base64
-from azure.storage.blob import BlobServiceClient
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import padding
+import importlib
+import random
+import threading
+from urllib.parse import quote, unquote
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from logging_utils import SAMPLED, configure_logging
+from resilience_utils import RESILIENCE_DEFAULTS, resilience_settings
+from tracing_utils import span
 
 # Configuración de logging
-logging.basicConfig(level=logging.INFO)
-
-# Configuración de la cadena de conexión desde una variable de entorno
-connection_string = os.getenv("AzureWebJobsStorage")
-if not connection_string:
-    logging.error("La cadena de conexión de Blob Storage no está configurada.")
-    raise ValueError("La cadena de conexión de Blob Storage no está configurada.")
-else:
-    logging.info(
-        f"Cadena de conexión obtenida: {connection_string[:50]}..."
-    )  # Mostrar solo una parte por seguridad
-
-# Inicializa el cliente de Blob Storage
-try:
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    logging.info("Cliente de Blob Service inicializado correctamente.")
-except Exception as e:
-    logging.error(f"Error al inicializar el cliente de Blob Service: {e}")
-    raise
+configure_logging()
+logger = logging.getLogger(__name__)
+
+# Backends de almacenamiento. Cada uno implementa la parte de la API de
+# azure.storage.blob (BlobServiceClient, ContainerClient y BlobClient) que usan
+# las funciones y se elige por el prefijo de la cadena de conexión:
+#   - "memory://<cuenta>": memory_blob.py, en memoria (benchmarks y pruebas);
+#   - "file://<ruta>": local_blob.py, ficheros en un disco local o montado.
+# Cualquier otra cadena es una cuenta de Azure Storage.
+MEMORY_CONNECTION_PREFIX = "memory://"
+LOCAL_CONNECTION_PREFIX = "file://"
+STORAGE_BACKENDS = {
+    MEMORY_CONNECTION_PREFIX: ("memory_blob", "MemoryBlobServiceClient"),
+    LOCAL_CONNECTION_PREFIX: ("local_blob", "LocalBlobServiceClient"),
+}
+# Tipos de conexión ('cloud') que guardan documentos
+STORAGE_CLOUDS = ("AZURE", "LOCAL")
+
+
+def create_blob_service_client(connection_string: str, **kwargs):
+    """Crea el BlobServiceClient de una cadena de conexión."""
+    for prefix, (module_name, class_name) in STORAGE_BACKENDS.items():
+        if connection_string.startswith(prefix):
+            backend = getattr(importlib.import_module(module_name), class_name)
+            return backend.from_connection_string(connection_string, **kwargs)
+    from azure.storage.blob import BlobServiceClient
+
+    return BlobServiceClient.from_connection_string(connection_string, **kwargs)
+
+
+def get_connection_string(connection_info: dict) -> str:
+    """Cadena de conexión de una conexión; las LOCAL indican solo la ruta (data.path)."""
+    connection_data = connection_info["data"]
+    if connection_info.get("cloud") == "LOCAL" and "connection_string" not in connection_data:
+        return LOCAL_CONNECTION_PREFIX + connection_data["path"]
+    return connection_data["connection_string"]
+
+
+# Cliente de la cuenta de configuración (AzureWebJobsStorage). Se crea en el
+# primer uso: importar este módulo no lee la configuración ni carga el SDK.
+_blob_service_client = None
+_blob_service_client_lock = threading.Lock()
+
+
+def get_blob_service_client():
+    global _blob_service_client
+    if _blob_service_client is not None:
+        return _blob_service_client
+    with _blob_service_client_lock:
+        if _blob_service_client is None:
+            connection_string = os.getenv("AzureWebJobsStorage")
+            if not connection_string:
+                logger.error("La cadena de conexión de Blob Storage no está configurada.")
+                raise ValueError(
+                    "La cadena de conexión de Blob Storage no está configurada."
+                )
+            try:
+                _blob_service_client = create_blob_service_client(connection_string)
+            except Exception as e:
+                # Sin el mensaje de la excepción: puede incluir la cadena de conexión
+                logger.error(
+                    "Error al inicializar el cliente de Blob Service: %s",
+                    type(e).__name__,
+                )
+                raise
+            logger.info("Cliente de Blob Service inicializado correctamente.")
+    return _blob_service_client
+
+
+def __getattr__(name: str):
+    # blob_utils.blob_service_client se sigue pudiendo usar como antes
+    if name == "blob_service_client":
+        return get_blob_service_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Caché en memoria (por worker) de los JSON de configuración.
+# Pasado el TTL, la entrada se revalida con una descarga condicional por ETag.
+CONFIG_CACHE_TTL_SECONDS = float(os.getenv("CONFIG_CACHE_TTL_SECONDS", "30"))
+
+_json_cache = {}
+_json_cache_lock = threading.Lock()
+
+
+def _get_cached_json(container_name: str, blob_name: str):
+    with _json_cache_lock:
+        return _json_cache.get((container_name, blob_name))
+
+
+def _set_cached_json(container_name: str, blob_name: str, data: dict, etag: str):
+    with _json_cache_lock:
+        _json_cache[(container_name, blob_name)] = {
+            "data": copy.deepcopy(data),
+            "etag": etag,
+            "checked_at": time.monotonic(),
+        }
+
+
+def invalidate_json_cache(container_name: str = None, blob_name: str = None) -> None:
+    """
+    Invalida la caché de JSON. Sin argumentos vacía la caché completa.
+    """
+    with _json_cache_lock:
+        if container_name is None and blob_name is None:
+            _json_cache.clear()
+        else:
+            _json_cache.pop((container_name, blob_name), None)
+
+
+def load_json_with_etag(container_name: str, blob_name: str, revalidate: bool = False):
+    """
+    Carga un JSON desde Azure Blob Storage y devuelve (datos, etag).
+
+    El resultado se guarda en caché; dentro del TTL no se accede a Blob Storage y,
+    una vez vencido (o con revalidate=True), solo se vuelve a descargar si el ETag
+    del blob ha cambiado. Siempre se devuelve una copia, de modo que el llamador
+    puede modificarla.
+    """
+    with span("config_load", blob=blob_name) as attributes:
+        cached = _get_cached_json(container_name, blob_name)
+        if (
+            cached
+            and not revalidate
+            and time.monotonic() - cached["checked_at"] < CONFIG_CACHE_TTL_SECONDS
+        ):
+            attributes["cache"] = "hit"
+            return copy.deepcopy(cached["data"]), cached["etag"]
+
+        container_client = get_blob_service_client().get_container_client(
+            container_name
+        )
+        blob_client = container_client.get_blob_client(blob_name)
+
+        # Descargar el contenido del blob (condicional si ya hay una versión en caché)
+        if cached:
+            try:
+                download_stream = blob_client.download_blob(
+                    etag=cached["etag"], match_condition=MatchConditions.IfModified
+                )
+            except ResourceNotFoundError:
+                invalidate_json_cache(container_name, blob_name)
+                raise
+            except HttpResponseError as e:
+                # El SDK no lanza ResourceNotModifiedError: un 304 sin código de
+                # error llega como HttpResponseError
+                if e.status_code != 304:
+                    raise
+                with _json_cache_lock:
+                    cached["checked_at"] = time.monotonic()
+                attributes["cache"] = "not_modified"
+                return copy.deepcopy(cached["data"]), cached["etag"]
+        else:
+            download_stream = blob_client.download_blob()
+
+        content = download_stream.readall()
+        attributes["cache"] = "miss"
+        attributes["bytes"] = len(content)
+        data = json.loads(content)
+        etag = download_stream.properties.etag
+        _set_cached_json(container_name, blob_name, data, etag)
+        return data, etag
 
 
 def load_json_from_blob(container_name: str, blob_name: str) -> dict:
     """
     Carga un archivo JSON desde Azure Blob Storage y lo convierte en un diccionario de Python.
+    Ver load_json_with_etag para el comportamiento de la caché.
     """
-    logging.info(
-        f"Cargando JSON desde el contenedor '{container_name}', blob '{blob_name}'..."
-    )
     try:
-        container_client = blob_service_client.get_container_client(container_name)
-        blob_client = container_client.get_blob_client(blob_name)
-
-        # Descargar el contenido del blob
-        download_stream = blob_client.download_blob()
-        data = json.loads(download_stream.readall())
-        logging.info(
-            f"Archivo JSON '{blob_name}' cargado correctamente desde '{container_name}'."
-        )
+        data, _ = load_json_with_etag(container_name, blob_name)
+        logger.debug("JSON '%s' cargado desde '%s'", blob_name, container_name)
         return data
     except Exception as e:
-        logging.error(
-            f"Error cargando JSON desde blob '{blob_name}' en contenedor '{container_name}': {e}"
+        logger.error(
+            "Error cargando JSON desde blob '%s' en contenedor '%s': %s",
+            blob_name,
+            container_name,
+            e,
         )
         raise
 
 
-def save_json_to_blob(container_name: str, blob_name: str, data: dict) -> None:
+def save_json_to_blob(
+    container_name: str,
+    blob_name: str,
+    data: dict,
+    etag: str = None,
+    if_missing: bool = False,
+) -> str:
     """
     Guarda un diccionario de Python como un archivo JSON en Azure Blob Storage.
+
+    Con 'etag' la escritura solo se realiza si el blob no ha cambiado (If-Match) y con
+    'if_missing' solo si todavía no existe; en caso contrario se lanza
+    ResourceModifiedError o ResourceExistsError. Devuelve el ETag nuevo.
     """
-    logging.info(
-        f"Guardando JSON en el contenedor '{container_name}', blob '{blob_name}'..."
-    )
     try:
         json_data = json.dumps(data)
-        container_client = blob_service_client.get_container_client(container_name)
-        blob_client = container_client.get_blob_client(blob_name)
-        blob_client.upload_blob(json_data, overwrite=True)
-        logging.info(
-            f"Archivo JSON '{blob_name}' guardado correctamente en '{container_name}'."
+        container_client = get_blob_service_client().get_container_client(
+            container_name
         )
+        blob_client = container_client.get_blob_client(blob_name)
+        if etag:
+            result = blob_client.upload_blob(
+                json_data,
+                overwrite=True,
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+            )
+        elif if_missing:
+            result = blob_client.upload_blob(json_data, overwrite=False)
+        else:
+            result = blob_client.upload_blob(json_data, overwrite=True)
+        # Actualizar la caché local con lo que acabamos de escribir
+        _set_cached_json(container_name, blob_name, data, result.get("etag"))
+        logger.info("JSON '%s' guardado en '%s'", blob_name, container_name)
+        return result.get("etag")
+    except (ResourceModifiedError, ResourceExistsError):
+        # Otro proceso escribió antes; el llamador decide si reintenta
+        invalidate_json_cache(container_name, blob_name)
+        raise
     except Exception as e:
-        logging.error(
-            f"Error guardando JSON en blob '{blob_name}' en contenedor '{container_name}': {e}"
+        logger.error(
+            "Error guardando JSON en blob '%s' en contenedor '%s': %s",
+            blob_name,
+            container_name,
+            e,
         )
         raise
 
 
+# Almacenamiento de la configuración (conexiones y destinos).
+#   - "file": un único JSON por tipo (connections.json / destinations.json).
+#   - "entries": un blob por entrada ('connections/<nombre>.json',
+#     'destinations/<contRep>.json'), de modo que las operaciones CRUD son O(1).
+# En ambos modos las escrituras usan If-Match y se reintentan si hay conflicto.
+CONFIG_CONTAINER = "connections"
+CONFIG_FILES = {"connections": "connections.json", "destinations": "destinations.json"}
+CONFIG_STORAGE_MODE = os.getenv("CONFIG_STORAGE_MODE", "file")
+CONFIG_WRITE_RETRIES = int(os.getenv("CONFIG_WRITE_RETRIES", "5"))
+CONFIG_MIGRATION_MARKER = "_entries_migrated"
+
+_entries_migrated = False
+
+
+class ConfigEntryExists(Exception):
+    pass
+
+
+class ConfigEntryNotFound(Exception):
+    pass
+
+
+def _entry_blob_name(kind: str, key: str) -> str:
+    return f"{kind}/{quote(key, safe='')}.json"
+
+
+def _conflict_backoff(attempt: int) -> None:
+    time.sleep(random.uniform(0, 0.05 * 2**attempt))
+
+
+def update_json_blob(container_name: str, blob_name: str, mutate) -> dict:
+    """
+    Lee, modifica y guarda un JSON con control de concurrencia optimista.
+
+    'mutate' recibe los datos actuales (un diccionario vacío si el blob no existe)
+    y los modifica en el sitio; si otro proceso escribe entre medias se vuelve a
+    leer y se repite la operación.
+    """
+    for attempt in range(CONFIG_WRITE_RETRIES):
+        try:
+            data, etag = load_json_with_etag(container_name, blob_name, revalidate=True)
+        except ResourceNotFoundError:
+            data, etag = {}, None
+        mutate(data)
+        try:
+            save_json_to_blob(
+                container_name, blob_name, data, etag=etag, if_missing=etag is None
+            )
+            return data
+        except (ResourceModifiedError, ResourceExistsError):
+            logger.info("Conflicto al escribir '%s', reintentando...", blob_name)
+            _conflict_backoff(attempt)
+    raise RuntimeError(
+        f"No se pudo guardar '{blob_name}' tras {CONFIG_WRITE_RETRIES} intentos"
+    )
+
+
+def update_blob_metadata(blob_client, mutate):
+    """
+    Modifica los metadatos de un blob con control de concurrencia optimista.
+
+    'mutate' recibe una copia de los metadatos actuales y devuelve los nuevos, o
+    None para borrar el blob. Devuelve lo que devolvió 'mutate' en el intento que
+    se guardó; lanza ResourceNotFoundError si el blob no existe.
+    """
+    for attempt in range(CONFIG_WRITE_RETRIES):
+        props = blob_client.get_blob_properties()
+        metadata = mutate(dict(props.metadata or {}))
+        try:
+            if metadata is None:
+                blob_client.delete_blob(
+                    etag=props.etag, match_condition=MatchConditions.IfNotModified
+                )
+            else:
+                blob_client.set_blob_metadata(
+                    metadata,
+                    etag=props.etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            return metadata
+        except ResourceModifiedError:
+            logger.info(
+                "Conflicto al actualizar los metadatos de '%s', reintentando...",
+                blob_client.blob_name,
+                extra=SAMPLED,
+            )
+            _conflict_backoff(attempt)
+    raise RuntimeError(
+        f"No se pudieron actualizar los metadatos de '{blob_client.blob_name}' "
+        f"tras {CONFIG_WRITE_RETRIES} intentos"
+    )
+
+
+def _ensure_entries_migrated() -> None:
+    """
+    Copia una sola vez los JSON completos existentes al almacenamiento por entrada.
+    Un blob marcador evita repetir la migración (y resucitar entradas borradas).
+    """
+    global _entries_migrated
+    if _entries_migrated:
+        return
+    container_client = get_blob_service_client().get_container_client(CONFIG_CONTAINER)
+    marker = container_client.get_blob_client(CONFIG_MIGRATION_MARKER)
+    if not marker.exists():
+        for kind, file_name in CONFIG_FILES.items():
+            try:
+                entries = load_json_from_blob(CONFIG_CONTAINER, file_name)
+            except ResourceNotFoundError:
+                continue
+            for key, value in entries.items():
+                try:
+                    save_json_to_blob(
+                        CONFIG_CONTAINER,
+                        _entry_blob_name(kind, key),
+                        value,
+                        if_missing=True,
+                    )
+                except ResourceExistsError:
+                    pass
+        try:
+            marker.upload_blob(b"", overwrite=False)
+        except ResourceExistsError:
+            pass
+    _entries_migrated = True
+
+
+def get_config_entry(kind: str, key: str):
+    """Devuelve una entrada de configuración o lanza ConfigEntryNotFound."""
+    if CONFIG_STORAGE_MODE == "entries":
+        _ensure_entries_migrated()
+        try:
+            value, _ = load_json_with_etag(CONFIG_CONTAINER, _entry_blob_name(kind, key))
+            return value
+        except ResourceNotFoundError:
+            raise ConfigEntryNotFound(key)
+    entries = load_json_from_blob(CONFIG_CONTAINER, CONFIG_FILES[kind])
+    if key not in entries:
+        raise ConfigEntryNotFound(key)
+    return entries[key]
+
+
+def list_config_entries(kind: str) -> dict:
+    """Devuelve todas las entradas de un tipo de configuración."""
+    if CONFIG_STORAGE_MODE == "entries":
+        _ensure_entries_migrated()
+        container_client = get_blob_service_client().get_container_client(
+            CONFIG_CONTAINER
+        )
+        entries = {}
+        for blob in container_client.list_blobs(name_starts_with=f"{kind}/"):
+            key = unquote(blob.name[len(kind) + 1 : -len(".json")])
+            try:
+                entries[key], _ = load_json_with_etag(CONFIG_CONTAINER, blob.name)
+            except ResourceNotFoundError:
+                pass
+        return entries
+    return load_json_from_blob(CONFIG_CONTAINER, CONFIG_FILES[kind])
+
+
+def create_config_entry(kind: str, key: str, value) -> None:
+    """Crea una entrada; lanza ConfigEntryExists si ya existe."""
+    if CONFIG_STORAGE_MODE == "entries":
+        _ensure_entries_migrated()
+        try:
+            save_json_to_blob(
+                CONFIG_CONTAINER, _entry_blob_name(kind, key), value, if_missing=True
+            )
+        except ResourceExistsError:
+            raise ConfigEntryExists(key)
+        return
+
+    def mutate(entries):
+        if key in entries:
+            raise ConfigEntryExists(key)
+        entries[key] = value
+
+    update_json_blob(CONFIG_CONTAINER, CONFIG_FILES[kind], mutate)
+
+
+def create_config_entries(kind: str, entries: dict) -> None:
+    """Crea en una sola operación las entradas que todavía no existen (las demás se ignoran)."""
+    if CONFIG_STORAGE_MODE == "entries":
+        for key, value in entries.items():
+            try:
+                create_config_entry(kind, key, value)
+            except ConfigEntryExists:
+                pass
+        return
+
+    def mutate(current):
+        for key, value in entries.items():
+            current.setdefault(key, value)
+
+    update_json_blob(CONFIG_CONTAINER, CONFIG_FILES[kind], mutate)
+
+
+def update_config_entry(kind: str, key: str, value) -> None:
+    """Reemplaza una entrada existente; lanza ConfigEntryNotFound si no existe."""
+    if CONFIG_STORAGE_MODE == "entries":
+        _ensure_entries_migrated()
+        blob_name = _entry_blob_name(kind, key)
+        for attempt in range(CONFIG_WRITE_RETRIES):
+            try:
+                _, etag = load_json_with_etag(
+                    CONFIG_CONTAINER, blob_name, revalidate=True
+                )
+            except ResourceNotFoundError:
+                raise ConfigEntryNotFound(key)
+            try:
+                save_json_to_blob(CONFIG_CONTAINER, blob_name, value, etag=etag)
+                return
+            except ResourceModifiedError:
+                _conflict_backoff(attempt)
+        raise RuntimeError(f"No se pudo actualizar '{key}' tras varios intentos")
+
+    def mutate(entries):
+        if key not in entries:
+            raise ConfigEntryNotFound(key)
+        entries[key] = value
+
+    update_json_blob(CONFIG_CONTAINER, CONFIG_FILES[kind], mutate)
+
+
+def delete_config_entry(kind: str, key: str) -> None:
+    """Elimina una entrada; lanza ConfigEntryNotFound si no existe."""
+    if CONFIG_STORAGE_MODE == "entries":
+        _ensure_entries_migrated()
+        blob_name = _entry_blob_name(kind, key)
+        container_client = get_blob_service_client().get_container_client(
+            CONFIG_CONTAINER
+        )
+        try:
+            container_client.get_blob_client(blob_name).delete_blob()
+        except ResourceNotFoundError:
+            raise ConfigEntryNotFound(key)
+        finally:
+            invalidate_json_cache(CONFIG_CONTAINER, blob_name)
+        return
+
+    def mutate(entries):
+        if key not in entries:
+            raise ConfigEntryNotFound(key)
+        del entries[key]
+
+    update_json_blob(CONFIG_CONTAINER, CONFIG_FILES[kind], mutate)
+
+
 def load_connections() -> dict:
-    """Cargar el archivo 'connections.json' desde el contenedor de Azure Blob Storage."""
-    logging.info("Cargando 'connections.json' desde el contenedor 'connections'...")
-    return load_json_from_blob("connections", "connections.json")
+    """Cargar todas las conexiones desde el contenedor de Azure Blob Storage."""
+    with span("load_connections"):
+        return list_config_entries("connections")
 
 
 def load_destinations() -> dict:
-    """Cargar el archivo 'destinations.json' desde el contenedor de Azure Blob Storage."""
-    logging.info("Cargando 'destinations.json' desde el contenedor 'connections'...")
-    return load_json_from_blob("connections", "destinations.json")
+    """Cargar todos los destinos desde el contenedor de Azure Blob Storage."""
+    with span("load_destinations"):
+        return list_config_entries("destinations")
+
+
+def destination_entry(destination_data: dict):
+    """
+    Valor que se guarda para un destino a partir del cuerpo de create/update:
+    el nombre de la conexión ("connection_name") o, si está replicado en varias
+    ("connections"), {"connections": [...], "write_quorum": n}. El quórum es
+    opcional (por defecto, la mayoría). Devuelve None si el cuerpo no es válido.
+    """
+    connections = destination_data.get("connections")
+    if connections is None:
+        return destination_data.get("connection_name") or None
+    if (
+        not isinstance(connections, list)
+        or not connections
+        or not all(isinstance(name, str) and name for name in connections)
+        or len(set(connections)) != len(connections)
+    ):
+        return None
+    entry = {"connections": connections}
+    write_quorum = destination_data.get("write_quorum")
+    if write_quorum is not None:
+        if not isinstance(write_quorum, int) or not 1 <= write_quorum <= len(connections):
+            return None
+        entry["write_quorum"] = write_quorum
+    return entry
+
+
+def get_connection(connection_name: str) -> dict:
+    """Cargar una conexión; lanza ConfigEntryNotFound si no existe."""
+    with span("load_connection", connection=connection_name):
+        return get_config_entry("connections", connection_name)
+
+
+# Pool de clientes de Blob Storage por conexión (por worker).
+# Reutilizar el cliente mantiene el pipeline HTTP, las sesiones TLS y el keep-alive.
+BLOB_POOL_MAXSIZE = int(os.getenv("BLOB_POOL_MAXSIZE", "32"))
+BLOB_CONNECTION_TIMEOUT = int(os.getenv("BLOB_CONNECTION_TIMEOUT", "20"))
+BLOB_READ_TIMEOUT = int(os.getenv("BLOB_READ_TIMEOUT", "60"))
+# Tamaño de bloque de las descargas (acota la memoria de download_blob().chunks())
+BLOB_MAX_CHUNK_GET_SIZE = int(os.getenv("BLOB_MAX_CHUNK_GET_SIZE", str(4 * 1024 * 1024)))
+
+_client_pool = {}
+_client_pool_lock = threading.Lock()
+
+
+def _build_transport(connection_timeout: float, read_timeout: float):
+    from azure.core.pipeline.transport import RequestsTransport
+    from requests import Session
+    from requests.adapters import HTTPAdapter
 
+    session = Session()
+    adapter = HTTPAdapter(
+        pool_connections=BLOB_POOL_MAXSIZE, pool_maxsize=BLOB_POOL_MAXSIZE
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(
+        session=session,
+        session_owner=False,
+        connection_timeout=connection_timeout,
+        read_timeout=read_timeout,
+    )
+
+
+def connection_resilience(connection_info: dict) -> dict:
+    """
+    Plazos, reintentos y disyuntor de una conexión: los valores por defecto con
+    los de su objeto 'resilience' (ver resilience_utils.py).
+    """
+    return resilience_settings(
+        connection_info["data"].get("resilience"),
+        {
+            "connection_timeout": BLOB_CONNECTION_TIMEOUT,
+            "read_timeout": BLOB_READ_TIMEOUT,
+            **RESILIENCE_DEFAULTS,
+        },
+    )
 
-def generate_secKey(message: str) -> str:
-    logging.info(f"Generando SecKey para el mensaje: {message}")
-    hash_object = hashlib.sha256(message.encode())
-    sec_key = base64.b64encode(hash_object.digest()).decode("utf-8")
-    logging.info(f"SecKey generado: {sec_key}")
-    return sec_key
 
+def connection_config_hash(connection_string: str, settings: dict) -> str:
+    """Identifica la configuración de un cliente; si cambia se crea uno nuevo."""
+    config = json.dumps([connection_string, settings], sort_keys=True)
+    return hashlib.sha256(config.encode()).hexdigest()
 
-def derive_key_from_docId(docId: str) -> bytes:
-    """Deriva una clave de cifrado a partir del docId utilizando SHA-256"""
-    logging.info(f"Derivando clave de cifrado desde docId: {docId}")
-    key = hashlib.sha256(docId.encode()).digest()
-    logging.info(f"Clave derivada: {key.hex()[:16]}...")  # Muestra parte de la clave
-    return key
 
+def get_container_client_for_connection(connection_name: str, connection_info: dict):
+    """
+    Devuelve un ContainerClient reutilizable para la conexión indicada.
+
+    Los clientes se guardan por nombre de conexión y hash de la cadena de conexión
+    y de los parámetros de resiliencia, de modo que un cambio en cualquiera de
+    ellos genera un cliente nuevo.
+    """
+    connection_string = get_connection_string(connection_info)
+    container_name = connection_info["data"]["container_name"]
+    is_azure = not connection_string.startswith(tuple(STORAGE_BACKENDS))
+    # Solo Azure usa HTTP y, por tanto, plazos, reintentos y disyuntor
+    settings = connection_resilience(connection_info) if is_azure else None
+    config_hash = connection_config_hash(connection_string, settings)
+
+    with _client_pool_lock:
+        entry = _client_pool.get(connection_name)
+        if entry is None or entry["config_hash"] != config_hash:
+            options = {"max_chunk_get_size": BLOB_MAX_CHUNK_GET_SIZE}
+            if is_azure:
+                from storage_policies import resilience_options
 
-def encrypt_data(data: bytes, key: bytes) -> bytes:
-    logging.info("Cifrando datos...")
-    iv = os.urandom(16)
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
+                options.update(
+                    transport=_build_transport(
+                        settings["connection_timeout"], settings["read_timeout"]
+                    ),
+                    max_single_get_size=BLOB_MAX_CHUNK_GET_SIZE,
+                    **resilience_options(connection_name, settings),
+                )
+            entry = {
+                "config_hash": config_hash,
+                "service": create_blob_service_client(connection_string, **options),
+                "containers": {},
+            }
+            _client_pool[connection_name] = entry
+            logger.info("Cliente de Blob Service creado para '%s'.", connection_name)
 
-    padder = padding.PKCS7(128).padder()
-    padded_data = padder.update(data) + padder.finalize()
+        container_client = entry["containers"].get(container_name)
+        if container_client is None:
+            container_client = entry["service"].get_container_client(container_name)
+            entry["containers"][container_name] = container_client
+        return container_client
 
-    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-    logging.info("Datos cifrados correctamente.")
-    return iv + encrypted_data
 
+# Funciones a las que se avisa al descartar el cliente de una conexión (p. ej.
+# el pool de clientes asíncronos de contentserver/aio.py)
+_drop_callbacks = []
 
-def decrypt_data(encrypted_data: bytes, key: bytes) -> bytes:
-    logging.info("Descifrando datos...")
-    iv = encrypted_data[:16]
-    encrypted_data = encrypted_data[16:]
 
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
+def register_drop_callback(callback) -> None:
+    _drop_callbacks.append(callback)
 
-    decrypted_padded_data = decryptor.update(encrypted_data) + decryptor.finalize()
 
-    unpadder = padding.PKCS7(128).unpadder()
-    decrypted_data = unpadder.update(decrypted_padded_data) + unpadder.finalize()
+def drop_blob_client(connection_name: str) -> None:
+    """Elimina del pool el cliente de una conexión (p. ej. tras modificarla o borrarla)."""
+    with _client_pool_lock:
+        _client_pool.pop(connection_name, None)
+    for callback in _drop_callbacks:
+        callback(connection_name)
 
-    logging.info("Datos descifrados correctamente.")
-    return decrypted_data
+
+def prewarm_blob_clients() -> None:
+    """Crea por adelantado los clientes de todas las conexiones de almacenamiento."""
+    try:
+        connections = load_connections()
+        for connection_name, connection_info in connections.items():
+            if connection_info.get("cloud") in STORAGE_CLOUDS:
+                get_container_client_for_connection(connection_name, connection_info)
+    except Exception as e:
+        logger.warning("No se pudo precalentar el pool de clientes: %s", e)
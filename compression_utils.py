@@ -0,0 +1,180 @@
+import os
+import zlib
+import logging
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional; sin el paquete se usa zlib
+    zstandard = None
+
+# Compresión previa al cifrado. Cada conexión puede pedir un códec con el campo
+# "compression" ("zlib" o "zstd"); el códec usado queda en los metadatos del blob
+# (content_encoding) y solo se aplica si el contenido no está ya comprimido y la
+# muestra inicial se reduce al menos COMPRESSION_MIN_RATIO veces.
+CODEC_ZLIB = "zlib"
+CODEC_ZSTD = "zstd"
+
+# Nombre del códec en Accept-Encoding / Content-Encoding ("deflate" es zlib, RFC 9110)
+HTTP_ENCODINGS = {CODEC_ZLIB: "deflate", CODEC_ZSTD: "zstd"}
+
+COMPRESSION_MIN_RATIO = float(os.getenv("COMPRESSION_MIN_RATIO", "1.2"))
+COMPRESSION_SAMPLE_SIZE = int(os.getenv("COMPRESSION_SAMPLE_SIZE", str(64 * 1024)))
+COMPRESSION_LEVEL_ZLIB = int(os.getenv("COMPRESSION_LEVEL_ZLIB", "6"))
+COMPRESSION_LEVEL_ZSTD = int(os.getenv("COMPRESSION_LEVEL_ZSTD", "3"))
+# Tamaño máximo de cada parte descomprimida (zlib)
+DECOMPRESS_CHUNK_SIZE = int(os.getenv("DECOMPRESS_CHUNK_SIZE", str(4 * 1024 * 1024)))
+
+# Firmas de formatos que ya van comprimidos (imágenes, zip/ofimática, gzip...)
+COMPRESSED_SIGNATURES = (
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG\r\n\x1a\n",
+    b"GIF8",
+    b"PK\x03\x04",  # ZIP, DOCX, XLSX...
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"7z\xbc\xaf\x27\x1c",
+    b"Rar!\x1a\x07",
+    b"BZh",
+    b"\xfd7zXZ\x00",
+    b"\x00\x00\x00\x0cjP  ",  # JPEG 2000
+)
+COMPRESSED_CONTENT_TYPES = ("image/jpeg", "image/png", "image/gif", "application/zip")
+COMPRESSED_CONTENT_TYPE_PREFIXES = ("video/", "audio/")
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_codec(codec):
+    """Normaliza el códec configurado; zstd sin el paquete instalado pasa a zlib."""
+    if not codec:
+        return None
+    codec = codec.lower()
+    if codec == CODEC_ZSTD and zstandard is None:
+        logger.warning("Paquete 'zstandard' no disponible; se comprime con zlib")
+        return CODEC_ZLIB
+    if codec not in HTTP_ENCODINGS:
+        raise ValueError(f"Códec de compresión no soportado: {codec}")
+    return codec
+
+
+def is_precompressed(sample: bytes, content_type: str = None) -> bool:
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in COMPRESSED_CONTENT_TYPES or content_type.startswith(
+        COMPRESSED_CONTENT_TYPE_PREFIXES
+    ):
+        return True
+    return sample.startswith(COMPRESSED_SIGNATURES)
+
+
+def compressor(codec: str):
+    """Compresor incremental con compress()/flush()."""
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL_ZSTD).compressobj()
+    return zlib.compressobj(COMPRESSION_LEVEL_ZLIB)
+
+
+def decompressor(codec: str):
+    """Descompresor incremental con decompress()/flush()."""
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Paquete 'zstandard' no disponible para descomprimir")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec != CODEC_ZLIB:
+        raise ValueError(f"Códec de compresión no soportado: {codec}")
+    return zlib.decompressobj()
+
+
+def choose_codec(codec, sample: bytes, content_type: str = None):
+    """
+    Devuelve el códec con el que comprimir un fichero a partir de su muestra
+    inicial, o None si no compensa (ya comprimido o ratio insuficiente).
+    """
+    codec = resolve_codec(codec)
+    if codec is None or not sample or is_precompressed(sample, content_type):
+        return None
+    c = compressor(codec)
+    compressed_size = len(c.compress(sample)) + len(c.flush())
+    if len(sample) < COMPRESSION_MIN_RATIO * compressed_size:
+        return None
+    return codec
+
+
+def peek(chunks, size: int):
+    """Lee al menos 'size' bytes del iterable; devuelve (muestra, iterador completo)."""
+    chunks = iter(chunks)
+    head = []
+    read = 0
+    for chunk in chunks:
+        head.append(chunk)
+        read += len(chunk)
+        if read >= size:
+            break
+    sample = b"".join(head)
+
+    def rest():
+        if sample:
+            yield sample
+        yield from chunks
+
+    return sample[:size], rest()
+
+
+def iter_compressed_chunks(chunks, codec: str):
+    c = compressor(codec)
+    for chunk in chunks:
+        compressed = c.compress(chunk)
+        if compressed:
+            yield compressed
+    tail = c.flush()
+    if tail:
+        yield tail
+
+
+def iter_decompressed(d, chunk: bytes, codec: str):
+    """Descomprime un bloque con el descompresor d, por partes si es zlib."""
+    if codec != CODEC_ZLIB:
+        data = d.decompress(chunk)
+        if data:
+            yield data
+        return
+    # Un bloque muy comprimido puede ocupar mucho más al descomprimirlo:
+    # se entrega por partes de DECOMPRESS_CHUNK_SIZE
+    while True:
+        data = d.decompress(chunk, DECOMPRESS_CHUNK_SIZE)
+        if data:
+            yield data
+        chunk = d.unconsumed_tail
+        if not chunk and len(data) < DECOMPRESS_CHUNK_SIZE:
+            return
+
+
+def iter_decompressed_chunks(chunks, codec: str):
+    d = decompressor(codec)
+    for chunk in chunks:
+        yield from iter_decompressed(d, chunk, codec)
+    tail = d.flush()
+    if tail:
+        yield tail
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    return b"".join(iter_decompressed_chunks([data], codec))
+
+
+def accepts_encoding(accept_encoding, codec: str) -> bool:
+    """Indica si la cabecera Accept-Encoding del cliente admite el códec."""
+    if not accept_encoding or not codec:
+        return False
+    wanted = HTTP_ENCODINGS.get(codec)
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() != wanted:
+            continue
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
@@ -0,0 +1,529 @@
+import io
+import asyncio
+import json
+import time
+import logging
+
+import aiohttp
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.functions import HttpRequest, HttpResponse
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+from azure.storage.blob.aio import ExponentialRetry as AsyncExponentialRetry
+
+from blob_utils import (
+    BLOB_MAX_CHUNK_GET_SIZE,
+    BLOB_POOL_MAXSIZE,
+    STORAGE_BACKENDS,
+    connection_config_hash,
+    connection_resilience,
+    get_connection,
+    register_drop_callback,
+)
+from compression_utils import (
+    accepts_encoding,
+    decompressor,
+    iter_decompressed,
+    resolve_codec,
+)
+from crypto_utils import StreamDecryptor, derive_key_from_docId
+from resilience_utils import CircuitOpenError, ensure_available
+from storage_policies import BudgetedRetryMixin, resilience_options
+from tracing_utils import end_trace, run_in_executor, span, start_trace, traced_aiter
+from . import (
+    handle_request,
+    handle_server_info,
+    handle_storage_health,
+    parse_command,
+    unavailable_response,
+)
+from .handlers import (
+    UPLOAD_MAX_PENDING_BLOCKS,
+    build_document_index,
+    component_key,
+    connection_names_of,
+    create_response,
+    document_info_from_index,
+    document_response,
+    document_validators,
+    index_blob_name,
+    info_response,
+    is_conditional_request,
+    is_range_request,
+    iter_upload_blocks,
+    load_destination,
+    new_upload,
+    next_block_id,
+    uploaded_file_info,
+)
+from . import doccache
+from .multipart import MultipartError, get_boundary, iter_multipart_files
+
+# Variante asíncrona del content server (CONTENTSERVER_ASYNC=1).
+# La E/S con Blob Storage usa azure.storage.blob.aio y el cifrado, que es trabajo
+# de CPU, se ejecuta en el executor del bucle. Los casos que no cubre esta
+# variante (rangos, documentos sin índice, batchInfo, mCreate, append, create
+# con deduplicación, delete...) se delegan al manejador síncrono en el executor.
+
+logger = logging.getLogger(__name__)
+
+_async_clients = {}
+# Último ContainerClient resuelto de cada contRep, para leer el índice mientras
+# se revalida la configuración
+_resolved_containers = {}
+# Cierres pendientes de clientes sustituidos (referencias para que no se pierdan)
+_closing = set()
+
+
+class AsyncBudgetedRetry(BudgetedRetryMixin, AsyncExponentialRetry):
+    pass
+
+
+async def _close_async_client(entry: dict) -> None:
+    # Se espera read_timeout para no cortar las peticiones que aún lo usan
+    await asyncio.sleep(entry["read_timeout"])
+    try:
+        await entry["service"].close()
+        await entry["session"].close()
+    except Exception as e:
+        logger.warning("No se pudo cerrar el cliente asíncrono: %s", e)
+
+
+def _retire_async_client(entry: dict) -> None:
+    """Programa el cierre de un cliente sustituido; se puede llamar desde cualquier hilo."""
+
+    def schedule():
+        task = asyncio.ensure_future(_close_async_client(entry))
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+
+    try:
+        entry["loop"].call_soon_threadsafe(schedule)
+    except RuntimeError:
+        # El bucle ya está cerrado y con él las conexiones
+        pass
+
+
+def drop_async_client(connection_name: str) -> None:
+    """Descarta el cliente asíncrono de una conexión (ver blob_utils.drop_blob_client)."""
+    entry = _async_clients.pop(connection_name, None)
+    if entry is not None:
+        for contRep, container_client in list(_resolved_containers.items()):
+            if container_client in entry["containers"].values():
+                _resolved_containers.pop(contRep, None)
+        _retire_async_client(entry)
+
+
+register_drop_callback(drop_async_client)
+
+
+def get_async_container_client(connection_name: str, connection_info: dict):
+    """Equivalente asíncrono de get_container_client_for_connection (un cliente por conexión)."""
+    connection_data = connection_info["data"]
+    connection_string = connection_data["connection_string"]
+    settings = connection_resilience(connection_info)
+    config_hash = connection_config_hash(connection_string, settings)
+
+    entry = _async_clients.get(connection_name)
+    if entry is None or entry["config_hash"] != config_hash:
+        if entry is not None:
+            _retire_async_client(entry)
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=BLOB_POOL_MAXSIZE)
+        )
+        entry = {
+            "config_hash": config_hash,
+            "loop": asyncio.get_running_loop(),
+            "session": session,
+            "read_timeout": settings["read_timeout"],
+            "service": AsyncBlobServiceClient.from_connection_string(
+                connection_string,
+                transport=AioHttpTransport(session=session, session_owner=False),
+                connection_timeout=settings["connection_timeout"],
+                read_timeout=settings["read_timeout"],
+                max_single_get_size=BLOB_MAX_CHUNK_GET_SIZE,
+                max_chunk_get_size=BLOB_MAX_CHUNK_GET_SIZE,
+                **resilience_options(connection_name, settings, AsyncBudgetedRetry),
+            ),
+            "containers": {},
+        }
+        _async_clients[connection_name] = entry
+
+    container_name = connection_data["container_name"]
+    container_client = entry["containers"].get(container_name)
+    if container_client is None:
+        container_client = entry["service"].get_container_client(container_name)
+        entry["containers"][container_name] = container_client
+    return container_client
+
+
+def _resolve_connection(contRep: str):
+    connection_names = connection_names_of(load_destination(contRep))
+    ensure_available(connection_names)
+    return connection_names, get_connection(connection_names[0])
+
+
+async def resolve_container_async(contRep: str):
+    """
+    Resuelve la conexión del contRep y devuelve (ContainerClient, conexión), o
+    (None, conexión principal) si no es de tipo AZURE, usa un backend local o en
+    memoria o el destino está replicado.
+    """
+    loop = asyncio.get_running_loop()
+    # La configuración suele estar en caché, pero si no lo está implica E/S síncrona
+    connection_names, connection_info = await run_in_executor(
+        loop, _resolve_connection, contRep
+    )
+    if (
+        len(connection_names) > 1
+        or connection_info["cloud"] != "AZURE"
+        or connection_info["data"]["connection_string"].startswith(
+            tuple(STORAGE_BACKENDS)
+        )
+    ):
+        # Los backends local y en memoria y la replicación solo tienen cliente síncrono
+        _resolved_containers.pop(contRep, None)
+        return None, connection_info
+    container_client = get_async_container_client(connection_names[0], connection_info)
+    _resolved_containers[contRep] = container_client
+    return container_client, connection_info
+
+
+async def resolve_document_index_async(contRep: str, docId: str):
+    """
+    Devuelve (ContainerClient, índice del documento). Si el contRep ya se había
+    resuelto, el índice se lee en ese contenedor a la vez que se revalida la
+    configuración; si la conexión ha cambiado, se vuelve a leer en el nuevo.
+    """
+    speculative = _resolved_containers.get(contRep)
+    if speculative is None:
+        container_client, _ = await resolve_container_async(contRep)
+        if container_client is None:
+            return None, None
+        return container_client, await read_document_index_async(
+            container_client, contRep, docId
+        )
+
+    resolved, index = await asyncio.gather(
+        resolve_container_async(contRep),
+        read_document_index_async(speculative, contRep, docId),
+        return_exceptions=True,
+    )
+    if isinstance(resolved, BaseException):
+        raise resolved
+    container_client = resolved[0]
+    if container_client is None:
+        return None, None
+    if container_client is not speculative:
+        return container_client, await read_document_index_async(
+            container_client, contRep, docId
+        )
+    if isinstance(index, BaseException):
+        raise index
+    return container_client, index
+
+
+async def read_document_index_async(container_client, contRep: str, docId: str):
+    with span("read_index") as attributes:
+        try:
+            downloader = await container_client.get_blob_client(
+                index_blob_name(contRep, docId)
+            ).download_blob()
+            content = await downloader.readall()
+        except ResourceNotFoundError:
+            attributes["found"] = False
+            return None
+        attributes["bytes"] = len(content)
+    return json.loads(content)
+
+
+def document_error_response(docId: str, error: Exception) -> HttpResponse:
+    """500 para los errores de Blob Storage, como en el manejador síncrono."""
+    logger.error("Error al recuperar el documento %s: %s", docId, error)
+    return HttpResponse(
+        f"Error al recuperar el documento: {str(error)}", status_code=500
+    )
+
+
+async def handle_get_async(req: HttpRequest, command: str):
+    contRep = req.params.get("contRep")
+    docId = req.params.get("docId")
+    if not contRep or not docId or command not in ("get", "info"):
+        return None
+    if command == "get" and (
+        is_range_request(req)
+        or is_conditional_request(req)
+        or doccache.contains(contRep, docId)
+    ):
+        # Rangos, peticiones condicionales y documentos en caché se sirven desde
+        # el manejador síncrono
+        return None
+
+    try:
+        container_client, index = await resolve_document_index_async(contRep, docId)
+    except CircuitOpenError:
+        raise
+    except json.JSONDecodeError as e:
+        return document_error_response(docId, e)
+    except ValueError as e:
+        # Configuración del contRep no válida
+        logger.error(str(e))
+        return HttpResponse(str(e), status_code=400)
+    except Exception as e:
+        return document_error_response(docId, e)
+    if index is None or "created" not in index:
+        return None
+
+    if command == "info":
+        return info_response(
+            command, document_info_from_index(contRep, docId, index), req
+        )
+
+    loop = asyncio.get_running_loop()
+    component = index["components"][0]
+    decryptor = StreamDecryptor(component_key(docId, component))
+    blob_client = container_client.get_blob_client(component["blob_name"])
+    try:
+        with span("download_blob") as attributes:
+            downloader = await blob_client.download_blob()
+            attributes["size"] = downloader.size
+    except ResourceNotFoundError:
+        return None
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return document_error_response(docId, e)
+
+    codec = (downloader.properties.metadata or {}).get("content_encoding")
+    passthrough = accepts_encoding(req.headers.get("Accept-Encoding"), codec)
+
+    # Como en serve_document: el blob cifrado pasa a la caché según llega y el
+    # documento se descifra y descomprime por bloques; solo se retiene en claro
+    cache = doccache.open_writer(contRep, docId, component, downloader.properties)
+    inflater = decompressor(codec) if codec and not passthrough else None
+    content = io.BytesIO()
+
+    def decrypt(chunk):
+        if cache is not None:
+            cache.write(chunk)
+        return decryptor.update(chunk)
+
+    async def write(plaintext):
+        if inflater is None:
+            content.write(plaintext)
+            return
+        with span("decompress", bytes=len(plaintext)):
+            await loop.run_in_executor(
+                None,
+                content.writelines,
+                iter_decompressed(inflater, plaintext, codec),
+            )
+
+    try:
+        async for chunk in traced_aiter("download_blob", downloader.chunks()):
+            with span("decrypt", bytes=len(chunk)):
+                plaintext = await loop.run_in_executor(None, decrypt, chunk)
+            await write(plaintext)
+        await write(await loop.run_in_executor(None, decryptor.finalize))
+        if inflater is not None:
+            content.write(inflater.flush())
+        content = content.getvalue()
+    except CircuitOpenError as e:
+        if cache is not None:
+            cache.discard()
+        return unavailable_response(e)
+    except Exception as e:
+        if cache is not None:
+            cache.discard()
+        logger.error("Error al desencriptar el documento %s: %s", docId, e)
+        return HttpResponse(
+            f"Error al desencriptar el documento: {str(e)}", status_code=500
+        )
+    if cache is not None:
+        with span("cache_store", bytes=downloader.size):
+            await loop.run_in_executor(None, cache.commit)
+    with span("build_response", bytes=len(content)):
+        return document_response(
+            docId,
+            content,
+            content_encoding=codec if passthrough else None,
+            compressed=bool(codec),
+            validators=document_validators(downloader.properties, passthrough),
+        )
+
+
+async def abort_uploads_async(uploads, commits=()) -> None:
+    """
+    Equivalente asíncrono de handlers.abort_uploads: cancela los bloques aún
+    pendientes y las confirmaciones de 'commits' y espera a que terminen. Esta
+    variante no sube contenidos deduplicados, así que no hay referencias que liberar.
+    """
+    tasks = [*commits, *(f for upload in uploads for f in upload["futures"])]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def started_uploads(uploads: list, current) -> list:
+    """Subidas iniciadas: las de 'uploads' y la del fichero en curso, si la hay."""
+    started = [upload for _, _, upload in uploads]
+    if current is not None and current not in started:
+        started.append(current)
+    return started
+
+
+async def handle_post_async(req: HttpRequest, command: str):
+    contRep = req.params.get("contRep")
+    docId = req.params.get("docId")
+    if not contRep or not docId:
+        return None
+
+    try:
+        container_client, connection_info = await resolve_container_async(contRep)
+    except ValueError as e:
+        # Configuración del contRep no válida, como en handle_post
+        logger.error(str(e))
+        return HttpResponse(str(e), status_code=400)
+    if container_client is None:
+        return None
+    if connection_info["data"].get("dedup"):
+        return None
+    try:
+        compression = resolve_codec(connection_info["data"].get("compression"))
+    except ValueError:
+        return None
+
+    loop = asyncio.get_running_loop()
+    key = derive_key_from_docId(docId)
+    pending_slots = asyncio.Semaphore(UPLOAD_MAX_PENDING_BLOCKS)
+    uploads = []
+    upload = None
+
+    async def send(coroutine):
+        try:
+            return await coroutine
+        finally:
+            pending_slots.release()
+
+    try:
+        boundary = get_boundary(req.headers.get("Content-Type", ""))
+        parts = iter_multipart_files(req.get_body(), boundary)
+        while True:
+            # El parser y el cifrado avanzan en el executor; las subidas son tareas
+            part = await run_in_executor(loop, next, parts, None)
+            if part is None:
+                break
+            filename, part_headers, chunks = part
+            blob_name = f"{contRep}/{docId}_{filename}"
+            blob_client = container_client.get_blob_client(blob_name)
+            upload = new_upload(
+                blob_client,
+                part_headers.get("content-type", "application/octet-stream"),
+                compression,
+            )
+            blocks = iter_upload_blocks(upload, chunks, key)
+            while True:
+                block = await run_in_executor(loop, next, blocks, None)
+                if block is None:
+                    break
+                data, last = block
+                await pending_slots.acquire()
+                if last and not upload["block_ids"]:
+                    operation = blob_client.upload_blob(
+                        data, overwrite=True, metadata=upload["metadata"]
+                    )
+                else:
+                    operation = blob_client.stage_block(next_block_id(upload), data)
+                upload["futures"].append(asyncio.ensure_future(send(operation)))
+            uploads.append((filename, blob_name, upload))
+    except MultipartError as e:
+        await abort_uploads_async(started_uploads(uploads, upload))
+        logger.error("Cuerpo multipart no válido: %s", e)
+        return HttpResponse(f"Cuerpo multipart no válido: {str(e)}", status_code=400)
+    except CircuitOpenError as e:
+        await abort_uploads_async(started_uploads(uploads, upload))
+        return unavailable_response(e)
+    except Exception as e:
+        await abort_uploads_async(started_uploads(uploads, upload))
+        logger.error("Error al subir archivo a Azure Blob: %s", e)
+        return HttpResponse(f"Error al subir archivo: {str(e)}", status_code=500)
+
+    async def finish(upload):
+        await asyncio.gather(*upload["futures"])
+        if upload["block_ids"]:
+            await upload["blob_client"].commit_block_list(
+                upload["block_ids"], metadata=upload["metadata"]
+            )
+        upload["finished"] = time.perf_counter()
+
+    commits = [asyncio.ensure_future(finish(upload)) for _, _, upload in uploads]
+    try:
+        with span("upload_commit", files=len(uploads)):
+            await asyncio.gather(*commits)
+    except CircuitOpenError as e:
+        await abort_uploads_async((upload for _, _, upload in uploads), commits)
+        return unavailable_response(e)
+    except Exception as e:
+        await abort_uploads_async((upload for _, _, upload in uploads), commits)
+        logger.error("Error al subir archivo a Azure Blob: %s", e)
+        return HttpResponse(f"Error al subir archivo: {str(e)}", status_code=500)
+
+    file_info = [
+        uploaded_file_info(filename, blob_name, upload)
+        for filename, blob_name, upload in uploads
+    ]
+
+    if file_info:
+        try:
+            content = json.dumps(build_document_index(docId, file_info))
+            with span("write_index", bytes=len(content)):
+                await container_client.get_blob_client(
+                    index_blob_name(contRep, docId)
+                ).upload_blob(content, overwrite=True)
+        except Exception as e:
+            logger.warning("No se pudo escribir el índice del documento %s: %s", docId, e)
+        doccache.invalidate(contRep, docId)
+
+    with span("build_response"):
+        return create_response(command, contRep, docId, file_info)
+
+
+async def handle_request_async(req: HttpRequest) -> HttpResponse:
+    """Punto de entrada asíncrono; delega en handle_request lo que no cubre."""
+    command = parse_command(req)
+    trace = start_trace(
+        f"contentserver {command}",
+        req.headers.get("traceparent"),
+        **{"http.method": req.method, "command": command, "async": True},
+    )
+    response = None
+    try:
+        response = await dispatch_request_async(req, command)
+        return response
+    finally:
+        end_trace(trace, response)
+
+
+async def dispatch_request_async(req: HttpRequest, command: str) -> HttpResponse:
+    response = None
+    if command == "serverInfo":
+        return handle_server_info(req.params.get("pVersion"), req.params.get("contRep"))
+    if command == "storageHealth" and req.method == "GET":
+        return handle_storage_health()
+    try:
+        if command and req.method == "GET":
+            response = await handle_get_async(req, command)
+        elif (
+            command
+            and command not in ("batchInfo", "mCreate", "append")
+            and req.method == "POST"
+        ):
+            response = await handle_post_async(req, command)
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    if response is not None:
+        return response
+
+    # handle_request reutiliza la traza de esta petición (ver start_trace)
+    loop = asyncio.get_running_loop()
+    return await run_in_executor(loop, handle_request, req)
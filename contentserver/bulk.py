@@ -0,0 +1,303 @@
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+import posixpath
+import tarfile
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.functions import HttpRequest, HttpResponse
+
+from compression_utils import resolve_codec
+from logging_utils import SAMPLED
+from tracing_utils import span, traced_iter
+from .handlers import (
+    UPLOAD_MAX_PENDING_BLOCKS,
+    abort_uploads,
+    commit_document_index,
+    finish_dedup_upload,
+    finish_encrypted_upload,
+    resolve_destination,
+    start_document_upload,
+    uploaded_file_info,
+)
+from .multipart import (
+    READ_CHUNK_SIZE,
+    MultipartError,
+    get_boundary,
+    get_disposition_param,
+    iter_multipart_files,
+)
+
+# Ingesta en lote (comando 'mCreate', al estilo de ArchiveLink): un único POST
+# con muchos documentos de un contRep, en uno de estos formatos:
+#   - multipart/form-data: cada parte con fichero es un componente y su docId es
+#     el nombre del campo (name="docId"); las partes consecutivas con el mismo
+#     docId forman un documento;
+#   - application/x-tar: cada entrada "docId/filename" es un componente.
+# Destino, conexiones y cliente se resuelven una sola vez. Cada documento se cifra
+# y sube en un pool acotado (INGEST_CONCURRENCY) cuyos bloques comparten el pool
+# de subidas del worker, y la respuesta informa del resultado de cada docId.
+
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+# Documentos leídos del cuerpo y pendientes de subir; acota la memoria usada
+INGEST_MAX_PENDING_DOCUMENTS = int(
+    os.getenv("INGEST_MAX_PENDING_DOCUMENTS", str(2 * INGEST_CONCURRENCY))
+)
+TAR_CONTENT_TYPES = ("application/x-tar", "application/tar")
+
+logger = logging.getLogger(__name__)
+
+_ingest_executor = ThreadPoolExecutor(
+    max_workers=INGEST_CONCURRENCY, thread_name_prefix="ingest"
+)
+
+
+def valid_entry_name(name: str) -> bool:
+    """
+    Un docId o filename del lote forma parte del nombre del blob: no puede estar
+    vacío ni ser '.' o '..', ni contener separadores de ruta.
+    """
+    return bool(name) and name not in (".", "..") and not any(
+        separator in name for separator in ("/", "\\")
+    )
+
+
+def iter_multipart_entries(body: bytes, content_type: str):
+    """Componentes de un cuerpo multipart: (docId, filename, tipo, bloques)."""
+    boundary = get_boundary(content_type)
+    for filename, part_headers, chunks in iter_multipart_files(body, boundary):
+        docId = get_disposition_param(part_headers, "name")
+        # Sin docId el documento se rechaza en el resultado del lote
+        if docId and not valid_entry_name(docId):
+            raise MultipartError(f"docId no válido: {docId}")
+        if not valid_entry_name(filename):
+            raise MultipartError(f"Nombre de fichero no válido: {filename}")
+        yield (
+            docId,
+            filename,
+            part_headers.get("content-type", "application/octet-stream"),
+            chunks,
+        )
+
+
+def iter_tar_entries(body: bytes):
+    """Componentes de un tar ('docId/filename'): (docId, filename, tipo, bloques)."""
+    # Modo flujo: el tar se recorre una vez, sin buscar hacia atrás
+    with tarfile.open(fileobj=io.BytesIO(body), mode="r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            docId, _, filename = posixpath.normpath(member.name).partition("/")
+            if not filename:
+                raise tarfile.TarError(f"Entrada sin docId/filename: {member.name}")
+            # Se rechazan rutas absolutas, '..' y subdirectorios
+            if not (valid_entry_name(docId) and valid_entry_name(filename)):
+                raise tarfile.TarError(f"Entrada no válida: {member.name}")
+            content_type, _ = mimetypes.guess_type(filename)
+            stream = archive.extractfile(member)
+            yield (
+                docId,
+                filename,
+                content_type or "application/octet-stream",
+                iter(lambda: stream.read(READ_CHUNK_SIZE), b""),
+            )
+
+
+def iter_documents(entries):
+    """
+    Agrupa los componentes consecutivos con el mismo docId y devuelve
+    (docId, [(filename, tipo, bloques)]). El contenido de cada documento se lee
+    antes de pasar al siguiente.
+    """
+    docId, files = None, []
+    for entry_docId, filename, content_type, chunks in entries:
+        if files and entry_docId != docId:
+            yield docId, files
+            files = []
+        docId = entry_docId
+        files.append((filename, content_type, list(traced_iter("parse_body", chunks))))
+    if files:
+        yield docId, files
+
+
+def content_digest(chunks: list) -> str:
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ingest_document(
+    container_client,
+    contRep: str,
+    docId: str,
+    files: list,
+    pending_slots,
+    compression: str = None,
+    dedup: bool = False,
+) -> list:
+    """
+    Cifra y sube los ficheros de un documento y escribe su índice. Si algo
+    falla, se deshacen las subidas ya iniciadas (ver abort_uploads).
+    """
+    uploads = []
+    try:
+        for filename, content_type, chunks in files:
+            blob_name, upload = start_document_upload(
+                container_client,
+                contRep,
+                docId,
+                filename,
+                chunks,
+                pending_slots,
+                content_type,
+                compression,
+                digest=content_digest(chunks) if dedup else None,
+            )
+            uploads.append((filename, blob_name, upload))
+
+        finish = finish_dedup_upload if dedup else finish_encrypted_upload
+        for _, _, upload in uploads:
+            finish(upload)
+        file_info = [
+            uploaded_file_info(filename, blob_name, upload)
+            for filename, blob_name, upload in uploads
+        ]
+        commit_document_index(container_client, contRep, docId, file_info, dedup)
+    except BaseException:
+        abort_uploads(upload for _, _, upload in uploads)
+        raise
+    return file_info
+
+
+def _submit_ingest(pending_documents, fn, *args):
+    """Encola la ingesta de un documento respetando el límite de pendientes."""
+    pending_documents.acquire()
+    future = _ingest_executor.submit(fn, *args)
+    future.add_done_callback(lambda _: pending_documents.release())
+    return future
+
+
+def handle_bulk_create(req: HttpRequest) -> HttpResponse:
+    contRep = req.params.get("contRep")
+    if not contRep:
+        return HttpResponse(
+            "Faltan parámetros requeridos para 'mCreate'", status_code=400
+        )
+
+    try:
+        container_client, connection_info = resolve_destination(contRep)
+        connection_data = connection_info.get("data", {})
+        compression = resolve_codec(connection_data.get("compression"))
+        dedup = bool(connection_data.get("dedup"))
+    except ValueError as e:
+        logger.error(str(e))
+        return HttpResponse(str(e), status_code=400)
+
+    content_type = req.headers.get("Content-Type", "")
+    body = req.get_body()
+    if content_type.split(";")[0].strip().lower() in TAR_CONTENT_TYPES:
+        entries = iter_tar_entries(body)
+    else:
+        entries = iter_multipart_entries(body, content_type)
+
+    started = time.perf_counter()
+    pending_documents = threading.BoundedSemaphore(INGEST_MAX_PENDING_DOCUMENTS)
+    # Bloques cifrados pendientes de subir, compartidos por todo el lote
+    pending_slots = threading.BoundedSemaphore(UPLOAD_MAX_PENDING_BLOCKS)
+    outcomes = []
+    seen = set()
+    body_error = None
+
+    # Los documentos se ingieren en otros hilos, sin la traza de la petición
+    with span("bulk_ingest", bytes=len(body)) as attributes:
+        try:
+            for docId, files in iter_documents(entries):
+                if not docId:
+                    outcomes.append((docId, "Falta el docId (nombre del campo)"))
+                elif docId in seen:
+                    outcomes.append((docId, "docId repetido en el lote"))
+                else:
+                    seen.add(docId)
+                    future = _submit_ingest(
+                        pending_documents,
+                        ingest_document,
+                        container_client,
+                        contRep,
+                        docId,
+                        files,
+                        pending_slots,
+                        compression,
+                        dedup,
+                    )
+                    outcomes.append((docId, future))
+        except (MultipartError, tarfile.TarError) as e:
+            # Los documentos ya leídos se completan y se informan igualmente
+            logger.error("Cuerpo del lote no válido: %s", e)
+            body_error = str(e)
+
+        documents = []
+        for docId, outcome in outcomes:
+            if isinstance(outcome, str):
+                documents.append({"docId": docId, "status": "error", "error": outcome})
+                continue
+            try:
+                documents.append(
+                    {"docId": docId, "status": "created", "files": outcome.result()}
+                )
+            except Exception as e:
+                logger.error(
+                    "Error al ingerir el documento %s: %s", docId, e, extra=SAMPLED
+                )
+                documents.append({"docId": docId, "status": "error", "error": str(e)})
+        attributes["documents"] = len(documents)
+
+    if not documents and body_error is None:
+        return HttpResponse("El lote no contiene documentos", status_code=400)
+
+    with span("build_response"):
+        return bulk_response(contRep, documents, started, body_error)
+
+
+def bulk_response(
+    contRep: str, documents: list, started: float, body_error: str = None
+) -> HttpResponse:
+    created = sum(1 for d in documents if d["status"] == "created")
+    if body_error is not None:
+        status_code = 400
+        message = f"Cuerpo del lote no válido: {body_error}"
+    elif created == len(documents):
+        status_code = 201
+        message = "Documentos subidos exitosamente."
+    else:
+        # Resultado parcial: el estado de cada documento va en 'documents'
+        status_code = 207
+        message = "Lote procesado con errores."
+    return HttpResponse(
+        body=json.dumps(
+            {
+                "message": message,
+                "status": status_code,
+                "details": {
+                    "command": "mCreate",
+                    "contRep": contRep,
+                    "created": created,
+                    "failed": len(documents) - created,
+                    "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                    "documents": documents,
+                },
+            }
+        ),
+        mimetype="application/json",
+        headers={
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+            "Access-Control-Allow-Headers": "Content-Type, Authorization",
+        },
+        status_code=status_code,
+    )
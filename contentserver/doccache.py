@@ -0,0 +1,322 @@
+import os
+import mmap
+import uuid
+import time
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+
+# Caché LRU de documentos servidos recientemente (por worker), con dos niveles:
+# los pequeños en memoria y los grandes en un fichero temporal que se lee con
+# mmap. Se guarda el blob tal y como está en Blob Storage (cifrado), de modo que
+# ningún nivel contiene el documento en claro; un acierto evita Blob Storage y
+# solo paga el descifrado.
+#
+# Cada entrada recuerda el blob y su ETag. Durante DOCUMENT_CACHE_TTL_SECONDS se
+# sirve sin consultar nada; pasado ese tiempo el llamador la revalida (índice y
+# ETag del blob) antes de volver a usarla.
+DOCUMENT_CACHE_TTL_SECONDS = float(os.getenv("DOCUMENT_CACHE_TTL_SECONDS", "30"))
+DOCUMENT_CACHE_MEMORY_BYTES = int(
+    os.getenv("DOCUMENT_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024))
+)
+DOCUMENT_CACHE_DISK_BYTES = int(
+    os.getenv("DOCUMENT_CACHE_DISK_BYTES", str(1024 * 1024 * 1024))
+)
+# Los blobs de hasta este tamaño van a memoria; los mayores, a disco
+DOCUMENT_CACHE_MEMORY_ITEM_BYTES = int(
+    os.getenv("DOCUMENT_CACHE_MEMORY_ITEM_BYTES", str(1024 * 1024))
+)
+DOCUMENT_CACHE_MAX_ITEM_BYTES = int(
+    os.getenv("DOCUMENT_CACHE_MAX_ITEM_BYTES", str(64 * 1024 * 1024))
+)
+DOCUMENT_CACHE_DIR = os.getenv(
+    "DOCUMENT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "contentserver-cache")
+)
+DOCUMENT_CACHE_READ_SIZE = 4 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_usage = {"memory": 0, "disk": 0}
+_stats = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0, "evicted": 0}
+
+
+def is_cacheable(size: int) -> bool:
+    if size > DOCUMENT_CACHE_MAX_ITEM_BYTES:
+        return False
+    if size <= DOCUMENT_CACHE_MEMORY_ITEM_BYTES:
+        return size <= DOCUMENT_CACHE_MEMORY_BYTES
+    return size <= DOCUMENT_CACHE_DISK_BYTES
+
+
+def contains(contRep: str, docId: str) -> bool:
+    with _lock:
+        return (contRep, docId) in _entries
+
+
+def lookup(contRep: str, docId: str):
+    """
+    Devuelve (entrada, vigente) o (None, False). Una entrada no vigente debe
+    revalidarse (touch) o descartarse (expire) antes de usarla.
+    """
+    with _lock:
+        entry = _entries.get((contRep, docId))
+        if entry is None:
+            _stats["misses"] += 1
+            return None, False
+        _entries.move_to_end((contRep, docId))
+        fresh = time.monotonic() - entry["checked_at"] < DOCUMENT_CACHE_TTL_SECONDS
+        if fresh:
+            _stats["hits"] += 1
+        return entry, fresh
+
+
+def touch(entry: dict) -> None:
+    """Marca la entrada como revalidada (el blob no ha cambiado)."""
+    with _lock:
+        entry["checked_at"] = time.monotonic()
+        _stats["hits"] += 1
+        _stats["revalidated"] += 1
+
+
+def store(contRep: str, docId: str, component: dict, properties, chunks) -> None:
+    """Guarda el blob cifrado ('chunks') del componente servido para el documento."""
+    writer = open_writer(contRep, docId, component, properties)
+    if writer is None:
+        return
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.commit()
+
+
+def open_writer(contRep: str, docId: str, component: dict, properties):
+    """
+    Devuelve un CacheWriter para guardar el blob mientras se descarga, o None si
+    no cabe en la caché.
+    """
+    if not is_cacheable(properties.size):
+        return None
+    return CacheWriter(contRep, docId, component, properties)
+
+
+class CacheWriter:
+    """
+    Entrada de la caché que se rellena bloque a bloque. Las entradas de disco se
+    escriben en su fichero según llegan, de modo que quien descarga no retiene el
+    blob cifrado; solo las de memoria (hasta DOCUMENT_CACHE_MEMORY_ITEM_BYTES) se
+    acumulan. commit() publica la entrada y discard() la descarta.
+    """
+
+    def __init__(self, contRep: str, docId: str, component: dict, properties):
+        size = properties.size
+        self.key = (contRep, docId)
+        self.entry = {
+            "component": component,
+            "etag": properties.etag,
+            "last_modified": getattr(properties, "last_modified", None),
+            "metadata": dict(properties.metadata or {}),
+            "size": size,
+            "data": None,
+            "path": None,
+            "tier": "memory" if size <= DOCUMENT_CACHE_MEMORY_ITEM_BYTES else "disk",
+            "checked_at": time.monotonic(),
+        }
+        self._chunks = []
+        self._file = None
+        self._failed = False
+        if self.entry["tier"] == "disk":
+            try:
+                os.makedirs(DOCUMENT_CACHE_DIR, exist_ok=True)
+                self.entry["path"] = os.path.join(DOCUMENT_CACHE_DIR, uuid.uuid4().hex)
+                self._file = open(self.entry["path"], "wb")
+            except OSError as e:
+                self._fail(e)
+
+    def write(self, chunk) -> None:
+        if self._failed:
+            return
+        if self._file is None:
+            self._chunks.append(chunk)
+            return
+        try:
+            self._file.write(chunk)
+        except OSError as e:
+            self._fail(e)
+
+    def commit(self) -> None:
+        if self._failed:
+            return
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError as e:
+                self._fail(e)
+                return
+            self._file = None
+        else:
+            self.entry["data"] = b"".join(self._chunks)
+            self._chunks = []
+        _publish(self.key, self.entry)
+
+    def discard(self) -> None:
+        self._chunks = []
+        self._close()
+        _remove_file(self.entry)
+
+    def _fail(self, error: OSError) -> None:
+        logger.warning(
+            "No se pudo guardar el documento %s en caché: %s", self.key[1], error
+        )
+        self._failed = True
+        self.discard()
+
+    def _close(self) -> None:
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+
+def _publish(key: tuple, entry: dict) -> None:
+    with _lock:
+        previous = _entries.pop(key, None)
+        if previous is not None:
+            _release(previous)
+        _entries[key] = entry
+        _usage[entry["tier"]] += entry["size"]
+        _stats["stored"] += 1
+        evicted = _evict(entry["tier"])
+    for old in evicted:
+        _remove_file(old)
+    if previous is not None:
+        _remove_file(previous)
+
+
+def expire(contRep: str, docId: str) -> None:
+    """Descarta una entrada cuya revalidación ha fallado (cuenta como fallo)."""
+    with _lock:
+        _stats["misses"] += 1
+    invalidate(contRep, docId)
+
+
+def invalidate(contRep: str, docId: str) -> None:
+    with _lock:
+        entry = _entries.pop((contRep, docId), None)
+        if entry is not None:
+            _release(entry)
+    if entry is not None:
+        _remove_file(entry)
+
+
+def clear() -> None:
+    with _lock:
+        entries = list(_entries.values())
+        _entries.clear()
+        _usage["memory"] = _usage["disk"] = 0
+    for entry in entries:
+        _remove_file(entry)
+
+
+def stats() -> dict:
+    """Contadores de aciertos/fallos y ocupación de la caché."""
+    with _lock:
+        return {
+            **_stats,
+            "entries": len(_entries),
+            "memory_bytes": _usage["memory"],
+            "disk_bytes": _usage["disk"],
+        }
+
+
+def _release(entry: dict) -> None:
+    _usage[entry["tier"]] -= entry["size"]
+
+
+def _evict(tier: str) -> list:
+    """Descarta las entradas menos usadas del nivel hasta respetar su límite."""
+    limit = DOCUMENT_CACHE_MEMORY_BYTES if tier == "memory" else DOCUMENT_CACHE_DISK_BYTES
+    evicted = []
+    for key in list(_entries):
+        if _usage[tier] <= limit:
+            break
+        entry = _entries[key]
+        if entry["tier"] == tier:
+            del _entries[key]
+            _release(entry)
+            _stats["evicted"] += 1
+            evicted.append(entry)
+    return evicted
+
+
+def _remove_file(entry: dict) -> None:
+    if entry["path"]:
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            # Puede seguir abierto por una petición en curso (Windows)
+            pass
+
+
+class CachedBlob:
+    """
+    Lectura de una entrada con la interfaz de BlobClient que usa el content server.
+    Las entradas en disco se abren con mmap al crearlo; hay que llamar a close().
+    """
+
+    def __init__(self, entry: dict):
+        self.entry = entry
+        self.blob_name = entry["component"]["blob_name"]
+        self.properties = SimpleNamespace(
+            size=entry["size"],
+            etag=entry["etag"],
+            last_modified=entry["last_modified"],
+            metadata=entry["metadata"],
+        )
+        self.data = entry["data"]
+        self._file = None
+        if self.data is None:
+            # Abrir ahora: si la entrada se descarta después, el fichero sigue
+            # siendo legible hasta cerrarlo
+            self._file = open(entry["path"], "rb")
+            try:
+                self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                self._file.close()
+                raise
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.data.close()
+            self._file.close()
+            self._file = None
+
+    def get_blob_properties(self, **kwargs):
+        return self.properties
+
+    def download_blob(self, offset: int = None, length: int = None, **kwargs):
+        start = offset or 0
+        end = self.entry["size"]
+        if length is not None:
+            end = min(start + length, end)
+        return _CachedDownload(self, start, end)
+
+
+class _CachedDownload:
+    def __init__(self, blob: CachedBlob, start: int, end: int):
+        self.blob = blob
+        self.start = start
+        self.end = end
+        self.size = end - start
+        self.properties = blob.properties
+
+    def readall(self) -> bytes:
+        return self.blob.data[self.start : self.end]
+
+    def chunks(self):
+        for offset in range(self.start, self.end, DOCUMENT_CACHE_READ_SIZE):
+            yield self.blob.data[offset : min(offset + DOCUMENT_CACHE_READ_SIZE, self.end)]
@@ -0,0 +1,1748 @@
+import io
+import os
+import logging
+import hashlib
+import time
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from azure.storage.blob import BlobBlock, BlobServiceClient
+from azure.functions import HttpRequest, HttpResponse
+from http.client import HTTPException
+import azure.functions as func
+
+from blob_utils import *
+from crypto_utils import *
+from compression_utils import *
+from replicated_blob import ReplicatedContainerClient
+from resilience_utils import CircuitOpenError, ensure_available
+from tracing_utils import span, traced_iter
+from .multipart import MultipartError, get_boundary, iter_multipart_files
+from . import doccache, unavailable_response
+
+# Comandos del content server que usan Blob Storage y cifrado. Se importa la
+# primera vez que se necesita (ver __init__.py), de modo que serverInfo no carga
+# el SDK de Azure ni cryptography.
+
+logger = logging.getLogger(__name__)
+
+
+def prewarm() -> None:
+    """Crea los clientes de Blob Storage e inicializa el backend de cifrado."""
+    prewarm_blob_clients()
+    b"".join(iter_encrypted_chunks([b"warmup"], os.urandom(32)))
+
+
+# Lecturas parciales (fromOffset/toOffset de ArchiveLink y cabecera HTTP Range).
+# Ambos formatos de cifrado permiten descifrar un rango sin leer el resto: en v1
+# (AES-CBC) cada bloque se descifra con el bloque cifrado anterior como IV y en
+# v2 cada trozo AES-GCM es independiente.
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def is_range_request(req: HttpRequest) -> bool:
+    return (
+        "fromOffset" in req.params
+        or "toOffset" in req.params
+        or bool(req.headers.get("Range"))
+    )
+
+
+def resolve_range(req: HttpRequest, total: int):
+    """
+    Traduce la petición a un rango inclusivo (inicio, fin) del texto plano.
+
+    Devuelve None si debe servirse el documento completo (p. ej. un Range con
+    varios intervalos) y lanza RangeNotSatisfiable si el rango queda fuera.
+    """
+    range_header = req.headers.get("Range")
+    if range_header:
+        unit, _, spec = range_header.partition("=")
+        if unit.strip() != "bytes" or "," in spec:
+            return None
+        first, _, last = spec.strip().partition("-")
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else total - 1
+            else:
+                # Rango sufijo: los últimos N bytes
+                start = max(total - int(last), 0)
+                end = total - 1
+        except ValueError:
+            return None
+    else:
+        try:
+            start = int(req.params.get("fromOffset", 0))
+            end = int(req.params.get("toOffset", -1))
+        except ValueError:
+            raise RangeNotSatisfiable("fromOffset/toOffset no válidos")
+        if end < 0:
+            end = total - 1
+
+    end = min(end, total - 1)
+    if start < 0 or start > end:
+        raise RangeNotSatisfiable(f"Rango no satisfacible para {total} bytes")
+    return start, end
+
+
+def download_span_name(blob_client) -> str:
+    """Nombre del span de descarga: la caché de documentos se distingue de Blob Storage."""
+    return "cache_read" if isinstance(blob_client, doccache.CachedBlob) else "download_blob"
+
+
+def download_range(blob_client, offset: int, length: int) -> bytes:
+    with span(download_span_name(blob_client), offset=offset) as attributes:
+        data = blob_client.download_blob(offset=offset, length=length).readall()
+        attributes["bytes"] = len(data)
+    return data
+
+
+def read_encryption_header(blob_client) -> bytes:
+    return download_range(blob_client, 0, 16)
+
+
+def get_plaintext_size(blob_client, ciphertext_size: int, metadata: dict, key: bytes) -> int:
+    """
+    Tamaño del documento descifrado. Se toma de los metadatos del blob o, si no
+    están, se calcula a partir de la cabecera (v2) o del relleno PKCS7 (v1).
+    """
+    if metadata and "plaintext_size" in metadata:
+        return int(metadata["plaintext_size"])
+    if is_appendable(metadata):
+        return appended_plaintext_size(blob_client, ciphertext_size)
+    header = read_encryption_header(blob_client)
+    if detect_format(header) == FORMAT_V2:
+        chunk_size, _ = parse_header_v2(header)
+        return plaintext_size_v2(ciphertext_size, chunk_size)
+    if detect_format(header) == FORMAT_V3:
+        return appended_plaintext_size(blob_client, ciphertext_size)
+    if ciphertext_size < 32 or ciphertext_size % 16:
+        raise ValueError("Tamaño de blob cifrado no válido")
+    tail = download_range(blob_client, ciphertext_size - 32, 32)
+    return plaintext_size_v1(tail, key, ciphertext_size)
+
+
+def decrypt_range(
+    blob_client, key: bytes, start: int, end: int, ciphertext_size: int, metadata: dict
+) -> bytes:
+    """Descarga y descifra solo los bloques que cubren los bytes [start, end]."""
+    codec = (metadata or {}).get("content_encoding")
+    if codec or is_appendable(metadata):
+        return stream_range(blob_client, key, start, end, codec)
+    is_v1 = (metadata or {}).get("encryption_format") == str(FORMAT_V1)
+    header = None if is_v1 else read_encryption_header(blob_client)
+    if header is not None and detect_format(header) == FORMAT_V3:
+        return stream_range(blob_client, key, start, end)
+    if header is not None and detect_format(header) == FORMAT_V2:
+        chunk_size, _ = parse_header_v2(header)
+        offset, length = range_request_v2(start, end, chunk_size)
+        data = download_range(blob_client, offset, min(length, ciphertext_size - offset))
+        with span("decrypt", bytes=end - start + 1):
+            return decrypt_range_v2(data, key, header, start, end, ciphertext_size)
+
+    offset, length = range_request_v1(start, end)
+    data = download_range(blob_client, offset, length)
+    with span("decrypt", bytes=end - start + 1):
+        return decrypt_range_v1(data, key, start, end)
+
+
+def stream_range(
+    blob_client, key: bytes, start: int, end: int, codec: str = None
+) -> bytes:
+    """
+    Rango de un documento comprimido o anexable: ni la compresión ni los segmentos
+    de v3 permiten calcular dónde empieza el rango, así que se descifra (y
+    descomprime) en flujo hasta el final del rango.
+    """
+    parts = []
+    position = 0
+    ciphertext = traced_iter(
+        download_span_name(blob_client), blob_client.download_blob().chunks()
+    )
+    plaintext = traced_iter("decrypt", iter_decrypted_chunks(ciphertext, key))
+    if codec:
+        plaintext = traced_iter("decompress", iter_decompressed_chunks(plaintext, codec))
+    for chunk in plaintext:
+        chunk_end = position + len(chunk)
+        if chunk_end > start:
+            parts.append(chunk[max(start - position, 0) : end + 1 - position])
+        position = chunk_end
+        if position > end:
+            break
+    return b"".join(parts)
+
+
+def is_appendable(metadata: dict) -> bool:
+    return (metadata or {}).get("encryption_format") == str(FORMAT_V3)
+
+
+def appended_plaintext_size(blob_client, ciphertext_size: int) -> int:
+    """Tamaño de un documento anexable (v3): lo indica el pie del último segmento."""
+    if ciphertext_size < TRAILER_SIZE_V3:
+        return 0
+    trailer = download_range(
+        blob_client, ciphertext_size - TRAILER_SIZE_V3, TRAILER_SIZE_V3
+    )
+    return parse_trailer_v3(trailer)[1]
+
+
+def handle_range_get(
+    req: HttpRequest, blob_client, docId: str, key: bytes, props=None
+) -> HttpResponse:
+    if props is None:
+        with span("blob_properties"):
+            props = blob_client.get_blob_properties()
+    # Los rangos se sirven siempre sin comprimir
+    validators = document_validators(props)
+    total = get_plaintext_size(blob_client, props.size, props.metadata, key)
+    try:
+        byte_range = resolve_range(req, total)
+    except RangeNotSatisfiable as e:
+        return func.HttpResponse(
+            str(e),
+            status_code=416,
+            headers={"Content-Range": f"bytes */{total}", **validators},
+        )
+
+    if byte_range is None:
+        start, end = 0, total - 1
+    else:
+        start, end = byte_range
+    content = (
+        decrypt_range(blob_client, key, start, end, props.size, props.metadata)
+        if total
+        else b""
+    )
+
+    with span("build_response", bytes=len(content)):
+        return range_response(req, docId, content, byte_range, total, validators)
+
+
+def range_response(
+    req: HttpRequest,
+    docId: str,
+    content: bytes,
+    byte_range,
+    total: int,
+    validators: dict = None,
+):
+    headers = {
+        "Content-Type": "application/pdf",
+        "Content-Disposition": f'attachment; filename="{docId}.pdf"',
+        "Content-Length": str(len(content)),
+        "Accept-Ranges": "bytes",
+        **(validators or {}),
+    }
+    # Con Range se responde 206; ArchiveLink (fromOffset/toOffset) espera 200
+    status_code = 200
+    if req.headers.get("Range") and byte_range is not None:
+        status_code = 206
+        headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{total}"
+    return func.HttpResponse(body=content, status_code=status_code, headers=headers)
+
+
+# Destinos desconocidos: se resuelven en memoria con la conexión por defecto y su
+# alta en la configuración se agrupa en una única escritura diferida por worker,
+# de modo que ninguna petición espera a una escritura.
+DEFAULT_CONNECTION_NAME = os.getenv("DEFAULT_CONNECTION_NAME", "defaultDestination")
+UNKNOWN_DESTINATION_TTL_SECONDS = float(
+    os.getenv("UNKNOWN_DESTINATION_TTL_SECONDS", "60")
+)
+DESTINATION_PROVISION_DELAY_SECONDS = float(
+    os.getenv("DESTINATION_PROVISION_DELAY_SECONDS", "2")
+)
+
+_unknown_destinations = {}
+_pending_destinations = set()
+_provision_lock = threading.Lock()
+_provision_timer = None
+
+
+def connection_names_of(destination) -> list:
+    # Los destinos se guardan como nombre de conexión o, si están replicados, como
+    # {"connections": [...], "write_quorum": n}; versiones anteriores guardaban
+    # {"connection_name": ...} al darlos de alta automáticamente
+    if isinstance(destination, dict):
+        if "connections" in destination:
+            return list(destination["connections"])
+        return [destination["connection_name"]]
+    return [destination]
+
+
+def connection_name_of(destination) -> str:
+    """Conexión principal del destino (la primera si está replicado)."""
+    return connection_names_of(destination)[0]
+
+
+def _flush_pending_destinations() -> None:
+    global _provision_timer
+    with _provision_lock:
+        pending = set(_pending_destinations)
+        _pending_destinations.clear()
+        _provision_timer = None
+    if not pending:
+        return
+    try:
+        create_config_entries(
+            "destinations", {contRep: DEFAULT_CONNECTION_NAME for contRep in pending}
+        )
+        with _provision_lock:
+            for contRep in pending:
+                _unknown_destinations.pop(contRep, None)
+        logger.info("Destinos dados de alta automáticamente: %s", sorted(pending))
+    except Exception as e:
+        # Se volverá a intentar cuando caduque la entrada negativa
+        logger.warning("No se pudieron dar de alta los destinos %s: %s", sorted(pending), e)
+
+
+def _schedule_destination_provisioning(contRep: str) -> None:
+    global _provision_timer
+    with _provision_lock:
+        _pending_destinations.add(contRep)
+        if _provision_timer is None:
+            _provision_timer = threading.Timer(
+                DESTINATION_PROVISION_DELAY_SECONDS, _flush_pending_destinations
+            )
+            _provision_timer.daemon = True
+            _provision_timer.start()
+
+
+def load_destination(contRep: str):
+    """
+    Destino del contRep tal como está guardado (ver connection_names_of). Si el
+    contRep no está configurado se usa DEFAULT_CONNECTION_NAME y su alta se
+    programa en segundo plano.
+    """
+    expires = _unknown_destinations.get(contRep)
+    if expires is None or expires < time.monotonic():
+        try:
+            with span("load_destination", contRep=contRep):
+                return get_config_entry("destinations", contRep)
+        except ConfigEntryNotFound:
+            with _provision_lock:
+                _unknown_destinations[contRep] = (
+                    time.monotonic() + UNKNOWN_DESTINATION_TTL_SECONDS
+                )
+            _schedule_destination_provisioning(contRep)
+    return DEFAULT_CONNECTION_NAME
+
+
+def get_destination(contRep: str) -> str:
+    """Nombre de la conexión (principal) asociada al contRep."""
+    return connection_name_of(load_destination(contRep))
+
+
+# Las subidas se envían en bloques de este tamaño; un fichero que cabe en un
+# solo bloque se sube con una única llamada.
+UPLOAD_BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE", str(4 * 1024 * 1024)))
+# Subidas simultáneas (bloques o ficheros pequeños) compartidas por el worker
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+# Bloques cifrados pendientes de subir por petición; acota la memoria usada
+UPLOAD_MAX_PENDING_BLOCKS = int(
+    os.getenv("UPLOAD_MAX_PENDING_BLOCKS", str(2 * UPLOAD_CONCURRENCY))
+)
+
+_upload_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="upload"
+)
+
+
+def _submit_upload(pending_slots, fn, *args, **kwargs):
+    """Encola una subida respetando el límite de bloques pendientes de la petición."""
+    pending_slots.acquire()
+    future = _upload_executor.submit(fn, *args, **kwargs)
+    future.add_done_callback(lambda _: pending_slots.release())
+    return future
+
+
+def new_upload(blob_client, content_type: str, compression: str = None) -> dict:
+    """Estado de la subida de un fichero (bloques, tiempos y metadatos)."""
+    return {
+        "blob_client": blob_client,
+        "content_type": content_type,
+        "compression": compression,
+        "content_encoding": None,
+        # Metadatos y condiciones adicionales del blob (p. ej. contenido deduplicado)
+        "base_metadata": {},
+        "conditions": {},
+        "block_prefix": "",
+        "started": time.perf_counter(),
+        "plaintext_size": 0,
+        "block_ids": [],
+        "futures": [],
+    }
+
+
+def next_block_id(upload: dict) -> str:
+    block_id = base64.b64encode(
+        f"{upload['block_prefix']}{len(upload['block_ids']):08d}".encode()
+    ).decode()
+    upload["block_ids"].append(block_id)
+    return block_id
+
+
+def iter_upload_blocks(upload: dict, chunks, key: bytes):
+    """
+    Cifra un fichero recibido por bloques y lo divide en bloques de UPLOAD_BLOCK_SIZE.
+    Si la conexión tiene compresión y la muestra inicial la justifica, el fichero
+    se comprime antes de cifrarse. Devuelve (datos, es_el_último); antes del
+    último bloque deja en 'upload' los metadatos del blob, que ya incluyen el
+    tamaño sin cifrar ni comprimir.
+    """
+
+    def counted(source):
+        for chunk in source:
+            upload["plaintext_size"] += len(chunk)
+            yield chunk
+
+    source = counted(traced_iter("parse_body", chunks))
+    if upload["compression"]:
+        sample, source = peek(source, COMPRESSION_SAMPLE_SIZE)
+        upload["content_encoding"] = choose_codec(
+            upload["compression"], sample, upload["content_type"]
+        )
+        if upload["content_encoding"]:
+            source = traced_iter(
+                "compress", iter_compressed_chunks(source, upload["content_encoding"])
+            )
+
+    block = bytearray()
+    previous = None
+    for encrypted in traced_iter("encrypt", iter_encrypted_chunks(source, key)):
+        block += encrypted
+        while len(block) >= UPLOAD_BLOCK_SIZE:
+            # Se retiene un bloque para poder marcar cuál es el último
+            if previous is not None:
+                yield previous, False
+            previous = bytes(block[:UPLOAD_BLOCK_SIZE])
+            del block[:UPLOAD_BLOCK_SIZE]
+
+    upload["metadata"] = {
+        **upload["base_metadata"],
+        "plaintext_size": str(upload["plaintext_size"]),
+        "encryption_format": str(ENCRYPTION_FORMAT),
+        "content_type": upload["content_type"],
+    }
+    if upload["content_encoding"]:
+        upload["metadata"]["content_encoding"] = upload["content_encoding"]
+    upload["encrypted"] = time.perf_counter()
+    if previous is not None and block:
+        yield previous, False
+        previous = None
+    yield (previous if previous is not None else bytes(block)), True
+
+
+def start_encrypted_upload(
+    blob_client,
+    chunks,
+    key: bytes,
+    pending_slots,
+    content_type: str,
+    compression: str = None,
+) -> dict:
+    """
+    Cifra un fichero recibido por bloques y encola la subida de cada bloque cifrado,
+    sin esperar a que termine. Devuelve el estado de la subida, que se completa
+    con finish_encrypted_upload.
+    """
+    upload = new_upload(blob_client, content_type, compression)
+    try:
+        submit_upload_blocks(upload, chunks, key, pending_slots)
+    except BaseException:
+        abort_uploads([upload])
+        raise
+    return upload
+
+
+def submit_upload_blocks(upload: dict, chunks, key: bytes, pending_slots) -> None:
+    """Cifra el fichero y encola la subida de sus bloques (ver start_encrypted_upload)."""
+    blob_client = upload["blob_client"]
+    for data, last in iter_upload_blocks(upload, chunks, key):
+        if last and not upload["block_ids"]:
+            # El fichero cabe en un bloque: una única llamada con los metadatos
+            future = _submit_upload(
+                pending_slots,
+                blob_client.upload_blob,
+                data,
+                overwrite=True,
+                metadata=upload["metadata"],
+                **upload["conditions"],
+            )
+        else:
+            future = _submit_upload(
+                pending_slots, blob_client.stage_block, next_block_id(upload), data
+            )
+        upload["futures"].append(future)
+
+
+def finish_encrypted_upload(upload: dict) -> None:
+    """Espera a los bloques del fichero y, si se subió por bloques, confirma la lista."""
+    for future in upload["futures"]:
+        future.result()
+    if upload["block_ids"]:
+        upload["blob_client"].commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in upload["block_ids"]],
+            metadata=upload["metadata"],
+            **upload["conditions"],
+        )
+    upload["finished"] = time.perf_counter()
+
+
+# Deduplicación por contenido (conexiones con "dedup": true). Cada contenido se
+# guarda cifrado una sola vez en '_content/{sha256}', con una clave derivada del
+# hash y un contador de referencias en sus metadatos; los componentes del
+# documento lo referencian desde el índice. Subir un contenido ya existente solo
+# actualiza ese contador.
+CONTENT_PREFIX = "_content"
+
+
+def content_blob_name(digest: str) -> str:
+    return f"{CONTENT_PREFIX}/{digest}"
+
+
+def hash_multipart_files(body: bytes, boundary: bytes) -> list:
+    """SHA-256 (hex) del contenido de cada fichero del cuerpo multipart, en orden."""
+    digests = []
+    for _, _, chunks in iter_multipart_files(body, boundary):
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            digest.update(chunk)
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def add_content_reference(blob_client):
+    """Suma una referencia al contenido; devuelve sus metadatos o None si no existe."""
+
+    def increment(metadata):
+        metadata["refcount"] = str(int(metadata.get("refcount", "1")) + 1)
+        return metadata
+
+    try:
+        return update_blob_metadata(blob_client, increment)
+    except ResourceNotFoundError:
+        return None
+
+
+def release_content_reference(blob_client) -> None:
+    """Resta una referencia al contenido y lo borra al llegar a cero."""
+
+    def decrement(metadata):
+        refcount = int(metadata.get("refcount", "1")) - 1
+        if refcount <= 0:
+            return None
+        metadata["refcount"] = str(refcount)
+        return metadata
+
+    try:
+        update_blob_metadata(blob_client, decrement)
+    except ResourceNotFoundError:
+        logger.warning("Contenido '%s' ya eliminado", blob_client.blob_name)
+
+
+def start_dedup_upload(
+    container_client,
+    chunks,
+    digest: str,
+    pending_slots,
+    content_type: str,
+    compression: str = None,
+) -> dict:
+    """
+    Sube un fichero deduplicado. Si el contenido ya existe solo se suma una
+    referencia; si no, se cifra con la clave del contenido y se crea su blob
+    (con If-None-Match, por si otra petición lo está subiendo a la vez).
+    """
+    blob_client = container_client.get_blob_client(content_blob_name(digest))
+    upload = new_upload(blob_client, content_type, compression)
+    upload["content_address"] = digest
+    metadata = add_content_reference(blob_client)
+    if metadata is not None:
+        mark_deduplicated(upload, metadata)
+        return upload
+
+    upload["base_metadata"] = {"refcount": "1", "content_sha256": digest}
+    upload["conditions"] = {"match_condition": MatchConditions.IfMissing}
+    # Identificadores de bloque únicos: otra subida del mismo contenido puede
+    # estar preparando bloques en el mismo blob
+    upload["block_prefix"] = os.urandom(8).hex()
+    try:
+        submit_upload_blocks(
+            upload, chunks, derive_key_from_content(digest), pending_slots
+        )
+    except BaseException:
+        abort_uploads([upload])
+        raise
+    return upload
+
+
+def mark_deduplicated(upload: dict, metadata: dict) -> None:
+    upload["deduplicated"] = True
+    # El tipo de contenido es el de esta subida, no el de la que creó el contenido
+    upload["metadata"] = {**metadata, "content_type": upload["content_type"]}
+    upload["plaintext_size"] = int(metadata.get("plaintext_size", 0))
+    upload["content_encoding"] = metadata.get("content_encoding")
+    upload["encrypted"] = time.perf_counter()
+
+
+def finish_dedup_upload(upload: dict) -> None:
+    """Completa una subida deduplicada; si otra petición creó antes el contenido, se referencia."""
+    try:
+        finish_encrypted_upload(upload)
+    except (ResourceExistsError, ResourceModifiedError):
+        # El If-None-Match de la creación falla con 412 (ResourceModifiedError)
+        metadata = add_content_reference(upload["blob_client"])
+        if metadata is None:
+            raise
+        mark_deduplicated(upload, metadata)
+        upload["finished"] = time.perf_counter()
+
+
+def abort_uploads(uploads, commits=()) -> None:
+    """
+    Deshace lo posible de las subidas de una petición que ha fallado: descarta
+    los bloques aún encolados, espera a los que están en curso (y a las
+    confirmaciones en 'commits') y libera las referencias a contenidos
+    deduplicados que ya se habían sumado. Los bloques preparados y nunca
+    confirmados los descarta Blob Storage pasados 7 días.
+    """
+    uploads = list(uploads)
+    for upload in uploads:
+        for future in upload["futures"]:
+            future.cancel()
+    wait([*commits, *(f for upload in uploads for f in upload["futures"])])
+    for upload in uploads:
+        if upload.get("content_address") and (
+            upload.get("deduplicated") or "finished" in upload
+        ):
+            try:
+                release_content_reference(upload["blob_client"])
+            except Exception as e:
+                logger.warning(
+                    "No se pudo liberar el contenido '%s': %s",
+                    upload["blob_client"].blob_name,
+                    e,
+                )
+
+
+def component_key(docId: str, component: dict) -> bytes:
+    """Clave de cifrado de un componente: la del contenido si está deduplicado."""
+    if component.get("content_address"):
+        return derive_key_from_content(component["content_address"])
+    return derive_key_from_docId(docId)
+
+
+def release_document_contents(container_client, index: dict) -> None:
+    """Libera las referencias a contenidos deduplicados de un índice."""
+    for component in index["components"]:
+        if component.get("content_address"):
+            release_content_reference(
+                container_client.get_blob_client(component["blob_name"])
+            )
+
+
+# Índice docId -> blobs. Se guarda fuera del prefijo del contRep para que no
+# aparezca en los listados del repositorio.
+INDEX_PREFIX = "_index"
+
+
+def index_blob_name(contRep: str, docId: str) -> str:
+    return f"{INDEX_PREFIX}/{contRep}/{docId}.json"
+
+
+def build_document_index(docId: str, files: list, created: str = None) -> dict:
+    """
+    Índice del documento: fecha de creación y, por componente, su blob, tamaño sin
+    cifrar, tipo de contenido, compresión y, si está deduplicado, su contenido. Basta con leerlo para responder a 'info'.
+    """
+    return {
+        "docId": docId,
+        "created": created or datetime.now(timezone.utc).isoformat(),
+        "components": [
+            {
+                "filename": f["filename"],
+                "blob_name": f["blob_name"],
+                "size": f.get("size"),
+                "content_type": f.get("content_type"),
+                "content_encoding": f.get("content_encoding"),
+                "content_address": f.get("content_address"),
+            }
+            for f in files
+        ],
+    }
+
+
+def write_document_index(
+    container_client,
+    contRep: str,
+    docId: str,
+    files: list,
+    created: str = None,
+    required: bool = False,
+    etag: str = None,
+):
+    """
+    Guarda el índice del documento (ver build_document_index). Con 'required'
+    un fallo se propaga; si no, solo se registra. Con 'etag' solo se escribe si
+    el índice no ha cambiado (If-Match).
+    """
+    index = build_document_index(docId, files, created)
+    conditions = (
+        {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag else {}
+    )
+    try:
+        content = json.dumps(index)
+        with span("write_index", bytes=len(content)):
+            container_client.get_blob_client(
+                index_blob_name(contRep, docId)
+            ).upload_blob(content, overwrite=True, **conditions)
+    except Exception as e:
+        if required:
+            logger.error("No se pudo escribir el índice del documento %s: %s", docId, e)
+            raise
+        # Sin índice el documento sigue siendo accesible mediante el listado
+        logger.warning("No se pudo escribir el índice del documento %s: %s", docId, e)
+
+
+def index_required(files: list) -> bool:
+    """
+    Los componentes deduplicados solo se encuentran a través del índice (el
+    listado por '{contRep}/{docId}_' no llega a '_content/'), así que sin él el
+    documento se pierde.
+    """
+    return any(f.get("content_address") for f in files)
+
+
+def read_document_index(container_client, contRep: str, docId: str):
+    """Devuelve el índice del documento o None si no existe."""
+    return load_document_index(container_client, contRep, docId)[0]
+
+
+def load_document_index(container_client, contRep: str, docId: str) -> tuple:
+    """Devuelve (índice, ETag) del documento o (None, None) si no existe."""
+    with span("read_index") as attributes:
+        try:
+            download = container_client.get_blob_client(
+                index_blob_name(contRep, docId)
+            ).download_blob()
+            content = download.readall()
+        except ResourceNotFoundError:
+            attributes["found"] = False
+            return None, None
+        attributes["bytes"] = len(content)
+    return json.loads(content), download.properties.etag
+
+
+def find_document_components(container_client, contRep: str, docId: str) -> list:
+    """
+    Devuelve los componentes del documento (al menos 'filename' y 'blob_name').
+
+    Primero se lee el índice del documento; si no existe (documentos anteriores al
+    índice) se listan los blobs con el prefijo '{contRep}/{docId}_' y se crea el índice.
+    """
+    index = read_document_index(container_client, contRep, docId)
+    if index is not None:
+        return index["components"]
+
+    prefix = f"{contRep}/{docId}_"
+    with span("list_blobs") as attributes:
+        components = [
+            {"filename": blob.name[len(prefix) :], "blob_name": blob.name}
+            for blob in container_client.list_blobs(name_starts_with=prefix)
+        ]
+        attributes["blobs"] = len(components)
+    if components:
+        write_document_index(container_client, contRep, docId, components)
+    return components
+
+
+def get_document_info(container_client, contRep: str, docId: str):
+    """
+    Información del documento (creación, tamaño sin cifrar, componentes y tipo de
+    contenido) o None si no existe. Con un índice completo basta una lectura; para
+    documentos antiguos se consultan las propiedades de cada blob.
+    """
+    index = read_document_index(container_client, contRep, docId)
+    if index is None or "created" not in index:
+        found = find_document_components(container_client, contRep, docId)
+        if not found:
+            return None
+        components = []
+        created = None
+        for component in found:
+            blob_name = component["blob_name"]
+            blob_client = container_client.get_blob_client(blob_name)
+            with span("blob_properties"):
+                props = blob_client.get_blob_properties()
+            components.append(
+                {
+                    "filename": component["filename"],
+                    "blob_name": blob_name,
+                    "size": get_plaintext_size(
+                        blob_client,
+                        props.size,
+                        props.metadata,
+                        component_key(docId, component),
+                    ),
+                    "content_type": props.metadata.get("content_type"),
+                    "content_encoding": props.metadata.get("content_encoding"),
+                    "content_address": component.get("content_address"),
+                }
+            )
+            created = created or props.last_modified.isoformat()
+        index = {"docId": docId, "created": created, "components": components}
+        # Completar el índice para que las próximas consultas sean de una sola lectura
+        write_document_index(container_client, contRep, docId, components, created)
+
+    return document_info_from_index(contRep, docId, index)
+
+
+def document_info_from_index(contRep: str, docId: str, index: dict) -> dict:
+    size = sum(c["size"] or 0 for c in index["components"])
+    return {
+        "contRep": contRep,
+        "docId": docId,
+        "status": "active",
+        "file_size": f"{size / 1024} KB",
+        "size": size,
+        "created": index["created"],
+        "last_modified": index["created"],
+        "content_type": index["components"][0].get("content_type"),
+        "components": index["components"],
+    }
+
+
+def resolve_destination(contRep: str) -> tuple:
+    """
+    Resuelve destino y conexiones del contRep y devuelve (ContainerClient,
+    conexión principal). Si el destino lista varias conexiones, el cliente replica
+    las escrituras y reparte las lecturas entre ellas (ver replicated_blob.py).
+    Lanza CircuitOpenError si todas tienen el disyuntor abierto.
+    """
+    destination = load_destination(contRep)
+    replicas = []
+    for connection_name in connection_names_of(destination):
+        connection_info = get_connection(connection_name)
+        cloud_type = connection_info["cloud"]
+        if cloud_type not in STORAGE_CLOUDS:
+            raise ValueError(f"Tipo de nube no soportado: {cloud_type}")
+        replicas.append((connection_name, connection_info))
+    ensure_available([connection_name for connection_name, _ in replicas])
+
+    primary_info = replicas[0][1]
+    clients = [
+        (connection_name, get_container_client_for_connection(connection_name, connection_info))
+        for connection_name, connection_info in replicas
+    ]
+    if len(clients) == 1:
+        return clients[0][1], primary_info
+    return (
+        ReplicatedContainerClient(clients, destination.get("write_quorum")),
+        primary_info,
+    )
+
+
+def get_container_for_contRep(contRep: str):
+    """Resuelve destino y conexiones del contRep y devuelve su ContainerClient."""
+    return resolve_destination(contRep)[0]
+
+
+# Consultas de información en lote (comando 'batchInfo')
+INFO_CONCURRENCY = int(os.getenv("INFO_CONCURRENCY", "16"))
+BATCH_INFO_MAX_DOCIDS = int(os.getenv("BATCH_INFO_MAX_DOCIDS", "5000"))
+
+_info_executor = ThreadPoolExecutor(
+    max_workers=INFO_CONCURRENCY, thread_name_prefix="info"
+)
+
+
+def handle_batch_info(req: HttpRequest) -> HttpResponse:
+    """
+    Devuelve la información de varios documentos de un contRep en una sola petición.
+    Los docId llegan en el parámetro 'docIds' (separados por comas) o, por POST,
+    en un cuerpo JSON {"docIds": [...]}.
+    """
+    contRep = req.params.get("contRep")
+    if req.method == "POST":
+        try:
+            doc_ids = req.get_json().get("docIds") or []
+        except ValueError:
+            return HttpResponse("Cuerpo JSON no válido", status_code=400)
+    else:
+        doc_ids = [d for d in req.params.get("docIds", "").split(",") if d]
+
+    if not contRep or not doc_ids:
+        return HttpResponse(
+            "Faltan parámetros requeridos para 'batchInfo'", status_code=400
+        )
+    if len(doc_ids) > BATCH_INFO_MAX_DOCIDS:
+        return HttpResponse(
+            f"Se admiten como máximo {BATCH_INFO_MAX_DOCIDS} docIds por petición",
+            status_code=400,
+        )
+
+    try:
+        container_client = get_container_for_contRep(contRep)
+    except ValueError as e:
+        logger.error(str(e))
+        return HttpResponse(str(e), status_code=400)
+
+    def lookup(docId):
+        try:
+            return get_document_info(container_client, contRep, docId) or {
+                "docId": docId,
+                "status": "not_found",
+            }
+        except Exception as e:
+            logger.error("Error al recuperar información del documento %s: %s", docId, e)
+            return {"docId": docId, "status": "error", "error": str(e)}
+
+    # Las consultas corren en otros hilos, sin la traza de la petición
+    with span("batch_lookup", documents=len(doc_ids)):
+        documents = list(_info_executor.map(lookup, doc_ids))
+    return func.HttpResponse(
+        body=json.dumps(
+            {
+                "message": "Información de los documentos recuperada",
+                "command": "batchInfo",
+                "contRep": contRep,
+                "documents": documents,
+            }
+        ),
+        mimetype="application/json",
+        status_code=200,
+    )
+
+
+def dispatch_request(req: HttpRequest, command: str) -> HttpResponse:
+    method = req.method
+
+    # Si no hay un command, devuelve un error
+    if not command:
+        return HttpResponse("Command not found in URL query", status_code=400)
+
+    # Procesa según el método HTTP
+    if command == "batchInfo" and method in ("GET", "POST"):
+        return handle_batch_info(req)
+    if command == "append" and method in ("PUT", "POST"):
+        return handle_append(req)
+    if method == "GET":
+        return handle_get(req, command)
+    elif method == "POST":
+        return handle_post(req, command)
+    elif method == "DELETE":
+        return handle_delete(req, command)
+    else:
+        return HttpResponse("Método no permitido", status_code=405)
+
+
+# Procesamiento del método GET
+def handle_get(req: HttpRequest, command: str) -> HttpResponse:
+    contRep = req.params.get("contRep")
+    docId = req.params.get("docId")
+
+    if not contRep or not docId:
+        return HttpResponse("Faltan parámetros requeridos para 'get'", status_code=400)
+
+    try:
+        container_client = get_container_for_contRep(contRep)
+    except ValueError as e:
+        logger.error(str(e))
+        return HttpResponse(str(e), status_code=400)
+
+    if command == "get":
+        try:
+            cached_blob = get_cached_blob(container_client, contRep, docId)
+            if cached_blob is not None:
+                try:
+                    return serve_document(
+                        req, docId, cached_blob.entry["component"], cached_blob
+                    )
+                finally:
+                    cached_blob.close()
+
+            components = find_document_components(container_client, contRep, docId)
+
+            if components:
+                blob_client = container_client.get_blob_client(
+                    components[0]["blob_name"]
+                )
+                return serve_document(
+                    req, docId, components[0], blob_client, cache_as=(contRep, docId)
+                )
+
+            else:
+                logger.error("Documento %s no encontrado en Azure Blob Storage.", docId)
+                return func.HttpResponse(
+                    f"Documento con docId '{docId}' no encontrado en Azure Blob Storage.",
+                    status_code=404,
+                )
+
+        except CircuitOpenError as e:
+            return unavailable_response(e)
+        except Exception as e:
+            logger.error("Error al recuperar el documento de Azure Blob Storage: %s", e)
+            return HttpResponse(
+                f"Error al recuperar el documento: {str(e)}", status_code=500
+            )
+
+    # Manejo del comando 'info'
+    elif command == "info":
+        try:
+            info = get_document_info(container_client, contRep, docId)
+            if info:
+                return info_response(command, info, req)
+
+            else:
+                return HttpResponse(
+                    f"Documento con docId '{docId}' no encontrado en Azure Blob Storage.",
+                    status_code=404,
+                )
+
+        except CircuitOpenError as e:
+            return unavailable_response(e)
+        except Exception as e:
+            logger.error("Error al recuperar información del documento: %s", e)
+            return HttpResponse(
+                f"Error al recuperar información del documento: {str(e)}",
+                status_code=500,
+            )
+
+    else:
+        return HttpResponse("Comando no reconocido", status_code=400)
+
+
+def get_cached_blob(container_client, contRep: str, docId: str):
+    """
+    Devuelve el documento de la caché (doccache.CachedBlob) o None. Pasado el
+    TTL de la entrada se comprueba que el índice sigue apuntando al mismo blob y
+    que su ETag no ha cambiado.
+    """
+    entry, fresh = doccache.lookup(contRep, docId)
+    if entry is None:
+        return None
+    if not fresh:
+        blob_name = entry["component"]["blob_name"]
+        components = find_document_components(container_client, contRep, docId)
+        etag = None
+        if components and components[0]["blob_name"] == blob_name:
+            try:
+                with span("blob_properties"):
+                    etag = (
+                        container_client.get_blob_client(blob_name)
+                        .get_blob_properties()
+                        .etag
+                    )
+            except ResourceNotFoundError:
+                pass
+        if etag != entry["etag"]:
+            doccache.expire(contRep, docId)
+            return None
+        doccache.touch(entry)
+    try:
+        return doccache.CachedBlob(entry)
+    except (OSError, ValueError) as e:
+        logger.warning("Entrada de caché no legible para %s: %s", docId, e)
+        doccache.expire(contRep, docId)
+        return None
+
+
+def join_chunks(chunks) -> bytes:
+    """
+    Une los bloques en un único bytes. b"".join con un generador retiene antes
+    todos los bloques, y el documento ocuparía el doble.
+    """
+    buffer = io.BytesIO()
+    for chunk in chunks:
+        buffer.write(chunk)
+    return buffer.getvalue()
+
+
+def serve_document(
+    req: HttpRequest, docId: str, component: dict, blob_client, cache_as=None
+) -> HttpResponse:
+    """
+    Respuesta de 'get' para un componente. 'blob_client' puede ser el blob o su
+    copia en caché; con cache_as=(contRep, docId) el blob descargado se guarda en
+    la caché de documentos.
+    """
+    encryption_key = component_key(docId, component)
+
+    # Peticiones condicionales: basta con las propiedades del blob (o de la
+    # entrada en caché) para responder 304, sin descargar ni descifrar
+    props = None
+    if is_conditional_request(req) or is_range_request(req):
+        with span("blob_properties"):
+            props = blob_client.get_blob_properties()
+    if is_conditional_request(req):
+        codec = (props.metadata or {}).get("content_encoding")
+        passthrough = not is_range_request(req) and accepts_encoding(
+            req.headers.get("Accept-Encoding"), codec
+        )
+        validators = document_validators(props, passthrough)
+        if is_not_modified(req, validators):
+            return not_modified_response(validators)
+
+    if is_range_request(req):
+        return handle_range_get(req, blob_client, docId, encryption_key, props)
+
+    download_span = download_span_name(blob_client)
+    with span(download_span) as attributes:
+        download_stream = blob_client.download_blob()
+        attributes["size"] = download_stream.size
+
+    logger.debug("Blob cifrado de %s: %d bytes", docId, download_stream.size)
+
+    # Un documento comprimido se entrega tal cual si el cliente admite el códec;
+    # si no, se descomprime al descifrar
+    codec = (download_stream.properties.metadata or {}).get("content_encoding")
+    passthrough = accepts_encoding(req.headers.get("Accept-Encoding"), codec)
+
+    # El blob cifrado pasa a la caché según se descarga (ver doccache.CacheWriter)
+    cache = None
+    if cache_as is not None:
+        cache = doccache.open_writer(
+            *cache_as, component, download_stream.properties
+        )
+
+    def downloaded(chunks):
+        for chunk in chunks:
+            if cache is not None:
+                cache.write(chunk)
+            yield chunk
+
+    # Desencriptar el contenido por bloques, sin cargar el blob cifrado completo.
+    # La respuesta de Azure Functions necesita el cuerpo entero, pero solo se
+    # retiene el documento en claro
+    try:
+        plaintext = traced_iter(
+            "decrypt",
+            iter_decrypted_chunks(
+                traced_iter(download_span, downloaded(download_stream.chunks())),
+                encryption_key,
+            ),
+        )
+        if codec and not passthrough:
+            plaintext = traced_iter(
+                "decompress", iter_decompressed_chunks(plaintext, codec)
+            )
+        decrypted_content = join_chunks(plaintext)
+        logger.debug("Documento %s descifrado: %d bytes", docId, len(decrypted_content))
+    except CircuitOpenError as e:
+        if cache is not None:
+            cache.discard()
+        return unavailable_response(e)
+    except Exception as e:
+        if cache is not None:
+            cache.discard()
+        logger.error("Error al desencriptar el documento %s: %s", docId, e)
+        return func.HttpResponse(
+            f"Error al desencriptar el documento: {str(e)}", status_code=500
+        )
+
+    if cache is not None:
+        with span("cache_store", bytes=download_stream.size):
+            cache.commit()
+
+    # Configurar la respuesta con el contenido desencriptado
+    with span("build_response", bytes=len(decrypted_content)):
+        return document_response(
+            docId,
+            decrypted_content,
+            content_encoding=codec if passthrough else None,
+            compressed=bool(codec),
+            validators=document_validators(download_stream.properties, passthrough),
+        )
+
+
+# Validación de las respuestas de 'get' e 'info' (ETag, Last-Modified) para que
+# clientes y proxies puedan guardarlas y revalidarlas con If-None-Match /
+# If-Modified-Since. DOCUMENT_CACHE_CONTROL admite, por ejemplo,
+# "private, max-age=86400" si los documentos no se reemplazan.
+DOCUMENT_CACHE_CONTROL = os.getenv("DOCUMENT_CACHE_CONTROL", "no-cache")
+
+
+def is_conditional_request(req: HttpRequest) -> bool:
+    return bool(req.headers.get("If-None-Match") or req.headers.get("If-Modified-Since"))
+
+
+def document_validators(properties, passthrough: bool = False) -> dict:
+    """
+    Cabeceras de validación de un documento a partir de las propiedades del blob.
+    El ETag es fuerte: el del blob, con el códec si se entrega comprimido.
+    """
+    codec = (properties.metadata or {}).get("content_encoding")
+    tag = properties.etag.strip('"')
+    if codec and passthrough:
+        tag = f"{tag}-{codec}"
+    headers = {"ETag": f'"{tag}"', "Cache-Control": DOCUMENT_CACHE_CONTROL}
+    last_modified = getattr(properties, "last_modified", None)
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(
+            last_modified.astimezone(timezone.utc), usegmt=True
+        )
+    if codec:
+        headers["Vary"] = "Accept-Encoding"
+    return headers
+
+
+def is_not_modified(req: HttpRequest, validators: dict) -> bool:
+    """
+    Evalúa If-None-Match (comparación débil) o, si no lo hay, If-Modified-Since
+    frente a las cabeceras de validación de la respuesta.
+    """
+    if_none_match = req.headers.get("If-None-Match")
+    if if_none_match:
+        etag = validators["ETag"]
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag.removeprefix("W/") == etag:
+                return True
+        return False
+    if_modified_since = req.headers.get("If-Modified-Since")
+    last_modified = validators.get("Last-Modified")
+    if not if_modified_since or not last_modified:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(
+            if_modified_since
+        )
+    except (TypeError, ValueError):
+        return False
+
+
+def not_modified_response(validators: dict) -> HttpResponse:
+    return func.HttpResponse(status_code=304, headers=validators)
+
+
+def document_response(
+    docId: str,
+    content: bytes,
+    content_encoding: str = None,
+    compressed: bool = False,
+    validators: dict = None,
+) -> HttpResponse:
+    headers = {
+        "Content-Type": "application/pdf",
+        "Content-Disposition": f'attachment; filename="{docId}.pdf"',
+        "Content-Length": str(len(content)),  # Asegura el tamaño del contenido
+        "Accept-Ranges": "bytes",
+        **(validators or {}),
+    }
+    if content_encoding:
+        headers["Content-Encoding"] = HTTP_ENCODINGS[content_encoding]
+    if compressed:
+        # La respuesta depende de Accept-Encoding para los documentos comprimidos
+        headers["Vary"] = "Accept-Encoding"
+    return func.HttpResponse(
+        body=content,  # Utiliza el contenido desencriptado
+        status_code=200,
+        headers=headers,
+    )
+
+
+def info_response(command: str, info: dict, req: HttpRequest = None) -> HttpResponse:
+    body = json.dumps(
+        {
+            "message": "Información del documento recuperada",
+            "command": command,
+            **info,
+        }
+    )
+    # La información sale del índice y puede cambiar sin que cambie la fecha
+    # de creación: solo ETag (del propio cuerpo), sin Last-Modified
+    validators = {
+        "ETag": f'"{hashlib.sha256(body.encode()).hexdigest()[:32]}"',
+        "Cache-Control": DOCUMENT_CACHE_CONTROL,
+    }
+    if req is not None and is_not_modified(req, validators):
+        return not_modified_response(validators)
+    return func.HttpResponse(body=body, status_code=200, headers=validators)
+
+
+# Procesamiento del método DELETE (comando 'delete')
+def handle_delete(req: HttpRequest, command: str) -> HttpResponse:
+    contRep = req.params.get("contRep")
+    docId = req.params.get("docId")
+
+    if command != "delete":
+        return HttpResponse("Comando no reconocido", status_code=400)
+    if not contRep or not docId:
+        return HttpResponse(
+            "Faltan parámetros requeridos para 'delete'", status_code=400
+        )
+
+    try:
+        container_client = get_container_for_contRep(contRep)
+    except ValueError as e:
+        logger.error(str(e))
+        return HttpResponse(str(e), status_code=400)
+
+    try:
+        components = find_document_components(container_client, contRep, docId)
+        if not components:
+            return HttpResponse(
+                f"Documento con docId '{docId}' no encontrado en Azure Blob Storage.",
+                status_code=404,
+            )
+        doccache.invalidate(contRep, docId)
+        # Primero el índice: si algo falla después quedan contenidos sin
+        # referenciar, pero nunca se libera dos veces la misma referencia
+        try:
+            container_client.get_blob_client(
+                index_blob_name(contRep, docId)
+            ).delete_blob()
+        except ResourceNotFoundError:
+            pass
+        for component in components:
+            blob_client = container_client.get_blob_client(component["blob_name"])
+            if component.get("content_address"):
+                release_content_reference(blob_client)
+            else:
+                try:
+                    blob_client.delete_blob()
+                except ResourceNotFoundError:
+                    pass
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    except Exception as e:
+        logger.error("Error al eliminar el documento %s: %s", docId, e)
+        return HttpResponse(
+            f"Error al eliminar el documento: {str(e)}", status_code=500
+        )
+
+    return HttpResponse(f"Documento '{docId}' eliminado", status_code=200)
+
+
+# Comando 'append' (ArchiveLink): añade datos al final de un componente, p. ej.
+# listas de impresión o logs que crecen con el tiempo. El componente se guarda
+# como Append Blob cifrado en formato v3 y cada append escribe solo segmentos
+# nuevos, sin leer ni volver a cifrar los datos anteriores. Un componente creado
+# con 'create' se copia a un Append Blob la primera vez que se le añaden datos.
+# Con deduplicación, los componentes anexables no se deduplican.
+APPEND_BLOCK_SIZE = int(os.getenv("APPEND_BLOCK_SIZE", str(4 * 1024 * 1024)))
+# Reintentos cuando otro append se adelanta en el mismo componente
+APPEND_RETRIES = int(os.getenv("APPEND_RETRIES", "3"))
+APPEND_POSITION_CONDITION_NOT_MET = "AppendPositionConditionNotMet"
+
+
+def appendable_metadata(content_type: str) -> dict:
+    return {"encryption_format": str(FORMAT_V3), "content_type": content_type}
+
+
+def iter_append_pieces(chunks, length: int):
+    """
+    Reagrupa los bloques en trozos de 'length' bytes. Devuelve al menos uno,
+    vacío si no hay datos.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) > length:
+            yield bytes(buffer[:length])
+            del buffer[:length]
+    yield bytes(buffer)
+
+
+def append_encrypted(blob_client, chunks, key: bytes, ciphertext_size: int = None):
+    """
+    Añade cifrados al final del Append Blob los bloques de 'chunks' y devuelve el
+    tamaño del documento. Cada segmento cabe en un bloque (APPEND_BLOCK_SIZE) y
+    se escribe con un único append_block condicionado a la posición esperada: si
+    falla a mitad, el documento sigue siendo válido con parte de los datos.
+    """
+    segment_length = max_segment_length_v3(APPEND_BLOCK_SIZE)
+    plaintext_size = None
+    conflicts = 0
+    for piece in iter_append_pieces(chunks, segment_length):
+        while True:
+            if ciphertext_size is None:
+                with span("blob_properties"):
+                    ciphertext_size = blob_client.get_blob_properties().size
+            if plaintext_size is None:
+                plaintext_size = appended_plaintext_size(blob_client, ciphertext_size)
+            segment = encrypt_segment_v3(piece, key, plaintext_size)
+            try:
+                with span("append_block", bytes=len(segment)):
+                    blob_client.append_block(segment, appendpos_condition=ciphertext_size)
+            except HttpResponseError as e:
+                if (
+                    getattr(e, "error_code", None) != APPEND_POSITION_CONDITION_NOT_MET
+                    or conflicts >= APPEND_RETRIES
+                ):
+                    raise
+                # Otro append se adelantó: se continúa desde el nuevo final
+                conflicts += 1
+                ciphertext_size = plaintext_size = None
+                continue
+            ciphertext_size += len(segment)
+            plaintext_size += len(piece)
+            break
+    return plaintext_size
+
+
+def convert_to_appendable(container_client, docId: str, component: dict, blob_name: str) -> str:
+    """
+    Copia un componente creado con 'create' (v1/v2, quizá comprimido o
+    deduplicado) a un Append Blob nuevo junto a 'blob_name' y devuelve su nombre.
+    Se descifra y vuelve a cifrar por segmentos, sin leer el documento entero. El
+    original no se modifica: el llamador apunta el índice a la copia y después
+    lo libera (release_converted_source).
+    """
+    source = container_client.get_blob_client(component["blob_name"])
+    download = source.download_blob()
+    metadata = download.properties.metadata or {}
+    plaintext = iter_decrypted_chunks(
+        download.chunks(), component_key(docId, component)
+    )
+    if metadata.get("content_encoding"):
+        plaintext = iter_decompressed_chunks(plaintext, metadata["content_encoding"])
+
+    target = container_client.get_blob_client(f"{blob_name}.{os.urandom(4).hex()}")
+    target.create_append_blob(
+        metadata=appendable_metadata(
+            component.get("content_type") or metadata.get("content_type")
+        ),
+        match_condition=MatchConditions.IfMissing,
+    )
+    try:
+        append_encrypted(target, plaintext, derive_key_from_docId(docId), 0)
+    except BaseException:
+        delete_blob_quietly(target)
+        raise
+    return target.blob_name
+
+
+def release_converted_source(container_client, component: dict) -> None:
+    """Libera el blob de un componente ya convertido en anexable."""
+    source = container_client.get_blob_client(component["blob_name"])
+    try:
+        if component.get("content_address"):
+            release_content_reference(source)
+        else:
+            source.delete_blob()
+    except ResourceNotFoundError:
+        pass
+    except Exception as e:
+        # El documento ya apunta a la copia: solo queda un blob sin usar
+        logger.warning("No se pudo liberar '%s': %s", source.blob_name, e)
+
+
+def delete_blob_quietly(blob_client) -> None:
+    try:
+        blob_client.delete_blob()
+    except Exception as e:
+        logger.warning("No se pudo borrar '%s': %s", blob_client.blob_name, e)
+
+
+def handle_append(req: HttpRequest) -> HttpResponse:
+    contRep = req.params.get("contRep")
+    docId = req.params.get("docId")
+    compId = req.params.get("compId") or "data"
+
+    if not contRep or not docId:
+        return HttpResponse(
+            "Faltan parámetros requeridos para 'append'", status_code=400
+        )
+
+    try:
+        container_client = get_container_for_contRep(contRep)
+    except ValueError as e:
+        logger.error(str(e))
+        return HttpResponse(str(e), status_code=400)
+
+    data = req.get_body()
+    content_type = req.headers.get("Content-Type") or "application/octet-stream"
+    blob_name = f"{contRep}/{docId}_{compId}"
+    blob_client = container_client.get_blob_client(blob_name)
+
+    try:
+        index, index_etag = load_document_index(container_client, contRep, docId)
+        if index is not None:
+            components = index["components"]
+        else:
+            components = find_document_components(container_client, contRep, docId)
+        component = next((c for c in components if c["filename"] == compId), None)
+
+        ciphertext_size = None
+        converted = None
+        if component is None:
+            component = {"filename": compId, "content_type": content_type}
+            components = components + [component]
+            try:
+                blob_client.create_append_blob(
+                    metadata=appendable_metadata(content_type),
+                    match_condition=MatchConditions.IfMissing,
+                )
+                ciphertext_size = 0
+            except (ResourceExistsError, ResourceModifiedError):
+                # Otra petición lo creó a la vez (412 en Azure): se añade al final
+                pass
+        else:
+            blob_client = container_client.get_blob_client(component["blob_name"])
+            with span("blob_properties"):
+                props = blob_client.get_blob_properties()
+            if is_appendable(props.metadata):
+                ciphertext_size = props.size
+            else:
+                converted = dict(component)
+                with span("convert_appendable"):
+                    blob_client = container_client.get_blob_client(
+                        convert_to_appendable(container_client, docId, component, blob_name)
+                    )
+
+        try:
+            with span("append", bytes=len(data)):
+                size = append_encrypted(
+                    blob_client, [data], derive_key_from_docId(docId), ciphertext_size
+                )
+            component.update(
+                blob_name=blob_client.blob_name,
+                size=size,
+                content_type=component.get("content_type") or content_type,
+                content_encoding=None,
+                content_address=None,
+            )
+            # Tras convertir, el índice debe apuntar a la copia antes de liberar el
+            # original; el If-Match impide que dos conversiones a la vez lo liberen
+            write_document_index(
+                container_client,
+                contRep,
+                docId,
+                components,
+                index.get("created") if index else None,
+                required=converted is not None or index_required(components),
+                etag=index_etag if converted is not None else None,
+            )
+        except BaseException:
+            if converted is not None:
+                delete_blob_quietly(blob_client)
+            raise
+        doccache.invalidate(contRep, docId)
+        if converted is not None:
+            release_converted_source(container_client, converted)
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    except Exception as e:
+        logger.error("Error al añadir datos al documento %s: %s", docId, e)
+        return HttpResponse(f"Error al añadir datos: {str(e)}", status_code=500)
+
+    return func.HttpResponse(
+        body=json.dumps(
+            {
+                "message": "Datos añadidos al componente.",
+                "status": 200,
+                "details": {
+                    "command": "append",
+                    "contRep": contRep,
+                    "docId": docId,
+                    "compId": compId,
+                    "appended": len(data),
+                    "size": size,
+                },
+            }
+        ),
+        mimetype="application/json",
+        status_code=200,
+    )
+
+
+# Procesamiento del método POST
+def handle_post(req: HttpRequest, command: str) -> HttpResponse:
+    pVersion = req.params.get("pVersion")
+    contRep = req.params.get("contRep")
+    docId = req.params.get("docId")
+
+    if not contRep or not docId:
+        return HttpResponse(
+            "Faltan parámetros requeridos para 'create'", status_code=400
+        )
+
+    try:
+        container_client, connection_info = resolve_destination(contRep)
+        compression = resolve_codec(connection_info.get("data", {}).get("compression"))
+        dedup = bool(connection_info.get("data", {}).get("dedup"))
+    except ValueError as e:
+        logger.error(str(e))
+        return HttpResponse(str(e), status_code=400)
+
+    file_info = []
+    uploads = []
+    pending_slots = threading.BoundedSemaphore(UPLOAD_MAX_PENDING_BLOCKS)
+
+    try:
+        boundary = get_boundary(req.headers.get("Content-Type", ""))
+        body = req.get_body()
+        # Con deduplicación, una primera pasada calcula el hash de cada fichero
+        # para no subir los contenidos que ya existen
+        if dedup:
+            with span("hash_body", bytes=len(body)):
+                digests = iter(hash_multipart_files(body, boundary))
+        # El cuerpo se recorre por bloques; solo se decodifican las cabeceras de cada
+        # parte. Las subidas de cada fichero se encolan y continúan en paralelo
+        # mientras se cifra el siguiente.
+        for filename, part_headers, chunks in iter_multipart_files(body, boundary):
+            blob_name, upload = start_document_upload(
+                container_client,
+                contRep,
+                docId,
+                filename,
+                chunks,
+                pending_slots,
+                part_headers.get("content-type", "application/octet-stream"),
+                compression,
+                digest=next(digests) if dedup else None,
+            )
+            uploads.append((filename, blob_name, upload))
+    except MultipartError as e:
+        abort_uploads(upload for _, _, upload in uploads)
+        logger.error("Cuerpo multipart no válido: %s", e)
+        return HttpResponse(f"Cuerpo multipart no válido: {str(e)}", status_code=400)
+    except CircuitOpenError as e:
+        abort_uploads(upload for _, _, upload in uploads)
+        return unavailable_response(e)
+    except HttpResponseError as e:
+        # P. ej. al sumar la referencia a un contenido deduplicado
+        abort_uploads(upload for _, _, upload in uploads)
+        logger.error("Error al subir archivo a Azure Blob: %s", e)
+        return HttpResponse(f"Error al subir archivo: {str(e)}", status_code=500)
+
+    # Confirmar las listas de bloques de todos los ficheros en paralelo
+    finish = finish_dedup_upload if dedup else finish_encrypted_upload
+    commits = [_upload_executor.submit(finish, upload) for _, _, upload in uploads]
+    try:
+        with span("upload_commit", files=len(uploads)):
+            for commit in commits:
+                commit.result()
+    except CircuitOpenError as e:
+        abort_uploads((upload for _, _, upload in uploads), commits)
+        return unavailable_response(e)
+    except Exception as e:
+        abort_uploads((upload for _, _, upload in uploads), commits)
+        logger.error("Error al subir archivo a Azure Blob: %s", e)
+        return HttpResponse(f"Error al subir archivo: {str(e)}", status_code=500)
+
+    for filename, blob_name, upload in uploads:
+        logger.debug("Archivo subido a Azure Blob: %s", blob_name)
+        file_info.append(uploaded_file_info(filename, blob_name, upload))
+
+    if file_info:
+        try:
+            commit_document_index(container_client, contRep, docId, file_info, dedup)
+        except CircuitOpenError as e:
+            abort_uploads(upload for _, _, upload in uploads)
+            return unavailable_response(e)
+        except Exception as e:
+            # Sin índice los contenidos deduplicados quedarían sin referenciar
+            abort_uploads(upload for _, _, upload in uploads)
+            logger.error("Error al guardar el documento %s: %s", docId, e)
+            return HttpResponse(f"Error al subir archivo: {str(e)}", status_code=500)
+
+    with span("build_response"):
+        return create_response(command, contRep, docId, file_info)
+
+
+def start_document_upload(
+    container_client,
+    contRep: str,
+    docId: str,
+    filename: str,
+    chunks,
+    pending_slots,
+    content_type: str,
+    compression: str = None,
+    digest: str = None,
+):
+    """
+    Encola la subida de un fichero del documento y devuelve (blob_name, upload).
+    Con 'digest' (SHA-256 del contenido) la subida es deduplicada.
+    """
+    if digest is not None:
+        upload = start_dedup_upload(
+            container_client, chunks, digest, pending_slots, content_type, compression
+        )
+        return content_blob_name(digest), upload
+    blob_name = f"{contRep}/{docId}_{filename}"
+    upload = start_encrypted_upload(
+        container_client.get_blob_client(blob_name),
+        chunks,
+        derive_key_from_docId(docId),
+        pending_slots,
+        content_type,
+        compression,
+    )
+    return blob_name, upload
+
+
+def commit_document_index(
+    container_client, contRep: str, docId: str, file_info: list, dedup: bool
+) -> None:
+    """Escribe el índice del documento subido e invalida su copia en caché."""
+    # Si el docId ya existía, sus referencias a contenidos dejan de usarse
+    previous = read_document_index(container_client, contRep, docId) if dedup else None
+    write_document_index(
+        container_client,
+        contRep,
+        docId,
+        file_info,
+        required=index_required(file_info),
+    )
+    doccache.invalidate(contRep, docId)
+    if previous is not None:
+        # El documento nuevo ya está guardado: un fallo aquí solo deja
+        # referencias de más, que no deben deshacer la subida
+        try:
+            with span("release_contents"):
+                release_document_contents(container_client, previous)
+        except Exception as e:
+            logger.warning(
+                "No se pudieron liberar los contenidos anteriores de %s: %s", docId, e
+            )
+
+
+def uploaded_file_info(filename: str, blob_name: str, upload: dict) -> dict:
+    return {
+        "filename": filename,
+        "blob_name": blob_name,
+        "size": upload["plaintext_size"],
+        "content_type": upload["metadata"]["content_type"],
+        "content_encoding": upload["content_encoding"],
+        "content_address": upload.get("content_address"),
+        "deduplicated": upload.get("deduplicated", False),
+        "encrypt_ms": round((upload["encrypted"] - upload["started"]) * 1000, 1),
+        "total_ms": round((upload["finished"] - upload["started"]) * 1000, 1),
+    }
+
+
+def create_response(command: str, contRep: str, docId: str, file_info: list):
+    return func.HttpResponse(
+        body=json.dumps(
+            {
+                "message": "Archivos subidos exitosamente.",
+                "status": 201,
+                "details": {
+                    "command": command,
+                    "contRep": contRep,
+                    "docId": docId,
+                    "files": file_info,
+                },
+            }
+        ),
+        headers={
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+            "Access-Control-Allow-Headers": "Content-Type, Authorization",
+        },
+        status_code=201,
+    )
@@ -0,0 +1,133 @@
+import io
+
+# Parser incremental de multipart/form-data para el comando 'create'.
+# Solo se decodifican las cabeceras de cada parte; el contenido de los ficheros
+# se entrega como bloques de bytes a medida que se lee el cuerpo.
+
+READ_CHUNK_SIZE = 1024 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+def get_boundary(content_type: str) -> bytes:
+    """Extrae el boundary de la cabecera Content-Type."""
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.strip().lower() == "boundary":
+            value = value.strip().strip('"')
+            if value:
+                return value.encode("latin-1")
+    raise MultipartError("Falta el boundary en Content-Type")
+
+
+def parse_part_headers(raw: bytes) -> dict:
+    """Convierte el bloque de cabeceras de una parte en un diccionario (claves en minúscula)."""
+    headers = {}
+    for line in raw.decode("utf-8", errors="replace").split("\r\n"):
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def get_disposition_param(headers: dict, param: str):
+    """Devuelve un parámetro de Content-Disposition o None si no está."""
+    disposition = headers.get("content-disposition", "")
+    for item in disposition.split(";")[1:]:
+        name, _, value = item.strip().partition("=")
+        if name.strip().lower() == param:
+            return value.strip().strip('"')
+    return None
+
+
+def get_filename(headers: dict):
+    """Devuelve el 'filename' de Content-Disposition o None si la parte no es un fichero."""
+    return get_disposition_param(headers, "filename")
+
+
+class _MultipartReader:
+    def __init__(self, stream, boundary: bytes, chunk_size: int):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.delimiter = b"\r\n--" + boundary
+        # El primer delimitador puede no ir precedido de CRLF
+        self.buffer = b"\r\n"
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        data = self.stream.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def read_exact(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            if not self._fill():
+                raise MultipartError("Cuerpo multipart truncado")
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def iter_until_delimiter(self):
+        """Devuelve bloques hasta el siguiente delimitador, que queda consumido."""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index != -1:
+                data = self.buffer[:index]
+                self.buffer = self.buffer[index + len(self.delimiter) :]
+                if data:
+                    yield data
+                return
+            # Se retiene la cola por si el delimitador queda partido entre lecturas
+            if len(self.buffer) > keep:
+                data = self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+                yield data
+            if not self._fill():
+                raise MultipartError("Cuerpo multipart sin delimitador final")
+
+    def read_headers(self) -> bytes:
+        while True:
+            index = self.buffer.find(b"\r\n\r\n")
+            if index != -1:
+                raw, self.buffer = self.buffer[:index], self.buffer[index + 4 :]
+                return raw
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise MultipartError("Cabeceras de la parte demasiado grandes")
+            if not self._fill():
+                raise MultipartError("Cabeceras de la parte truncadas")
+
+
+def iter_multipart_files(stream, boundary: bytes, chunk_size: int = READ_CHUNK_SIZE):
+    """
+    Recorre un cuerpo multipart leyendo de 'stream' por bloques.
+
+    Por cada parte con 'filename' devuelve (filename, cabeceras, bloques), donde
+    'bloques' es un iterador con el contenido del fichero. Si el llamador no lo
+    consume por completo, se descarta antes de pasar a la parte siguiente.
+    """
+    if isinstance(stream, (bytes, bytearray, memoryview)):
+        stream = io.BytesIO(stream)
+    reader = _MultipartReader(stream, boundary, chunk_size)
+
+    # Descartar el preámbulo hasta el primer delimitador
+    for _ in reader.iter_until_delimiter():
+        pass
+
+    while True:
+        if reader.read_exact(2) == b"--":
+            return
+        headers = parse_part_headers(reader.read_headers())
+        chunks = reader.iter_until_delimiter()
+        filename = get_filename(headers)
+        if filename is not None:
+            yield filename, headers, chunks
+        for _ in chunks:
+            pass
@@ -1,6 +1,6 @@
 import azure.functions as func
 import json
-from blob_utils import load_connections, save_json_to_blob  # Importar funciones auxiliares
+from blob_utils import create_config_entry, ConfigEntryExists  # Importar funciones auxiliares
 import logging
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -30,11 +30,12 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 }
             )
 
-        # Cargar conexiones existentes desde el blob
-        connections = load_connections()
-
-        # Verificar si la conexión ya existe
-        if connection_data["connection_name"] in connections:
+        # Agregar la nueva conexión (falla si ya existe)
+        try:
+            create_config_entry(
+                "connections", connection_data["connection_name"], connection_data
+            )
+        except ConfigEntryExists:
             return func.HttpResponse(
                 "Connection already exists",
                 status_code=400,
@@ -45,12 +46,6 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 }
             )
 
-        # Agregar la nueva conexión
-        connections[connection_data["connection_name"]] = connection_data
-
-        # Guardar las conexiones actualizadas en el blob
-        save_json_to_blob("connections", "connections.json", connections)
-
         return func.HttpResponse(
             "Connection added successfully",
             status_code=201,
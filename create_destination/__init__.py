@@ -1,6 +1,6 @@
 import azure.functions as func
 import json
-from blob_utils import load_destinations, save_json_to_blob
+from blob_utils import create_config_entry, destination_entry, ConfigEntryExists
 import logging
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -21,11 +21,12 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
         # Validar que se hayan enviado los campos necesarios
         contRep = destination_data.get("contRep")
-        connection_name = destination_data.get("connection_name")
+        # Una conexión ("connection_name") o varias réplicas ("connections")
+        destination = destination_entry(destination_data)
         
-        if not contRep or not connection_name:
+        if not contRep or not destination:
             return func.HttpResponse(
-                "Missing 'contRep' or 'connection_name' in request body",
+                "Missing 'contRep' or valid 'connection_name'/'connections' in request body",
                 status_code=400,
                 headers={
                     "Access-Control-Allow-Origin": "*",
@@ -34,11 +35,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 }
             )
 
-        # Cargar destinos existentes desde el blob
-        destinations = load_destinations()
-
-        # Verificar si el destino ya existe
-        if contRep in destinations:
+        # Agregar el nuevo destino (falla si ya existe)
+        try:
+            create_config_entry("destinations", contRep, destination)
+        except ConfigEntryExists:
             return func.HttpResponse(
                 "Destination already exists",
                 status_code=400,
@@ -49,12 +49,6 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 }
             )
 
-        # Agregar el nuevo destino
-        destinations[contRep] = connection_name
-
-        # Guardar los destinos actualizados en el blob
-        save_json_to_blob("connections", "destinations.json", destinations)
-
         return func.HttpResponse(
             "Destination added successfully",
             status_code=201,
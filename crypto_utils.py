@@ -0,0 +1,454 @@
+import os
+import struct
+import hashlib
+import base64
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import padding
+
+# Formatos de cifrado de los documentos:
+#   v1: IV (16 bytes) + AES-CBC con relleno PKCS7 sobre todo el documento.
+#   v2: cabecera (16 bytes) + trozos de tamaño fijo cifrados con AES-GCM de forma
+#       independiente, lo que permite cifrar/descifrar en paralelo y leer rangos.
+#
+# Cabecera v2: MAGIC (4) + tamaño de trozo (uint32) + prefijo de nonce (8).
+# Cada trozo i usa el nonce prefijo + i (uint32) y autentica como datos
+# adicionales la cabecera, el índice y si es el último trozo, de modo que no se
+# pueden reordenar ni truncar.
+#
+# v3 (documentos anexables, comando 'append'): secuencia de segmentos, uno o más
+# por cada append, de modo que añadir datos no obliga a volver a cifrar los
+# anteriores. Cada segmento es una cabecera de 32 bytes, MAGIC_V3 (4) + tamaño
+# de trozo (uint32) + prefijo de nonce (8) + posición de inicio en el documento
+# (uint64) + tamaño del texto plano (uint64); sus trozos AES-GCM, como en v2,
+# con la cabecera del segmento como datos adicionales; y un pie sin cifrar con
+# el tamaño del segmento y el del documento hasta ese segmento (uint64 + uint64),
+# que permite conocer el tamaño total leyendo solo los últimos bytes.
+FORMAT_V1 = 1
+FORMAT_V2 = 2
+FORMAT_V3 = 3
+MAGIC_V2 = b"BTA\x02"
+MAGIC_V3 = b"BTA\x03"
+HEADER_SIZE_V2 = 16
+HEADER_SIZE_V3 = 32
+TRAILER_SIZE_V3 = 16
+TAG_SIZE = 16
+
+# Formato con el que se cifran los documentos nuevos
+ENCRYPTION_FORMAT = int(os.getenv("ENCRYPTION_FORMAT", str(FORMAT_V2)))
+ENCRYPTION_CHUNK_SIZE = int(os.getenv("ENCRYPTION_CHUNK_SIZE", str(1024 * 1024)))
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS", str(os.cpu_count() or 1)))
+
+_crypto_executor = ThreadPoolExecutor(
+    max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto"
+)
+
+
+def generate_secKey(message: str) -> str:
+    hash_object = hashlib.sha256(message.encode())
+    sec_key = base64.b64encode(hash_object.digest()).decode("utf-8")
+    return sec_key
+
+
+def derive_key_from_docId(docId: str) -> bytes:
+    """Deriva una clave de cifrado a partir del docId utilizando SHA-256"""
+    return hashlib.sha256(docId.encode()).digest()
+
+
+def derive_key_from_content(digest: str) -> bytes:
+    """Clave de un contenido deduplicado, derivada de su SHA-256 (hex) y no del docId"""
+    return hashlib.sha256(b"content:" + bytes.fromhex(digest)).digest()
+
+
+# --- Formato v1 (AES-CBC) ---
+
+
+def iter_encrypted_chunks_v1(chunks, key: bytes):
+    """Cifra de forma incremental un iterable de bloques. El primer bloque devuelto es el IV."""
+    iv = os.urandom(16)
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    encryptor = cipher.encryptor()
+    padder = padding.PKCS7(128).padder()
+    yield iv
+    for chunk in chunks:
+        encrypted = encryptor.update(padder.update(chunk))
+        if encrypted:
+            yield encrypted
+    yield encryptor.update(padder.finalize()) + encryptor.finalize()
+
+
+def range_request_v1(start: int, end: int):
+    """(offset, length) del cifrado que cubre los bytes [start, end] del texto plano."""
+    first_block = start // 16
+    last_block = end // 16
+    # El bloque i empieza en 16 * (i + 1); el anterior (o el IV) en 16 * i
+    return first_block * 16, (last_block - first_block + 2) * 16
+
+
+def decrypt_range_v1(data: bytes, key: bytes, start: int, end: int) -> bytes:
+    """Descifra el tramo descargado según range_request_v1."""
+    cipher = Cipher(algorithms.AES(key), modes.CBC(data[:16]), backend=default_backend())
+    decryptor = cipher.decryptor()
+    plain = decryptor.update(data[16:]) + decryptor.finalize()
+    skip = start - (start // 16) * 16
+    return plain[skip : skip + end - start + 1]
+
+
+def plaintext_size_v1(tail: bytes, key: bytes, ciphertext_size: int) -> int:
+    """Tamaño del texto plano a partir de los 32 últimos bytes (relleno PKCS7)."""
+    cipher = Cipher(algorithms.AES(key), modes.CBC(tail[:16]), backend=default_backend())
+    decryptor = cipher.decryptor()
+    last_block = decryptor.update(tail[16:]) + decryptor.finalize()
+    pad = last_block[-1]
+    if not 1 <= pad <= 16:
+        raise ValueError("Relleno PKCS7 no válido")
+    return ciphertext_size - 16 - pad
+
+
+# --- Formato v2 (trozos AES-GCM) ---
+
+
+def build_header_v2(chunk_size: int, nonce_prefix: bytes) -> bytes:
+    return struct.pack(">4sI8s", MAGIC_V2, chunk_size, nonce_prefix)
+
+
+def parse_header_v2(header: bytes):
+    """Devuelve (tamaño de trozo, prefijo de nonce) de una cabecera v2."""
+    magic, chunk_size, nonce_prefix = struct.unpack(">4sI8s", header[:HEADER_SIZE_V2])
+    if magic != MAGIC_V2 or chunk_size == 0:
+        raise ValueError("Cabecera de cifrado v2 no válida")
+    return chunk_size, nonce_prefix
+
+
+def detect_format(head: bytes) -> int:
+    """Detecta el formato a partir de los primeros 16 bytes del blob cifrado."""
+    if head[:4] == MAGIC_V2:
+        return FORMAT_V2
+    if head[:4] == MAGIC_V3:
+        return FORMAT_V3
+    return FORMAT_V1
+
+
+def chunk_count_v2(ciphertext_size: int, chunk_size: int) -> int:
+    body = ciphertext_size - HEADER_SIZE_V2
+    return max(1, -(-body // (chunk_size + TAG_SIZE)))
+
+
+def plaintext_size_v2(ciphertext_size: int, chunk_size: int) -> int:
+    body = ciphertext_size - HEADER_SIZE_V2
+    return body - chunk_count_v2(ciphertext_size, chunk_size) * TAG_SIZE
+
+
+def _seal(aesgcm, header: bytes, index: int, final: bool, plain: bytes) -> bytes:
+    nonce = header[8:16] + struct.pack(">I", index)
+    aad = header + struct.pack(">IB", index, final)
+    return aesgcm.encrypt(nonce, plain, aad)
+
+
+def _open(aesgcm, header: bytes, index: int, final: bool, sealed: bytes) -> bytes:
+    nonce = header[8:16] + struct.pack(">I", index)
+    aad = header + struct.pack(">IB", index, final)
+    try:
+        return aesgcm.decrypt(nonce, sealed, aad)
+    except InvalidTag:
+        raise ValueError(f"Trozo cifrado {index} no válido o manipulado")
+
+
+def _iter_frames(chunks, frame_size: int):
+    """
+    Reagrupa un iterable de bloques en tramas de 'frame_size' bytes y devuelve
+    (trama, es_la_última). La última trama puede ser más corta.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        # Se retiene siempre una trama para saber cuál es la última
+        while len(buffer) > frame_size:
+            yield bytes(buffer[:frame_size]), False
+            del buffer[:frame_size]
+    yield bytes(buffer), True
+
+
+def _parallel_map(fn, frames):
+    """Aplica fn a las tramas en lotes paralelos, manteniendo el orden y la memoria acotada."""
+    batch = []
+    for index, (frame, final) in enumerate(frames):
+        batch.append((index, final, frame))
+        if len(batch) >= 2 * CRYPTO_WORKERS:
+            yield from _crypto_executor.map(lambda item: fn(*item), batch)
+            batch = []
+    if batch:
+        yield from _crypto_executor.map(lambda item: fn(*item), batch)
+
+
+def iter_encrypted_chunks_v2(chunks, key: bytes, chunk_size: int = ENCRYPTION_CHUNK_SIZE):
+    """Cifra de forma incremental en formato v2. El primer bloque devuelto es la cabecera."""
+    aesgcm = AESGCM(key)
+    header = build_header_v2(chunk_size, os.urandom(8))
+    yield header
+    yield from _parallel_map(
+        lambda index, final, plain: _seal(aesgcm, header, index, final, plain),
+        _iter_frames(chunks, chunk_size),
+    )
+
+
+def range_request_v2(start: int, end: int, chunk_size: int):
+    """(offset, length) de los trozos que cubren los bytes [start, end] del texto plano."""
+    first_chunk = start // chunk_size
+    last_chunk = end // chunk_size
+    frame_size = chunk_size + TAG_SIZE
+    return (
+        HEADER_SIZE_V2 + first_chunk * frame_size,
+        (last_chunk - first_chunk + 1) * frame_size,
+    )
+
+
+def decrypt_range_v2(
+    data: bytes, key: bytes, header: bytes, start: int, end: int, ciphertext_size: int
+) -> bytes:
+    """Descifra en paralelo los trozos descargados según range_request_v2."""
+    aesgcm = AESGCM(key)
+    chunk_size, _ = parse_header_v2(header)
+    frame_size = chunk_size + TAG_SIZE
+    first_chunk = start // chunk_size
+    last_index = chunk_count_v2(ciphertext_size, chunk_size) - 1
+    items = [
+        (first_chunk + i, data[offset : offset + frame_size])
+        for i, offset in enumerate(range(0, len(data), frame_size))
+    ]
+    plain = b"".join(
+        _crypto_executor.map(
+            lambda item: _open(aesgcm, header, item[0], item[0] == last_index, item[1]),
+            items,
+        )
+    )
+    skip = start - first_chunk * chunk_size
+    return plain[skip : skip + end - start + 1]
+
+
+# --- Formato v3 (segmentos anexables) ---
+
+
+def build_segment_header_v3(
+    chunk_size: int, nonce_prefix: bytes, start: int, length: int
+) -> bytes:
+    return struct.pack(">4sI8sQQ", MAGIC_V3, chunk_size, nonce_prefix, start, length)
+
+
+def parse_segment_header_v3(header: bytes):
+    """Devuelve (tamaño de trozo, inicio, tamaño del texto plano) de un segmento v3."""
+    magic, chunk_size, _, start, length = struct.unpack(
+        ">4sI8sQQ", header[:HEADER_SIZE_V3]
+    )
+    if magic != MAGIC_V3 or chunk_size == 0:
+        raise ValueError("Cabecera de segmento v3 no válida")
+    return chunk_size, start, length
+
+
+def parse_trailer_v3(trailer: bytes):
+    """Devuelve (tamaño del segmento, tamaño del documento) del pie de un segmento v3."""
+    return struct.unpack(">QQ", trailer[-TRAILER_SIZE_V3:])
+
+
+def segment_size_v3(length: int, chunk_size: int) -> int:
+    """Tamaño cifrado de un segmento con 'length' bytes de texto plano."""
+    frames = max(1, -(-length // chunk_size))
+    return HEADER_SIZE_V3 + length + frames * TAG_SIZE + TRAILER_SIZE_V3
+
+
+def max_segment_length_v3(segment_size: int, chunk_size: int = ENCRYPTION_CHUNK_SIZE) -> int:
+    """Mayor texto plano cuyo segmento cifrado cabe en 'segment_size' bytes."""
+    frames = max(1, -(-segment_size // chunk_size))
+    return segment_size - HEADER_SIZE_V3 - TRAILER_SIZE_V3 - frames * TAG_SIZE
+
+
+def encrypt_segment_v3(
+    data: bytes, key: bytes, start: int, chunk_size: int = ENCRYPTION_CHUNK_SIZE
+) -> bytes:
+    """Cifra 'data' como un segmento v3 que empieza en el byte 'start' del documento."""
+    aesgcm = AESGCM(key)
+    header = build_segment_header_v3(chunk_size, os.urandom(8), start, len(data))
+    frames = _parallel_map(
+        lambda index, final, plain: _seal(aesgcm, header, index, final, plain),
+        _iter_frames([data], chunk_size),
+    )
+    segment = header + b"".join(frames)
+    return segment + struct.pack(
+        ">QQ", len(segment) + TRAILER_SIZE_V3, start + len(data)
+    )
+
+
+# --- API común ---
+
+
+def iter_encrypted_chunks(chunks, key: bytes, encryption_format: int = None):
+    """Cifra un iterable de bloques en el formato indicado (por defecto ENCRYPTION_FORMAT)."""
+    if (encryption_format or ENCRYPTION_FORMAT) == FORMAT_V1:
+        return iter_encrypted_chunks_v1(chunks, key)
+    return iter_encrypted_chunks_v2(chunks, key)
+
+
+class StreamDecryptor:
+    """
+    Descifrador incremental con la interfaz update()/finalize() de cryptography.
+    Detecta el formato (v1, v2 o v3) con los primeros 16 bytes recibidos.
+    """
+
+    def __init__(self, key: bytes):
+        self.key = key
+        self.head = b""
+        self.format = None
+        self.buffer = bytearray()
+        self.next_index = 0
+
+    def _start(self, head: bytes) -> None:
+        self.format = detect_format(head)
+        if self.format == FORMAT_V3:
+            self.aesgcm = AESGCM(self.key)
+            # Segmento en curso y posición del documento descifrada hasta ahora
+            self.segment = None
+            self.position = 0
+        elif self.format == FORMAT_V2:
+            self.header = head
+            self.aesgcm = AESGCM(self.key)
+            self.frame_size = parse_header_v2(head)[0] + TAG_SIZE
+        else:
+            cipher = Cipher(
+                algorithms.AES(self.key), modes.CBC(head), backend=default_backend()
+            )
+            self.decryptor = cipher.decryptor()
+            self.unpadder = padding.PKCS7(128).unpadder()
+
+    def _open_frames(self, frames: list, last_is_final: bool) -> bytes:
+        items = [
+            (self.next_index + i, last_is_final and i == len(frames) - 1, frame)
+            for i, frame in enumerate(frames)
+        ]
+        self.next_index += len(frames)
+
+        def opened(item):
+            return _open(self.aesgcm, self.header, *item)
+
+        if len(items) > 1:
+            return b"".join(_crypto_executor.map(opened, items))
+        return b"".join(map(opened, items))
+
+    def _open_segments(self) -> bytes:
+        """Descifra los trozos completos recibidos de los segmentos v3."""
+        items = []
+        while True:
+            segment = self.segment
+            if segment is None:
+                if len(self.buffer) < HEADER_SIZE_V3:
+                    break
+                header = bytes(self.buffer[:HEADER_SIZE_V3])
+                chunk_size, start, length = parse_segment_header_v3(header)
+                if start != self.position:
+                    raise ValueError("Segmento cifrado fuera de orden")
+                del self.buffer[:HEADER_SIZE_V3]
+                segment = self.segment = {
+                    "header": header,
+                    "chunk_size": chunk_size,
+                    "size": segment_size_v3(length, chunk_size),
+                    "end": start + length,
+                    "index": 0,
+                }
+            remaining = segment["end"] - self.position
+            if remaining == 0 and segment["index"]:
+                # Trozos del segmento completos: queda el pie
+                if len(self.buffer) < TRAILER_SIZE_V3:
+                    break
+                if parse_trailer_v3(self.buffer[:TRAILER_SIZE_V3]) != (
+                    segment["size"],
+                    segment["end"],
+                ):
+                    raise ValueError("Pie de segmento cifrado no válido")
+                del self.buffer[:TRAILER_SIZE_V3]
+                self.segment = None
+                continue
+            plain_size = min(segment["chunk_size"], remaining)
+            frame_size = plain_size + TAG_SIZE
+            if len(self.buffer) < frame_size:
+                break
+            items.append(
+                (
+                    segment["header"],
+                    segment["index"],
+                    plain_size == remaining,
+                    bytes(self.buffer[:frame_size]),
+                )
+            )
+            del self.buffer[:frame_size]
+            segment["index"] += 1
+            self.position += plain_size
+
+        def opened(item):
+            return _open(self.aesgcm, *item)
+
+        if len(items) > 1:
+            return b"".join(_crypto_executor.map(opened, items))
+        return b"".join(map(opened, items))
+
+    def update(self, data: bytes) -> bytes:
+        if self.format is None:
+            self.head += data
+            if len(self.head) < 16:
+                return b""
+            head, self.head = self.head, b""
+            self._start(head[:16])
+            # En v3 la cabecera forma parte del primer segmento
+            data = head if self.format == FORMAT_V3 else head[16:]
+
+        if self.format == FORMAT_V1:
+            return self.unpadder.update(self.decryptor.update(data))
+        if self.format == FORMAT_V3:
+            self.buffer += data
+            return self._open_segments()
+
+        self.buffer += data
+        # Se retiene siempre una trama para saber cuál es la última
+        count = (len(self.buffer) - 1) // self.frame_size
+        if count <= 0:
+            return b""
+        frames = [
+            bytes(self.buffer[i * self.frame_size : (i + 1) * self.frame_size])
+            for i in range(count)
+        ]
+        del self.buffer[: count * self.frame_size]
+        return self._open_frames(frames, last_is_final=False)
+
+    def finalize(self) -> bytes:
+        if self.format is None:
+            raise ValueError("Datos cifrados incompletos: falta la cabecera")
+        if self.format == FORMAT_V1:
+            return self.unpadder.update(self.decryptor.finalize()) + self.unpadder.finalize()
+        if self.format == FORMAT_V3:
+            if self.segment is not None or self.buffer:
+                raise ValueError("Datos cifrados incompletos: segmento truncado")
+            return b""
+        return self._open_frames([bytes(self.buffer)], last_is_final=True)
+
+
+def iter_decrypted_chunks(chunks, key: bytes):
+    """
+    Descifra de forma incremental un iterable de bloques cifrados (p. ej.
+    download_blob().chunks()), detectando el formato por los primeros bytes.
+    """
+    decryptor = StreamDecryptor(key)
+    for chunk in chunks:
+        plain = decryptor.update(chunk)
+        if plain:
+            yield plain
+    yield decryptor.finalize()
+
+
+def encrypt_data(data: bytes, key: bytes, encryption_format: int = None) -> bytes:
+    return b"".join(iter_encrypted_chunks([data], key, encryption_format))
+
+
+def decrypt_data(encrypted_data: bytes, key: bytes) -> bytes:
+    return b"".join(iter_decrypted_chunks([encrypted_data], key))
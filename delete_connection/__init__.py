@@ -1,6 +1,6 @@
 import azure.functions as func
 import json
-from blob_utils import load_connections, save_json_to_blob
+from blob_utils import delete_config_entry, ConfigEntryNotFound, drop_blob_client
 import logging
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -18,11 +18,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     try:
         connection_name = req.route_params.get("connection_name")
 
-        # Cargar conexiones desde el blob
-        connections = load_connections()
-
-        # Verificar si la conexión existe
-        if connection_name not in connections:
+        # Eliminar la conexión (falla si no existe)
+        try:
+            delete_config_entry("connections", connection_name)
+        except ConfigEntryNotFound:
             return func.HttpResponse(
                 "Connection not found",
                 status_code=404,
@@ -33,11 +32,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 }
             )
 
-        # Eliminar la conexión
-        del connections[connection_name]
-
-        # Guardar las conexiones actualizadas en el blob
-        save_json_to_blob("connections", "connections.json", connections)
+        # Descartar el cliente de Blob Storage en caché para esta conexión
+        drop_blob_client(connection_name)
 
         return func.HttpResponse(
             "Connection deleted successfully",
@@ -1,6 +1,6 @@
 import azure.functions as func
 import json
-from blob_utils import load_destinations, save_json_to_blob
+from blob_utils import delete_config_entry, ConfigEntryNotFound
 import logging
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -18,11 +18,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     try:
         contRep = req.route_params.get("contRep")
 
-        # Cargar destinos desde el blob
-        destinations = load_destinations()
-
-        # Verificar si el destino existe
-        if contRep not in destinations:
+        # Eliminar el destino (falla si no existe)
+        try:
+            delete_config_entry("destinations", contRep)
+        except ConfigEntryNotFound:
             return func.HttpResponse(
                 "Destination not found",
                 status_code=404,
@@ -33,12 +32,6 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 }
             )
 
-        # Eliminar el destino
-        del destinations[contRep]
-
-        # Guardar los destinos actualizados en el blob
-        save_json_to_blob("connections", "destinations.json", destinations)
-
         return func.HttpResponse(
             "Destination deleted successfully",
             status_code=200,
@@ -0,0 +1,579 @@
+import os
+import json
+import mmap
+import uuid
+import struct
+import shutil
+import hashlib
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se coordinan los hilos del proceso
+    fcntl = None
+
+# Almacenamiento de documentos en un sistema de ficheros local o montado, con la
+# misma interfaz que memory_blob.py (la parte de azure.storage.blob que usan las
+# funciones). Se activa con cadenas de conexión "file://<ruta>" y con las
+# conexiones LOCAL (ver blob_utils.create_blob_service_client).
+#
+# Cada blob es el fichero <ruta>/<contenedor>/<nombre del blob>, con los "/" del
+# nombre como subdirectorios: una cabecera (MAGIC, longitud y un JSON con tipo,
+# metadatos, token del ETag y fecha de creación) seguida de los datos.
+#   - Las escrituras van a un temporal del mismo contenedor que se renombra sobre
+#     el destino (os.replace): un lector ve el blob anterior o el nuevo, nunca uno
+#     a medias. Los Append Blobs crecen en el sitio y su ETag incluye el tamaño.
+#   - Las lecturas proyectan el fichero en memoria (mmap) y devuelven porciones
+#     de la proyección, sin una llamada a read() por bloque ni buffers propios.
+#   - set_blob_metadata no reescribe los datos: guarda los metadatos en
+#     <ruta>/<contenedor>/.meta/<nombre del blob>, que se sustituye de forma
+#     atómica. Ese fichero lleva el token del blob al que se refiere, así que
+#     una escritura completa posterior lo invalida sin tener que borrarlo antes.
+#   - Las escrituras de un contenedor se serializan con un lock, también entre
+#     procesos (flock) si el sistema lo permite.
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+# fsync antes de renombrar: sin él, una caída del sistema puede dejar un blob vacío
+LOCAL_STORAGE_FSYNC = os.getenv("LOCAL_STORAGE_FSYNC", "1") == "1"
+
+MAGIC = b"LBL1"
+PREFIX = struct.Struct(">4sI")
+# Temporales y bloques preparados, y metadatos actualizados; no son blobs y no se listan
+TMP_DIR = ".tmp"
+META_DIR = ".meta"
+LOCK_FILE = ".lock"
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+class _ContainerLock:
+    """Lock reentrante de las escrituras de un contenedor (hilos y procesos)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "a+b")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+
+def _container_lock(container_path: str) -> _ContainerLock:
+    with _locks_lock:
+        lock = _locks.get(container_path)
+        if lock is None:
+            lock = _locks[container_path] = _ContainerLock(
+                os.path.join(container_path, LOCK_FILE)
+            )
+        return lock
+
+
+def _valid_segments(name: str) -> list:
+    """Segmentos de un nombre; rechaza los que saldrían del contenedor."""
+    segments = name.split("/")
+    if (
+        not name
+        or "\\" in name
+        or "\x00" in name
+        or any(segment in ("", ".", "..") for segment in segments)
+        or segments[0] in (TMP_DIR, META_DIR, LOCK_FILE)
+    ):
+        raise ValueError(f"Nombre de blob no válido: {name!r}")
+    return segments
+
+
+def _container_path(root: str, container_name: str) -> str:
+    if not container_name or "/" in container_name or container_name in (".", ".."):
+        raise ValueError(f"Nombre de contenedor no válido: {container_name!r}")
+    return os.path.join(root, container_name)
+
+
+def _not_modified() -> HttpResponseError:
+    # Como el SDK: un 304 sin código de error llega como HttpResponseError
+    error = HttpResponseError("El blob no ha cambiado")
+    error.status_code = 304
+    return error
+
+
+def _check_conditions(current_etag, etag, match_condition) -> None:
+    if match_condition == MatchConditions.IfNotModified:
+        if current_etag is None or current_etag != etag:
+            raise ResourceModifiedError("La condición If-Match no se cumple")
+    elif match_condition == MatchConditions.IfMissing and current_etag is not None:
+        # Como el SDK: un If-None-Match: * que falla es un 412 ConditionNotMet
+        raise ResourceModifiedError("La condición If-None-Match no se cumple")
+    elif match_condition == MatchConditions.IfPresent and current_etag is None:
+        raise ResourceNotFoundError("El blob no existe")
+
+
+def _etag(header: dict, size: int) -> str:
+    # El token cambia con cada escritura completa y el tamaño con cada append
+    return f'"0x{header["token"]}{size:X}"'
+
+
+def _new_header(blob_type: str, metadata: dict, created: str = None) -> dict:
+    return {
+        "blob_type": blob_type,
+        "metadata": dict(metadata or {}),
+        "token": uuid.uuid4().hex[:16].upper(),
+        "created": created or datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _parse_header(buffer) -> tuple:
+    """(cabecera, desplazamiento de los datos) de un blob leído o proyectado."""
+    magic, length = PREFIX.unpack(buffer[: PREFIX.size])
+    if magic != MAGIC:
+        raise HttpResponseError("El fichero no es un blob local válido")
+    return json.loads(bytes(buffer[PREFIX.size : PREFIX.size + length])), PREFIX.size + length
+
+
+def _apply_metadata(header: dict, meta_path: str) -> dict:
+    """
+    Cabecera con los metadatos de set_blob_metadata, si los hay y son de esta
+    versión del blob. 'blob_token' conserva el token del fichero de datos.
+    """
+    try:
+        with open(meta_path, "rb") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        return header
+    if meta.get("blob_token") != header["token"]:
+        return header
+    return {
+        **header,
+        "metadata": meta["metadata"],
+        "token": meta["token"],
+        "blob_token": header["token"],
+    }
+
+
+def _read_state(path: str, meta_path: str):
+    """(cabecera, tamaño de los datos, stat) de un blob, o None si no existe."""
+    try:
+        f = open(path, "rb")
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return None
+    with f:
+        magic, length = PREFIX.unpack(f.read(PREFIX.size))
+        if magic != MAGIC:
+            raise HttpResponseError("El fichero no es un blob local válido")
+        header = json.loads(f.read(length))
+        stat = os.fstat(f.fileno())
+    return _apply_metadata(header, meta_path), stat.st_size - PREFIX.size - length, stat
+
+
+def _properties(name: str, header: dict, size: int, stat):
+    return SimpleNamespace(
+        name=name,
+        size=size,
+        etag=_etag(header, size),
+        metadata=dict(header["metadata"]),
+        last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        creation_time=datetime.fromisoformat(header["created"]),
+        blob_type=header["blob_type"],
+        content_settings=SimpleNamespace(content_type=None),
+    )
+
+
+def _iter_data(data):
+    """Bloques de bytes de lo que acepta upload_blob (bytes, str, fichero o iterable)."""
+    if isinstance(data, str):
+        yield data.encode("utf-8")
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        yield data
+    elif hasattr(data, "read"):
+        yield from iter(lambda: data.read(COPY_CHUNK_SIZE), b"")
+    else:
+        yield from data
+
+
+def _iter_file(path: str, offset: int = 0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        yield from iter(lambda: f.read(COPY_CHUNK_SIZE), b"")
+
+
+class LocalBlobServiceClient:
+    def __init__(self, root: str, max_chunk_get_size: int = DEFAULT_CHUNK_SIZE):
+        self.root = os.path.abspath(root)
+        self.max_chunk_get_size = max_chunk_get_size
+
+    @classmethod
+    def from_connection_string(cls, connection_string: str, **kwargs):
+        return cls(
+            connection_string.split("://", 1)[-1] or ".",
+            kwargs.get("max_chunk_get_size") or DEFAULT_CHUNK_SIZE,
+        )
+
+    def get_container_client(self, container: str):
+        return LocalContainerClient(self, container)
+
+    def get_blob_client(self, container: str, blob: str):
+        return LocalBlobClient(self, container, blob)
+
+
+class LocalContainerClient:
+    def __init__(self, service: LocalBlobServiceClient, container_name: str):
+        self.service = service
+        self.container_name = container_name
+        self.path = _container_path(service.root, container_name)
+
+    def get_blob_client(self, blob: str):
+        return LocalBlobClient(self.service, self.container_name, blob)
+
+    def create_container(self, **kwargs):
+        try:
+            os.makedirs(self.path)
+        except FileExistsError:
+            raise ResourceExistsError("El contenedor ya existe")
+
+    def exists(self, **kwargs) -> bool:
+        return os.path.isdir(self.path)
+
+    def list_blobs(self, name_starts_with: str = None, **kwargs):
+        prefix = name_starts_with or ""
+        # Solo se recorre el directorio más profundo que fija el prefijo
+        directory = prefix.rpartition("/")[0]
+        if directory:
+            try:
+                start = os.path.join(self.path, *_valid_segments(directory))
+            except ValueError:
+                return []
+        else:
+            start = self.path
+
+        names = []
+        for dirpath, dirnames, filenames in os.walk(start):
+            relative = os.path.relpath(dirpath, self.path).replace(os.sep, "/")
+            relative = "" if relative == "." else relative + "/"
+            if not relative:
+                dirnames[:] = [d for d in dirnames if d not in (TMP_DIR, META_DIR)]
+            names.extend(
+                relative + filename
+                for filename in filenames
+                if (relative or filename != LOCK_FILE)
+                and (relative + filename).startswith(prefix)
+            )
+
+        result = []
+        for name in sorted(names):
+            segments = name.split("/")
+            state = _read_state(
+                os.path.join(self.path, *segments),
+                os.path.join(self.path, META_DIR, *segments),
+            )
+            if state is not None:  # borrado mientras se listaba
+                result.append(_properties(name, *state))
+        return result
+
+    def upload_blob(self, name: str, data, **kwargs):
+        blob_client = self.get_blob_client(name)
+        blob_client.upload_blob(data, **kwargs)
+        return blob_client
+
+    def download_blob(self, blob: str, **kwargs):
+        return self.get_blob_client(blob).download_blob(**kwargs)
+
+    def delete_blob(self, blob: str, **kwargs):
+        return self.get_blob_client(blob).delete_blob(**kwargs)
+
+
+class LocalBlobClient:
+    def __init__(self, service: LocalBlobServiceClient, container_name: str, blob_name: str):
+        self.service = service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self._container_path = _container_path(service.root, container_name)
+        segments = _valid_segments(blob_name)
+        self._path = os.path.join(self._container_path, *segments)
+        self._meta_path = os.path.join(self._container_path, META_DIR, *segments)
+        self._lock = _container_lock(self._container_path)
+
+    def _current(self):
+        """(cabecera, tamaño, stat, ETag) del blob, o None si no existe."""
+        state = _read_state(self._path, self._meta_path)
+        if state is None:
+            return None
+        header, size, stat = state
+        return header, size, stat, _etag(header, size)
+
+    def _staged_dir(self) -> str:
+        blob_hash = hashlib.sha256(self.blob_name.encode()).hexdigest()
+        return os.path.join(self._container_path, TMP_DIR, "staged", blob_hash)
+
+    def exists(self, **kwargs) -> bool:
+        return _read_state(self._path, self._meta_path) is not None
+
+    def get_blob_properties(self, **kwargs):
+        state = _read_state(self._path, self._meta_path)
+        if state is None:
+            raise ResourceNotFoundError("El blob no existe")
+        return _properties(self.blob_name, *state)
+
+    def download_blob(
+        self, offset: int = None, length: int = None, etag=None, match_condition=None, **kwargs
+    ):
+        try:
+            f = open(self._path, "rb")
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise ResourceNotFoundError("El blob no existe")
+        with f:
+            # La proyección fija el tamaño: lo que se añada después no se ve
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+        try:
+            header, data_offset = _parse_header(mapped)
+            header = _apply_metadata(header, self._meta_path)
+            size = len(mapped) - data_offset
+            current_etag = _etag(header, size)
+            if match_condition == MatchConditions.IfModified and current_etag == etag:
+                raise _not_modified()
+            _check_conditions(current_etag, etag, match_condition)
+        except Exception:
+            mapped.close()
+            raise
+        start = min(offset or 0, size)
+        end = size if length is None else min(start + length, size)
+        return LocalDownloader(
+            mapped,
+            data_offset + start,
+            data_offset + end,
+            _properties(self.blob_name, header, size, stat),
+            self.service.max_chunk_get_size,
+        )
+
+    def upload_blob(
+        self, data, overwrite: bool = False, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        previous = self._current()
+        created = previous[0]["created"] if previous else None
+        temp_path = self._write_temp(_new_header("BlockBlob", metadata, created), _iter_data(data))
+        with self._lock:
+            current = self._current()
+            current_etag = current[3] if current else None
+            try:
+                if not overwrite and match_condition is None and current is not None:
+                    raise ResourceExistsError("El blob ya existe")
+                _check_conditions(current_etag, etag, match_condition)
+            except Exception:
+                os.remove(temp_path)
+                raise
+            return self._replace(temp_path)
+
+    def stage_block(self, block_id: str, data, **kwargs):
+        staged_dir = self._staged_dir()
+        os.makedirs(staged_dir, exist_ok=True)
+        block_path = os.path.join(staged_dir, hashlib.sha256(block_id.encode()).hexdigest())
+        temp_path = f"{block_path}.{uuid.uuid4().hex}"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, block_path)
+
+    def commit_block_list(
+        self, block_list, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        staged_dir = self._staged_dir()
+        block_paths = [
+            os.path.join(staged_dir, hashlib.sha256(getattr(block, "id", block).encode()).hexdigest())
+            for block in block_list
+        ]
+        missing = [path for path in block_paths if not os.path.exists(path)]
+        if missing:
+            raise HttpResponseError("La lista de bloques contiene bloques no preparados")
+
+        def blocks():
+            for path in block_paths:
+                yield from _iter_file(path)
+
+        previous = self._current()
+        created = previous[0]["created"] if previous else None
+        temp_path = self._write_temp(_new_header("BlockBlob", metadata, created), blocks())
+        with self._lock:
+            current = self._current()
+            try:
+                _check_conditions(current[3] if current else None, etag, match_condition)
+            except Exception:
+                os.remove(temp_path)
+                raise
+            result = self._replace(temp_path)
+        # Como en Azure, al confirmar la lista se descartan los bloques preparados
+        shutil.rmtree(staged_dir, ignore_errors=True)
+        return result
+
+    def create_append_blob(
+        self, content_settings=None, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        temp_path = self._write_temp(_new_header("AppendBlob", metadata), ())
+        with self._lock:
+            current = self._current()
+            try:
+                _check_conditions(current[3] if current else None, etag, match_condition)
+            except Exception:
+                os.remove(temp_path)
+                raise
+            return self._replace(temp_path)
+
+    def append_block(self, data, length: int = None, appendpos_condition: int = None, **kwargs):
+        with self._lock:
+            current = self._current()
+            if current is None:
+                raise ResourceNotFoundError("El blob no existe")
+            header, size, _, _ = current
+            if header["blob_type"] != "AppendBlob":
+                raise HttpResponseError("El blob no es un Append Blob")
+            if appendpos_condition is not None and appendpos_condition != size:
+                error = HttpResponseError("La condición de posición de append no se cumple")
+                error.error_code = "AppendPositionConditionNotMet"
+                raise error
+            with open(self._path, "ab") as f:
+                f.write(data)
+                if LOCAL_STORAGE_FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+            header, new_size, stat = _read_state(self._path, self._meta_path)
+            return {
+                "etag": _etag(header, new_size),
+                "last_modified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+                "blob_append_offset": str(size),
+            }
+
+    def set_blob_metadata(self, metadata: dict = None, etag=None, match_condition=None, **kwargs):
+        with self._lock:
+            current = self._current()
+            if current is None:
+                raise ResourceNotFoundError("El blob no existe")
+            header, _, _, current_etag = current
+            _check_conditions(current_etag, etag, match_condition)
+            # Solo se sustituye el fichero de metadatos; los datos no se tocan
+            meta = {
+                "blob_token": header.get("blob_token", header["token"]),
+                "token": uuid.uuid4().hex[:16].upper(),
+                "metadata": dict(metadata or {}),
+            }
+            temp_path = self._write_temp_file(lambda f: f.write(json.dumps(meta).encode("utf-8")))
+            os.makedirs(os.path.dirname(self._meta_path), exist_ok=True)
+            os.replace(temp_path, self._meta_path)
+            header, size, stat = _read_state(self._path, self._meta_path)
+            return {
+                "etag": _etag(header, size),
+                "last_modified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+            }
+
+    def delete_blob(self, etag=None, match_condition=None, **kwargs):
+        with self._lock:
+            current = self._current()
+            if current is None:
+                raise ResourceNotFoundError("El blob no existe")
+            _check_conditions(current[3], etag, match_condition)
+            os.remove(self._path)
+            self._remove_metadata()
+            self._remove_empty_dirs(self._path, self._container_path)
+
+    def _remove_metadata(self) -> None:
+        try:
+            os.remove(self._meta_path)
+        except FileNotFoundError:
+            return
+        self._remove_empty_dirs(
+            self._meta_path, os.path.join(self._container_path, META_DIR)
+        )
+
+    @staticmethod
+    def _remove_empty_dirs(path: str, stop: str) -> None:
+        # Quita los directorios que hayan quedado vacíos, sin salir de 'stop'
+        directory = os.path.dirname(path)
+        while directory != stop:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def _write_temp_file(self, write) -> str:
+        """Crea un temporal del contenedor con lo que escribe 'write' y devuelve su ruta."""
+        temp_dir = os.path.join(self._container_path, TMP_DIR)
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_path = os.path.join(temp_dir, uuid.uuid4().hex)
+        try:
+            with open(temp_path, "wb") as f:
+                write(f)
+                if LOCAL_STORAGE_FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path
+
+    def _write_temp(self, header: dict, chunks) -> str:
+        """Escribe el blob completo en un temporal del contenedor y devuelve su ruta."""
+        encoded = json.dumps(header).encode("utf-8")
+
+        def write(f):
+            f.write(PREFIX.pack(MAGIC, len(encoded)))
+            f.write(encoded)
+            for chunk in chunks:
+                f.write(chunk)
+
+        return self._write_temp_file(write)
+
+    def _replace(self, temp_path: str) -> dict:
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        os.replace(temp_path, self._path)
+        # Los metadatos de la versión anterior ya no se aplican (otro token)
+        self._remove_metadata()
+        header, size, stat = _read_state(self._path, self._meta_path)
+        return {
+            "etag": _etag(header, size),
+            "last_modified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        }
+
+
+class LocalDownloader:
+    def __init__(self, mapped: mmap.mmap, start: int, end: int, properties, chunk_size: int):
+        self._mapped = mapped
+        self._start = start
+        self._end = end
+        self._chunk_size = chunk_size
+        self.properties = properties
+        self.size = end - start
+
+    def readall(self) -> bytes:
+        try:
+            return self._mapped[self._start : self._end]
+        finally:
+            self._mapped.close()
+
+    def chunks(self):
+        try:
+            for offset in range(self._start, self._end, self._chunk_size):
+                yield self._mapped[offset : min(offset + self._chunk_size, self._end)]
+        finally:
+            self._mapped.close()
@@ -0,0 +1,153 @@
+import os
+import re
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Logging del content server. Los módulos usan logging.getLogger(__name__) y
+# mensajes con argumentos ("... %s", valor), que solo se formatean si el
+# nivel está activo. configure_logging() (una vez por worker):
+#   - fija el nivel de los loggers propios (LOG_LEVEL) y, por módulo,
+#     LOG_LEVELS="contentserver.doccache=DEBUG,azure=WARNING";
+#   - envía sus registros a una cola: el formateo y la escritura los hace un
+#     hilo aparte con los handlers del logger raíz (LOG_QUEUE_ENABLED=0 lo
+#     desactiva y se escribe en el hilo de la petición);
+#   - muestrea los mensajes de mucho volumen marcados con extra=SAMPLED: se
+#     registra uno de cada LOG_SAMPLE_EVERY por mensaje;
+#   - enmascara secretos (claves de cuenta, SAS, secKey) antes de escribir.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Por defecto se omite el registro por petición HTTP del SDK de Azure
+LOG_LEVELS = os.getenv("LOG_LEVELS", "azure=WARNING")
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "1") == "1"
+LOG_SAMPLE_EVERY = max(1, int(os.getenv("LOG_SAMPLE_EVERY", "100")))
+
+# Loggers de los módulos del content server. Los módulos de la raíz no tienen un
+# paquete común, así que cada uno que registre mensajes tiene que estar aquí.
+APP_LOGGERS = (
+    "blob_utils",
+    "compression_utils",
+    "contentserver",
+    "crypto_utils",
+    "local_blob",
+    "memory_blob",
+    "replicated_blob",
+    "resilience_utils",
+    "storage_policies",
+    "tracing_utils",
+)
+
+# Para mensajes de mucho volumen: logger.info("...", extra=SAMPLED)
+SAMPLED = {"sampled": True}
+
+SECRET_PATTERNS = [
+    re.compile(r"(?i)((?:AccountKey|SharedAccessSignature|sig|secKey)=)[^;&\s'\"]+"),
+    re.compile(r"(?i)(['\"]connection_string['\"]\s*:\s*['\"])[^'\"]*"),
+]
+
+_configured = False
+_configure_lock = threading.Lock()
+_listener = None
+
+
+def redact(text: str) -> str:
+    """Sustituye por '***' las claves y firmas que aparezcan en el texto."""
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(r"\1***", text)
+    return text
+
+
+class SamplingFilter(logging.Filter):
+    """Deja pasar uno de cada LOG_SAMPLE_EVERY registros marcados con SAMPLED."""
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = every
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False):
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        if count % self.every:
+            return False
+        if count:
+            record.msg = f"{record.msg} [muestreado 1/{self.every}]"
+        return True
+
+
+class RedactingFilter(logging.Filter):
+    """Formatea el mensaje (en el hilo del listener) sin secretos."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact(record.getMessage())
+        record.args = None
+        return True
+
+
+class _LazyQueueHandler(QueueHandler):
+    # QueueHandler.prepare formatea el mensaje antes de encolarlo; aquí el
+    # registro se encola tal cual y se formatea en el hilo del listener
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _RootHandlers(logging.Handler):
+    """Reenvía los registros a los handlers que tenga el logger raíz en cada momento."""
+
+    def __init__(self, *filters):
+        super().__init__()
+        for record_filter in filters:
+            self.addFilter(record_filter)
+        self.addFilter(RedactingFilter())
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger().callHandlers(record)
+
+
+def parse_levels(spec: str) -> dict:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging() -> None:
+    """Configura los loggers del content server (idempotente)."""
+    global _configured, _listener
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+
+        root = logging.getLogger()
+        if not root.handlers:
+            # Ejecución local: el host de Azure Functions ya instala su handler
+            logging.basicConfig(level=logging.INFO)
+
+        # El muestreo se decide en el hilo de la petición, antes de encolar
+        sampling = SamplingFilter()
+        if LOG_QUEUE_ENABLED:
+            log_queue = queue.SimpleQueue()
+            handler = _LazyQueueHandler(log_queue)
+            handler.addFilter(sampling)
+            _listener = QueueListener(log_queue, _RootHandlers())
+            _listener.start()
+            atexit.register(_listener.stop)
+        else:
+            handler = _RootHandlers(sampling)
+
+        for name in APP_LOGGERS:
+            logger = logging.getLogger(name)
+            logger.setLevel(LOG_LEVEL)
+            logger.addHandler(handler)
+            logger.propagate = False
+        for name, level in parse_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
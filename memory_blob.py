@@ -0,0 +1,295 @@
+import time
+import random
+import threading
+import itertools
+from urllib.parse import parse_qs
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+
+# Sustituto en memoria de los clientes de azure.storage.blob (solo la parte que
+# usan las funciones). Se activa con cadenas de conexión "memory://<cuenta>" (ver
+# blob_utils.create_blob_service_client) y sirve para medir y probar sin Azure.
+# Los datos viven en el proceso y se comparten entre clientes de la misma cuenta.
+# Con "memory://<cuenta>?delay_ms=50&delay_ratio=0.1" un 10 % de las lecturas
+# tarda 50 ms más, para medir réplicas lentas.
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+_accounts = {}
+_accounts_lock = threading.Lock()
+_etags = itertools.count(1)
+
+
+def reset_memory_accounts() -> None:
+    """Borra todos los datos en memoria."""
+    with _accounts_lock:
+        _accounts.clear()
+
+
+def _account(name: str) -> dict:
+    with _accounts_lock:
+        return _accounts.setdefault(
+            name, {"lock": threading.RLock(), "containers": {}, "staged": {}}
+        )
+
+
+def _not_modified() -> HttpResponseError:
+    # Como el SDK: un 304 sin código de error llega como HttpResponseError
+    error = HttpResponseError("El blob no ha cambiado")
+    error.status_code = 304
+    return error
+
+
+def _check_conditions(blob, etag, match_condition) -> None:
+    if match_condition == MatchConditions.IfNotModified:
+        if blob is None or blob["etag"] != etag:
+            raise ResourceModifiedError("La condición If-Match no se cumple")
+    elif match_condition == MatchConditions.IfMissing and blob is not None:
+        # Como el SDK: un If-None-Match: * que falla es un 412 ConditionNotMet
+        raise ResourceModifiedError("La condición If-None-Match no se cumple")
+    elif match_condition == MatchConditions.IfPresent and blob is None:
+        raise ResourceNotFoundError("El blob no existe")
+
+
+class MemoryBlobServiceClient:
+    def __init__(
+        self,
+        account_name: str,
+        max_chunk_get_size: int = DEFAULT_CHUNK_SIZE,
+        delay_ms: float = 0.0,
+        delay_ratio: float = 1.0,
+    ):
+        self.account_name = account_name
+        self.max_chunk_get_size = max_chunk_get_size
+        self.delay_ms = delay_ms
+        self.delay_ratio = delay_ratio
+
+    @classmethod
+    def from_connection_string(cls, connection_string: str, **kwargs):
+        account_name, _, query = connection_string.split("://", 1)[-1].partition("?")
+        options = {name: float(values[0]) for name, values in parse_qs(query).items()}
+        return cls(
+            account_name or "default",
+            kwargs.get("max_chunk_get_size") or DEFAULT_CHUNK_SIZE,
+            options.get("delay_ms", 0.0),
+            options.get("delay_ratio", 1.0),
+        )
+
+    def simulate_read_latency(self) -> None:
+        if self.delay_ms and random.random() < self.delay_ratio:
+            time.sleep(self.delay_ms / 1000)
+
+    def get_container_client(self, container: str):
+        return MemoryContainerClient(self, container)
+
+    def get_blob_client(self, container: str, blob: str):
+        return MemoryBlobClient(self, container, blob)
+
+
+class MemoryContainerClient:
+    def __init__(self, service: MemoryBlobServiceClient, container_name: str):
+        self.service = service
+        self.container_name = container_name
+        self._account = _account(service.account_name)
+
+    def get_blob_client(self, blob: str):
+        return MemoryBlobClient(self.service, self.container_name, blob)
+
+    def create_container(self, **kwargs):
+        with self._account["lock"]:
+            if self.container_name in self._account["containers"]:
+                raise ResourceExistsError("El contenedor ya existe")
+            self._account["containers"][self.container_name] = {}
+
+    def exists(self, **kwargs) -> bool:
+        return self.container_name in self._account["containers"]
+
+    def list_blobs(self, name_starts_with: str = None, **kwargs):
+        prefix = name_starts_with or ""
+        with self._account["lock"]:
+            blobs = self._account["containers"].get(self.container_name, {})
+            names = sorted(name for name in blobs if name.startswith(prefix))
+            return [_properties(name, blobs[name]) for name in names]
+
+    def upload_blob(self, name: str, data, **kwargs):
+        blob_client = self.get_blob_client(name)
+        blob_client.upload_blob(data, **kwargs)
+        return blob_client
+
+    def download_blob(self, blob: str, **kwargs):
+        return self.get_blob_client(blob).download_blob(**kwargs)
+
+    def delete_blob(self, blob: str, **kwargs):
+        return self.get_blob_client(blob).delete_blob(**kwargs)
+
+
+class MemoryBlobClient:
+    def __init__(self, service: MemoryBlobServiceClient, container_name: str, blob_name: str):
+        self.service = service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self._account = _account(service.account_name)
+
+    def _blobs(self) -> dict:
+        return self._account["containers"].setdefault(self.container_name, {})
+
+    def _get(self) -> dict:
+        return self._blobs().get(self.blob_name)
+
+    def exists(self, **kwargs) -> bool:
+        with self._account["lock"]:
+            return self._get() is not None
+
+    def get_blob_properties(self, **kwargs):
+        self.service.simulate_read_latency()
+        with self._account["lock"]:
+            blob = self._get()
+            if blob is None:
+                raise ResourceNotFoundError("El blob no existe")
+            return _properties(self.blob_name, blob)
+
+    def download_blob(
+        self, offset: int = None, length: int = None, etag=None, match_condition=None, **kwargs
+    ):
+        self.service.simulate_read_latency()
+        with self._account["lock"]:
+            blob = self._get()
+            if blob is None:
+                raise ResourceNotFoundError("El blob no existe")
+            if match_condition == MatchConditions.IfModified and blob["etag"] == etag:
+                raise _not_modified()
+            _check_conditions(blob, etag, match_condition)
+            data = blob["data"]
+            properties = _properties(self.blob_name, blob)
+        start = offset or 0
+        end = len(data) if length is None else min(start + length, len(data))
+        return MemoryDownloader(
+            memoryview(data)[start:end], properties, self.service.max_chunk_get_size
+        )
+
+    def upload_blob(
+        self, data, overwrite: bool = False, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif hasattr(data, "read"):
+            data = data.read()
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            data = b"".join(data)
+        with self._account["lock"]:
+            blob = self._get()
+            if not overwrite and match_condition is None and blob is not None:
+                raise ResourceExistsError("El blob ya existe")
+            _check_conditions(blob, etag, match_condition)
+            return self._write(bytes(data), metadata)
+
+    def stage_block(self, block_id: str, data, **kwargs):
+        with self._account["lock"]:
+            staged = self._account["staged"].setdefault(
+                (self.container_name, self.blob_name), {}
+            )
+            staged[block_id] = bytes(data)
+
+    def commit_block_list(
+        self, block_list, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        with self._account["lock"]:
+            _check_conditions(self._get(), etag, match_condition)
+            staged = self._account["staged"].pop((self.container_name, self.blob_name), {})
+            block_ids = [getattr(block, "id", block) for block in block_list]
+            return self._write(b"".join(staged[block_id] for block_id in block_ids), metadata)
+
+    def create_append_blob(
+        self, content_settings=None, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        with self._account["lock"]:
+            _check_conditions(self._get(), etag, match_condition)
+            return self._write(b"", metadata, blob_type="AppendBlob")
+
+    def append_block(self, data, length: int = None, appendpos_condition: int = None, **kwargs):
+        with self._account["lock"]:
+            blob = self._get()
+            if blob is None:
+                raise ResourceNotFoundError("El blob no existe")
+            if blob["blob_type"] != "AppendBlob":
+                raise HttpResponseError("El blob no es un Append Blob")
+            if appendpos_condition is not None and appendpos_condition != len(blob["data"]):
+                error = HttpResponseError("La condición de posición de append no se cumple")
+                error.error_code = "AppendPositionConditionNotMet"
+                raise error
+            offset = len(blob["data"])
+            blob["data"] += bytes(data)
+            blob["etag"] = f'"0x{next(_etags):X}"'
+            blob["last_modified"] = datetime.now(timezone.utc)
+            return {
+                "etag": blob["etag"],
+                "last_modified": blob["last_modified"],
+                "blob_append_offset": str(offset),
+            }
+
+    def set_blob_metadata(self, metadata: dict = None, etag=None, match_condition=None, **kwargs):
+        with self._account["lock"]:
+            blob = self._get()
+            if blob is None:
+                raise ResourceNotFoundError("El blob no existe")
+            _check_conditions(blob, etag, match_condition)
+            blob["metadata"] = dict(metadata or {})
+            blob["etag"] = f'"0x{next(_etags):X}"'
+            return {"etag": blob["etag"], "last_modified": blob["last_modified"]}
+
+    def delete_blob(self, etag=None, match_condition=None, **kwargs):
+        with self._account["lock"]:
+            blob = self._get()
+            if blob is None:
+                raise ResourceNotFoundError("El blob no existe")
+            _check_conditions(blob, etag, match_condition)
+            del self._blobs()[self.blob_name]
+
+    def _write(self, data: bytes, metadata: dict, blob_type: str = "BlockBlob") -> dict:
+        now = datetime.now(timezone.utc)
+        previous = self._get()
+        blob = {
+            "data": data,
+            "blob_type": blob_type,
+            "metadata": dict(metadata or {}),
+            "etag": f'"0x{next(_etags):X}"',
+            "last_modified": now,
+            "creation_time": previous["creation_time"] if previous else now,
+        }
+        self._blobs()[self.blob_name] = blob
+        return {"etag": blob["etag"], "last_modified": now}
+
+
+class MemoryDownloader:
+    def __init__(self, data: memoryview, properties, chunk_size: int):
+        self._data = data
+        self._chunk_size = chunk_size
+        self.properties = properties
+        self.size = len(data)
+
+    def readall(self) -> bytes:
+        return bytes(self._data)
+
+    def chunks(self):
+        for offset in range(0, len(self._data), self._chunk_size):
+            yield bytes(self._data[offset : offset + self._chunk_size])
+
+
+def _properties(name: str, blob: dict):
+    return SimpleNamespace(
+        name=name,
+        size=len(blob["data"]),
+        etag=blob["etag"],
+        metadata=dict(blob["metadata"]),
+        last_modified=blob["last_modified"],
+        creation_time=blob["creation_time"],
+        blob_type=blob["blob_type"],
+        content_settings=SimpleNamespace(content_type=None),
+    )
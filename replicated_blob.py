@@ -0,0 +1,537 @@
+import os
+import copy
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+
+from logging_utils import SAMPLED
+
+# Destinos replicados: un contRep cuyo destino lista varias conexiones (réplicas,
+# la primera es la principal). ReplicatedContainerClient tiene la misma interfaz
+# que los demás backends (ver blob_utils.STORAGE_BACKENDS) y reparte cada
+# operación entre los ContainerClient de las réplicas:
+#   - Las escrituras se lanzan en paralelo en todas las réplicas y terminan al
+#     confirmarlas el quórum (write_quorum del destino, por defecto la mayoría);
+#     las demás siguen en segundo plano. En cada réplica, las operaciones sobre un
+#     mismo blob se aplican en el orden en que se enviaron.
+#   - Las escrituras condicionadas (If-Match, posición de append) las decide la
+#     réplica principal y después se copian a las demás.
+#   - Las lecturas van a la réplica históricamente más rápida (media de sus
+#     últimas latencias, que refleja también sus colas). Si no responde en el
+#     percentil REPLICA_HEDGE_PERCENTILE de sus latencias se lanza la misma
+#     lectura en la siguiente y se usa la primera respuesta. Las réplicas con
+#     pocas muestras van primero, para medirlas, y se cubren tras
+#     REPLICA_HEDGE_DEFAULT_MS. Un blob que falta en una réplica se busca en las
+#     demás.
+# Cada réplica tiene sus propios ETag, así que toda escritura marca el blob con
+# una versión común (metadato REPLICA_VERSION_KEY) y el ETag que se devuelve es
+# "versión-tamaño", igual en todas las réplicas.
+
+REPLICATION_CONCURRENCY = int(os.getenv("REPLICATION_CONCURRENCY", "16"))
+# Percentil de la latencia de la réplica elegida tras el que se cubre la lectura
+REPLICA_HEDGE_PERCENTILE = float(os.getenv("REPLICA_HEDGE_PERCENTILE", "0.95"))
+REPLICA_HEDGE_MIN_MS = float(os.getenv("REPLICA_HEDGE_MIN_MS", "2"))
+# Espera antes de cubrir mientras una réplica tiene pocas muestras. Es corta: la
+# réplica sin medir va primero para medirla y no debe añadir su cola a la lectura
+REPLICA_HEDGE_DEFAULT_MS = float(os.getenv("REPLICA_HEDGE_DEFAULT_MS", "2"))
+REPLICA_LATENCY_WINDOW = int(os.getenv("REPLICA_LATENCY_WINDOW", "256"))
+REPLICA_MIN_SAMPLES = 16
+# Latencia que se anota cuando una lectura falla, para relegar a la réplica
+REPLICA_FAILURE_PENALTY_SECONDS = 1.0
+REPLICA_VERSION_KEY = "replica_version"
+
+logger = logging.getLogger(__name__)
+
+_replica_executor = ThreadPoolExecutor(
+    max_workers=REPLICATION_CONCURRENCY, thread_name_prefix="replica"
+)
+
+# Latencias de lectura recientes por conexión, compartidas por todos los destinos
+_latencies = {}
+_latencies_lock = threading.Lock()
+# Última operación encolada por (conexión, contenedor, blob)
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def record_latency(connection_name: str, seconds: float) -> None:
+    with _latencies_lock:
+        samples = _latencies.get(connection_name)
+        if samples is None:
+            samples = _latencies[connection_name] = deque(maxlen=REPLICA_LATENCY_WINDOW)
+        samples.append(seconds)
+
+
+def latency_profile(connection_name: str) -> tuple:
+    """(media, espera antes de cubrir) de una réplica; media None si hay pocas muestras."""
+    with _latencies_lock:
+        samples = sorted(_latencies.get(connection_name, ()))
+    if len(samples) < REPLICA_MIN_SAMPLES:
+        return None, REPLICA_HEDGE_DEFAULT_MS / 1000
+    hedge_index = min(len(samples) - 1, int(REPLICA_HEDGE_PERCENTILE * len(samples)))
+    return (
+        sum(samples) / len(samples),
+        max(samples[hedge_index], REPLICA_HEDGE_MIN_MS / 1000),
+    )
+
+
+def _blob_size(properties) -> int:
+    # Las descargas parciales informan del tamaño del rango; el total va en Content-Range
+    content_range = getattr(properties, "content_range", None)
+    if content_range:
+        return int(content_range.rpartition("/")[2])
+    return properties.size
+
+
+def replicated_properties(properties):
+    """Propiedades de una réplica con el ETag común y sin el metadato de versión."""
+    metadata = dict(properties.metadata or {})
+    version = metadata.pop(REPLICA_VERSION_KEY, None)
+    replicated = copy.copy(properties)
+    replicated.metadata = metadata
+    if version:
+        replicated.etag = f'"{version}-{_blob_size(properties):x}"'
+    return replicated
+
+
+def _versioned(metadata: dict) -> dict:
+    return {**(metadata or {}), REPLICA_VERSION_KEY: uuid.uuid4().hex}
+
+
+def _not_modified() -> HttpResponseError:
+    # Como el SDK: un 304 sin código de error llega como HttpResponseError
+    error = HttpResponseError("El blob no ha cambiado")
+    error.status_code = 304
+    return error
+
+
+def _materialize(data) -> bytes:
+    """Los datos se envían a varias réplicas: los flujos se leen una sola vez."""
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    if hasattr(data, "read"):
+        return data.read()
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        return b"".join(data)
+    return data
+
+
+def _if_match(etag: str, operation):
+    """
+    Operación condicionada al ETag común: se comprueba la versión en la réplica y
+    se aplica con su ETag nativo, que garantiza que no cambia entre medias.
+    """
+
+    def conditional(blob_client):
+        properties = blob_client.get_blob_properties()
+        if replicated_properties(properties).etag != etag:
+            raise ResourceModifiedError("La condición If-Match no se cumple")
+        return operation(blob_client, properties.etag)
+
+    return conditional
+
+
+def _plain_condition(match_condition) -> dict:
+    """Condición sin ETag (If-None-Match: *) para las réplicas; If-Match se resuelve aparte."""
+    if match_condition in (None, MatchConditions.IfNotModified):
+        return {}
+    return {"match_condition": match_condition}
+
+
+def _delete_if_exists(blob_client) -> None:
+    try:
+        blob_client.delete_blob()
+    except ResourceNotFoundError:
+        pass
+
+
+class ReplicatedContainerClient:
+    def __init__(self, replicas: list, write_quorum: int = None):
+        """'replicas': [(nombre de la conexión, ContainerClient)], la principal primero."""
+        self.replicas = replicas
+        self.write_quorum = max(1, min(len(replicas), write_quorum or len(replicas) // 2 + 1))
+        self.container_name = replicas[0][1].container_name
+
+    def get_blob_client(self, blob: str):
+        return ReplicatedBlobClient(self, blob)
+
+    def create_container(self, **kwargs):
+        return self._write_all(None, lambda client: client.create_container(**kwargs))
+
+    def exists(self, **kwargs) -> bool:
+        return self._read(None, lambda client: client.exists(**kwargs))
+
+    def list_blobs(self, name_starts_with: str = None, **kwargs):
+        blobs = self._read(
+            None,
+            lambda client: list(client.list_blobs(name_starts_with=name_starts_with, **kwargs)),
+        )
+        return [replicated_properties(blob) for blob in blobs]
+
+    def upload_blob(self, name: str, data, **kwargs):
+        blob_client = self.get_blob_client(name)
+        blob_client.upload_blob(data, **kwargs)
+        return blob_client
+
+    def download_blob(self, blob: str, **kwargs):
+        return self.get_blob_client(blob).download_blob(**kwargs)
+
+    def delete_blob(self, blob: str, **kwargs):
+        return self.get_blob_client(blob).delete_blob(**kwargs)
+
+    # Lecturas
+
+    def _read_order(self, blob_name: str) -> list:
+        """Réplicas por latencia media; sin muestras suficientes van primero para medirlas."""
+        pending = set()
+        if blob_name is not None:
+            with _queues_lock:
+                pending = {
+                    index
+                    for index, (connection_name, client) in enumerate(self.replicas)
+                    if (connection_name, self.container_name, blob_name) in _queues
+                }
+
+        def rank(index):
+            mean, _ = latency_profile(self.replicas[index][0])
+            # Las réplicas con escrituras del blob en curso, al final
+            return (index in pending, mean or 0.0, index)
+
+        return sorted(range(len(self.replicas)), key=rank)
+
+    def _timed(self, index: int, operation):
+        connection_name, client = self.replicas[index]
+        started = time.perf_counter()
+        try:
+            result = operation(client)
+        except ResourceNotFoundError:
+            record_latency(connection_name, time.perf_counter() - started)
+            raise
+        except Exception:
+            record_latency(connection_name, REPLICA_FAILURE_PENALTY_SECONDS)
+            raise
+        record_latency(connection_name, time.perf_counter() - started)
+        return result
+
+    def _read(self, blob_name: str, operation):
+        """
+        Ejecuta la lectura operation(ContainerClient) en la réplica más rápida y,
+        si tarda más de lo habitual o falla, también en la siguiente.
+        """
+        order = self._read_order(blob_name)
+        pending = {}
+        errors = []
+        not_found = None
+
+        def launch():
+            index = order.pop(0)
+            pending[_replica_executor.submit(self._timed, index, operation)] = index
+            return latency_profile(self.replicas[index][0])[1]
+
+        hedge_after = launch()
+        while pending:
+            done, _ = wait(
+                pending, timeout=hedge_after if order else None, return_when=FIRST_COMPLETED
+            )
+            if not done:
+                logger.debug(
+                    "Lectura de '%s' cubierta tras %.1f ms",
+                    blob_name,
+                    hedge_after * 1000,
+                    extra=SAMPLED,
+                )
+                hedge_after = launch()
+                continue
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    return future.result()
+                except ResourceNotFoundError as e:
+                    not_found = e
+                except Exception as e:
+                    logger.warning(
+                        "Error de lectura en la réplica '%s': %s",
+                        self.replicas[index][0],
+                        e,
+                        extra=SAMPLED,
+                    )
+                    errors.append(e)
+            if not pending and order:
+                hedge_after = launch()
+        if errors:
+            raise errors[0]
+        raise not_found
+
+    # Escrituras
+
+    def _enqueue(self, index: int, blob_name: str, operation) -> Future:
+        """Encola operation(ContainerClient) en una réplica, tras las anteriores del mismo blob."""
+        connection_name, client = self.replicas[index]
+        key = (connection_name, self.container_name, blob_name)
+        result = Future()
+
+        def run():
+            result.set_running_or_notify_cancel()
+            try:
+                result.set_result(operation(client))
+            except BaseException as e:
+                result.set_exception(e)
+            finally:
+                with _queues_lock:
+                    if _queues.get(key) is result:
+                        del _queues[key]
+
+        def log_failure(future):
+            error = future.exception()
+            if error is not None and not isinstance(error, ResourceNotFoundError):
+                logger.warning(
+                    "Error de escritura en la réplica '%s': %s",
+                    connection_name,
+                    error,
+                    extra=SAMPLED,
+                )
+
+        result.add_done_callback(log_failure)
+        with _queues_lock:
+            previous = _queues.get(key)
+            _queues[key] = result
+        if previous is None:
+            _replica_executor.submit(run)
+        else:
+            previous.add_done_callback(lambda _: _replica_executor.submit(run))
+        return result
+
+    def _await_quorum(self, futures: dict, quorum: int):
+        """
+        Espera a que 'quorum' réplicas ({Future: índice}) confirmen y devuelve el
+        resultado de la principal, o el de otra si la principal no ha terminado.
+        """
+        pending = dict(futures)
+        results = {}
+        errors = {}
+        while len(results) < quorum:
+            if len(errors) > len(futures) - quorum:
+                raise errors.get(0) or next(iter(errors.values()))
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    errors[index] = e
+        return results[0] if 0 in results else next(iter(results.values()))
+
+    def _write_all(self, blob_name: str, operation):
+        """Escritura en paralelo en todas las réplicas, confirmada por el quórum."""
+        futures = {
+            self._enqueue(index, blob_name, operation): index
+            for index in range(len(self.replicas))
+        }
+        return self._await_quorum(futures, self.write_quorum)
+
+    def _write_ordered(self, blob_name: str, primary_operation, mirror_operation):
+        """
+        Escritura que decide la principal: primary_operation(ContainerClient) se
+        aplica en ella y después mirror_operation(ContainerClient, resultado) en las
+        demás. Las copias se encolan antes de liberar la cola del blob en la
+        principal, así que llegan a cada réplica en el mismo orden.
+        """
+        mirrors = {}
+
+        def primary(client):
+            result = primary_operation(client)
+            for index in range(1, len(self.replicas)):
+                mirror = self._enqueue(
+                    index, blob_name, lambda client: mirror_operation(client, result)
+                )
+                mirrors[mirror] = index
+            return result
+
+        result = self._enqueue(0, blob_name, primary).result()
+        if self.write_quorum > 1:
+            try:
+                self._await_quorum(mirrors, self.write_quorum - 1)
+            except Exception:
+                # La principal ya la aplicó: las réplicas que fallan quedan desfasadas
+                logger.warning(
+                    "Escritura de '%s' sin quórum en las réplicas", blob_name, extra=SAMPLED
+                )
+        return result
+
+
+class ReplicatedBlobClient:
+    def __init__(self, container: ReplicatedContainerClient, blob_name: str):
+        self.container = container
+        self.container_name = container.container_name
+        self.blob_name = blob_name
+
+    def _blob(self, client):
+        return client.get_blob_client(self.blob_name)
+
+    def _write(self, etag, match_condition, conditional_operation, operation):
+        """
+        Con If-Match, conditional_operation(blob, ETag nativo) en la principal y
+        después operation(blob) en las demás; si no, operation(blob) en todas.
+        """
+        if match_condition == MatchConditions.IfNotModified:
+            return self.container._write_ordered(
+                self.blob_name,
+                lambda client: _if_match(etag, conditional_operation)(self._blob(client)),
+                lambda client, _: operation(self._blob(client)),
+            )
+        return self.container._write_all(
+            self.blob_name, lambda client: operation(self._blob(client))
+        )
+
+    def exists(self, **kwargs) -> bool:
+        try:
+            self.get_blob_properties()
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    def get_blob_properties(self, **kwargs):
+        return replicated_properties(
+            self.container._read(
+                self.blob_name, lambda client: self._blob(client).get_blob_properties(**kwargs)
+            )
+        )
+
+    def download_blob(
+        self, offset: int = None, length: int = None, etag=None, match_condition=None, **kwargs
+    ):
+        download = self.container._read(
+            self.blob_name,
+            lambda client: self._blob(client).download_blob(
+                offset=offset, length=length, **kwargs
+            ),
+        )
+        download.properties = replicated_properties(download.properties)
+        # Las condiciones se comprueban con el ETag común, no con el de la réplica
+        if match_condition == MatchConditions.IfModified and download.properties.etag == etag:
+            raise _not_modified()
+        if match_condition == MatchConditions.IfNotModified and download.properties.etag != etag:
+            raise ResourceModifiedError("La condición If-Match no se cumple")
+        return download
+
+    def upload_blob(
+        self, data, overwrite: bool = False, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        data = _materialize(data)
+        metadata = _versioned(metadata)
+        return self._write(
+            etag,
+            match_condition,
+            lambda blob, native_etag: blob.upload_blob(
+                data,
+                overwrite=True,
+                metadata=metadata,
+                etag=native_etag,
+                match_condition=MatchConditions.IfNotModified,
+                **kwargs,
+            ),
+            lambda blob: blob.upload_blob(
+                data,
+                overwrite=overwrite or match_condition == MatchConditions.IfNotModified,
+                metadata=metadata,
+                **_plain_condition(match_condition),
+                **kwargs,
+            ),
+        )
+
+    def stage_block(self, block_id: str, data, **kwargs):
+        data = _materialize(data)
+        return self.container._write_all(
+            self.blob_name,
+            lambda client: self._blob(client).stage_block(block_id, data, **kwargs),
+        )
+
+    def commit_block_list(
+        self, block_list, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        metadata = _versioned(metadata)
+        return self._write(
+            etag,
+            match_condition,
+            lambda blob, native_etag: blob.commit_block_list(
+                block_list,
+                metadata=metadata,
+                etag=native_etag,
+                match_condition=MatchConditions.IfNotModified,
+                **kwargs,
+            ),
+            lambda blob: blob.commit_block_list(
+                block_list, metadata=metadata, **_plain_condition(match_condition), **kwargs
+            ),
+        )
+
+    def create_append_blob(
+        self, content_settings=None, metadata: dict = None, etag=None, match_condition=None, **kwargs
+    ):
+        metadata = _versioned(metadata)
+        return self._write(
+            etag,
+            match_condition,
+            lambda blob, native_etag: blob.create_append_blob(
+                content_settings=content_settings,
+                metadata=metadata,
+                etag=native_etag,
+                match_condition=MatchConditions.IfNotModified,
+                **kwargs,
+            ),
+            lambda blob: blob.create_append_blob(
+                content_settings=content_settings,
+                metadata=metadata,
+                **_plain_condition(match_condition),
+                **kwargs,
+            ),
+        )
+
+    def append_block(self, data, length: int = None, appendpos_condition: int = None, **kwargs):
+        # La principal decide la posición; las réplicas añaden en la misma
+        data = bytes(data)
+        return self.container._write_ordered(
+            self.blob_name,
+            lambda client: self._blob(client).append_block(
+                data, appendpos_condition=appendpos_condition, **kwargs
+            ),
+            lambda client, result: self._blob(client).append_block(
+                data, appendpos_condition=int(result["blob_append_offset"]), **kwargs
+            ),
+        )
+
+    def set_blob_metadata(self, metadata: dict = None, etag=None, match_condition=None, **kwargs):
+        metadata = _versioned(metadata)
+        return self._write(
+            etag,
+            match_condition,
+            lambda blob, native_etag: blob.set_blob_metadata(
+                metadata, etag=native_etag, match_condition=MatchConditions.IfNotModified, **kwargs
+            ),
+            lambda blob: blob.set_blob_metadata(metadata, **kwargs),
+        )
+
+    def delete_blob(self, etag=None, match_condition=None, **kwargs):
+        if match_condition == MatchConditions.IfNotModified:
+            return self.container._write_ordered(
+                self.blob_name,
+                lambda client: _if_match(
+                    etag,
+                    lambda blob, native_etag: blob.delete_blob(
+                        etag=native_etag, match_condition=MatchConditions.IfNotModified, **kwargs
+                    ),
+                )(self._blob(client)),
+                lambda client, _: _delete_if_exists(self._blob(client)),
+            )
+        return self.container._write_all(
+            self.blob_name, lambda client: self._blob(client).delete_blob(**kwargs)
+        )
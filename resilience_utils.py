@@ -0,0 +1,283 @@
+import os
+import time
+import logging
+import threading
+
+# Resiliencia de las llamadas a Blob Storage, por conexión. Una cuenta degradada
+# no debe bloquear los workers durante toda la cadena de reintentos del SDK:
+#   - Plazos: connection_timeout acota el establecimiento de la conexión y
+#     read_timeout cada espera de datos del servidor. operation_timeout es el
+#     plazo de cada petición HTTP con sus reintentos: no se programa un
+#     reintento que empezaría después y los plazos de conexión y lectura de
+#     cada intento se reducen a lo que queda. Como read_timeout, acota las
+#     esperas y no la transferencia: una respuesta que sigue llegando poco a
+#     poco puede superarlo, y una descarga grande son varias peticiones, cada
+#     una con su plazo.
+#   - Presupuesto de reintentos: cada operación deposita retry_budget_ratio
+#     fichas (hasta RETRY_BUDGET_MAX_TOKENS) y cada reintento gasta una, de modo
+#     que los reintentos no superan esa fracción del tráfico. La espera entre
+#     intentos es aleatoria entre 0 y retry_backoff * 2^(intento - 1), con
+#     retry_max_backoff como máximo.
+#   - Disyuntor: tras breaker_failures fallos seguidos (errores de red, 408, 429
+#     o 5xx) se abre y las llamadas fallan al instante con CircuitOpenError.
+#     Pasados breaker_reset_seconds deja pasar una sola petición de prueba: si
+#     va bien se cierra y si falla vuelve a abrirse.
+# Los valores por defecto se pueden cambiar para cada conexión con el objeto
+# "resilience" de sus datos en connections.json, p. ej.
+#   "data": {..., "resilience": {"read_timeout": 10, "breaker_failures": 3}}
+# Las políticas del pipeline del SDK que aplican todo esto están en
+# storage_policies.py. El estado es por worker y se consulta con storage_health()
+# (comando 'storageHealth' del content server).
+STORAGE_OPERATION_TIMEOUT = float(os.getenv("STORAGE_OPERATION_TIMEOUT", "120"))
+STORAGE_RETRY_TOTAL = int(os.getenv("STORAGE_RETRY_TOTAL", "3"))
+STORAGE_RETRY_BACKOFF = float(os.getenv("STORAGE_RETRY_BACKOFF", "0.5"))
+STORAGE_RETRY_MAX_BACKOFF = float(os.getenv("STORAGE_RETRY_MAX_BACKOFF", "8"))
+STORAGE_RETRY_BUDGET_RATIO = float(os.getenv("STORAGE_RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MAX_TOKENS = float(os.getenv("RETRY_BUDGET_MAX_TOKENS", "10"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+RESILIENCE_DEFAULTS = {
+    "operation_timeout": STORAGE_OPERATION_TIMEOUT,
+    "retry_total": STORAGE_RETRY_TOTAL,
+    "retry_backoff": STORAGE_RETRY_BACKOFF,
+    "retry_max_backoff": STORAGE_RETRY_MAX_BACKOFF,
+    "retry_budget_ratio": STORAGE_RETRY_BUDGET_RATIO,
+    "breaker_failures": BREAKER_FAILURE_THRESHOLD,
+    "breaker_reset_seconds": BREAKER_RESET_SECONDS,
+}
+_INTEGER_SETTINGS = ("retry_total", "breaker_failures")
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """
+    El disyuntor de la conexión está abierto. No deriva de AzureError para que
+    la política de reintentos del SDK no la reintente.
+    """
+
+    def __init__(self, connection_name: str, retry_after: float):
+        super().__init__(
+            f"La conexión '{connection_name}' no está disponible "
+            f"(reintentar en {retry_after:.1f} s)"
+        )
+        self.connection_name = connection_name
+        self.retry_after = retry_after
+
+
+def resilience_settings(overrides: dict, defaults: dict) -> dict:
+    """
+    Combina los valores por defecto con los de la conexión ('resilience' en sus
+    datos). Lanza ValueError si hay claves desconocidas o valores no válidos.
+    """
+    settings = dict(defaults)
+    for name, value in (overrides or {}).items():
+        if name not in settings:
+            raise ValueError(f"Parámetro de resiliencia desconocido: {name}")
+        try:
+            value = int(value) if name in _INTEGER_SETTINGS else float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Valor no válido para '{name}': {value!r}") from None
+        if value < 0:
+            raise ValueError(f"'{name}' no puede ser negativo")
+        settings[name] = value
+    return settings
+
+
+class RetryBudget:
+    """Cubo de fichas compartido por todas las operaciones de una conexión."""
+
+    def __init__(self, ratio: float, max_tokens: float = RETRY_BUDGET_MAX_TOKENS):
+        self._lock = threading.Lock()
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.operations = 0
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.operations += 1
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Gasta una ficha para un reintento; False si no quedan."""
+        with self._lock:
+            if self.tokens < 1:
+                self.exhausted += 1
+                return False
+            self.tokens -= 1
+            self.retries += 1
+            return True
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "tokens": round(self.tokens, 2),
+                "ratio": self.ratio,
+                "operations": self.operations,
+                "retries": self.retries,
+                "exhausted": self.exhausted,
+            }
+
+
+class CircuitBreaker:
+    """Disyuntor de una conexión: 'closed', 'open' o 'half_open'."""
+
+    def __init__(self, connection_name: str, failure_threshold: int, reset_seconds: float):
+        self._lock = threading.Lock()
+        self.connection_name = connection_name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self.opened_at = None
+        self.last_error = None
+        self._probe_started = None
+
+    def before_request(self) -> None:
+        """Lanza CircuitOpenError si la llamada no debe llegar a la cuenta."""
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            if self.state == "open":
+                retry_after = self.opened_at + self.reset_seconds - now
+                if retry_after <= 0:
+                    # Esta llamada es la prueba; las demás siguen fallando
+                    self.state = "half_open"
+                    self._probe_started = now
+                    return
+            elif now - self._probe_started >= self.reset_seconds:
+                # La prueba anterior no terminó: se permite otra
+                self._probe_started = now
+                return
+            else:
+                retry_after = self.reset_seconds - (now - self._probe_started)
+            self.rejected += 1
+        raise CircuitOpenError(self.connection_name, max(retry_after, 0.0))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state != "closed":
+                self.state = "closed"
+                self.opened_at = None
+                logger.info("Disyuntor de '%s' cerrado", self.connection_name)
+
+    def record_failure(self, error: str) -> None:
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+            if self.state == "half_open" or (
+                self.state == "closed"
+                and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                logger.warning(
+                    "Disyuntor de '%s' abierto tras %d fallos seguidos (último: %s)",
+                    self.connection_name,
+                    self.consecutive_failures,
+                    error,
+                )
+
+    def open_for(self):
+        """Segundos que quedan con el disyuntor abierto, o None si deja pasar llamadas."""
+        with self._lock:
+            if self.state != "open":
+                return None
+            retry_after = self.opened_at + self.reset_seconds - time.monotonic()
+            return retry_after if retry_after > 0 else None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            opened_for = (
+                round(time.monotonic() - self.opened_at, 3)
+                if self.opened_at is not None
+                else None
+            )
+            return {
+                "state": self.state,
+                "trips": self.trips,
+                "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures,
+                "rejected": self.rejected,
+                "opened_for_seconds": opened_for,
+                "last_error": self.last_error,
+                "failure_threshold": self.failure_threshold,
+                "reset_seconds": self.reset_seconds,
+            }
+
+
+# Disyuntor y presupuesto por nombre de conexión. Sobreviven a la recreación del
+# cliente (p. ej. al cambiar la configuración), que solo ajusta sus parámetros.
+_health = {}
+_health_lock = threading.Lock()
+
+
+def connection_health(connection_name: str, settings: dict) -> tuple:
+    """Devuelve (CircuitBreaker, RetryBudget) de la conexión con 'settings' aplicados."""
+    with _health_lock:
+        entry = _health.get(connection_name)
+        if entry is None:
+            entry = _health[connection_name] = (
+                CircuitBreaker(
+                    connection_name,
+                    settings["breaker_failures"],
+                    settings["breaker_reset_seconds"],
+                ),
+                RetryBudget(settings["retry_budget_ratio"]),
+            )
+        else:
+            breaker, budget = entry
+            with breaker._lock:
+                breaker.failure_threshold = settings["breaker_failures"]
+                breaker.reset_seconds = settings["breaker_reset_seconds"]
+            with budget._lock:
+                budget.ratio = settings["retry_budget_ratio"]
+        return entry
+
+
+def ensure_available(connection_names) -> None:
+    """
+    Lanza CircuitOpenError si todas las conexiones tienen el disyuntor abierto,
+    para fallar antes de leer o cifrar nada. No consume la petición de prueba.
+    """
+    retry_after = []
+    with _health_lock:
+        entries = [_health.get(connection_name) for connection_name in connection_names]
+    for connection_name, entry in zip(connection_names, entries):
+        seconds = entry[0].open_for() if entry is not None else None
+        if seconds is None:
+            return
+        retry_after.append((seconds, connection_name))
+    if retry_after:
+        seconds, connection_name = min(retry_after)
+        raise CircuitOpenError(connection_name, seconds)
+
+
+def storage_health() -> dict:
+    """Estado del disyuntor y del presupuesto de reintentos de cada conexión."""
+    with _health_lock:
+        entries = dict(_health)
+    return {
+        connection_name: {
+            "breaker": breaker.snapshot(),
+            "retry_budget": budget.snapshot(),
+        }
+        for connection_name, (breaker, budget) in sorted(entries.items())
+    }
+
+
+def reset_storage_health() -> None:
+    """Olvida el estado de todas las conexiones."""
+    with _health_lock:
+        _health.clear()
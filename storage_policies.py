@@ -0,0 +1,131 @@
+import sys
+import time
+import random
+from azure.core.exceptions import ServiceRequestTimeoutError
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+from azure.storage.blob import ExponentialRetry
+
+from resilience_utils import connection_health
+
+# Políticas del pipeline de azure.storage.blob que aplican los plazos, el
+# presupuesto de reintentos y el disyuntor de cada conexión (ver
+# resilience_utils.py). blob_utils importa este módulo solo al crear un cliente
+# de Azure, porque carga el SDK.
+
+# Respuestas que indican que la cuenta no está sana
+UNHEALTHY_STATUS_CODES = (408, 429)
+# Clave del contexto de la petición con el fin del plazo de la operación
+DEADLINE_KEY = "operation_deadline"
+
+
+class DeadlinePolicy(SansIOHTTPPolicy):
+    """
+    Ajusta los plazos de conexión y de lectura de cada intento a lo que queda
+    del plazo de la operación (lo fija BudgetedRetryMixin), de modo que el
+    último intento no puede pasarse de operation_timeout esperando al servidor.
+    """
+
+    def __init__(self, connection_timeout: float, read_timeout: float):
+        self.connection_timeout = connection_timeout
+        self.read_timeout = read_timeout
+
+    def on_request(self, request):
+        deadline = request.context.get(DEADLINE_KEY)
+        if deadline is None:
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ServiceRequestTimeoutError("Se ha agotado el plazo de la operación")
+        options = request.context.options
+        options["connection_timeout"] = min(self.connection_timeout, remaining)
+        options["read_timeout"] = min(self.read_timeout, remaining)
+
+
+class CircuitBreakerPolicy(SansIOHTTPPolicy):
+    """
+    Consulta el disyuntor antes de cada intento y le anota el resultado. Va al
+    final del pipeline, detrás de la política de reintentos, de modo que también
+    corta los reintentos de una operación en curso.
+    """
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    def on_request(self, request):
+        self.breaker.before_request()
+
+    def on_response(self, request, response):
+        status_code = response.http_response.status_code
+        if status_code >= 500 or status_code in UNHEALTHY_STATUS_CODES:
+            self.breaker.record_failure(f"HTTP {status_code}")
+        else:
+            # 404, 409, 412... son respuestas normales de una cuenta sana
+            self.breaker.record_success()
+
+    def on_exception(self, request):
+        error = sys.exc_info()[1]
+        self.breaker.record_failure(type(error).__name__)
+
+
+class BudgetedRetryMixin:
+    """
+    Reintentos con espera aleatoria, limitados por el presupuesto de la conexión
+    y por el plazo de la operación. Se combina con el ExponentialRetry síncrono o
+    asíncrono del SDK.
+    """
+
+    def __init__(self, budget, settings: dict, **kwargs):
+        self.budget = budget
+        self.operation_timeout = settings["operation_timeout"]
+        self.retry_backoff = settings["retry_backoff"]
+        self.retry_max_backoff = settings["retry_max_backoff"]
+        # retry_total limita todos los tipos de fallo (conexión, lectura y estado)
+        retry_total = settings["retry_total"]
+        super().__init__(
+            retry_total=retry_total,
+            retry_connect=retry_total,
+            retry_read=retry_total,
+            retry_status=retry_total,
+            **kwargs,
+        )
+
+    def configure_retries(self, request):
+        retry_settings = super().configure_retries(request)
+        retry_settings["deadline"] = time.monotonic() + self.operation_timeout
+        request.context[DEADLINE_KEY] = retry_settings["deadline"]
+        self.budget.deposit()
+        return retry_settings
+
+    def increment(self, settings, request, response=None, error=None) -> bool:
+        if not super().increment(settings, request, response=response, error=error):
+            return False
+        cap = min(
+            self.retry_max_backoff, self.retry_backoff * 2 ** (settings["count"] - 1)
+        )
+        backoff = random.uniform(0, cap)
+        if time.monotonic() + backoff >= settings["deadline"]:
+            return False
+        if not self.budget.withdraw():
+            return False
+        settings["backoff"] = backoff
+        return True
+
+    def get_backoff_time(self, settings) -> float:
+        return settings.get("backoff", 0.0)
+
+
+class BudgetedRetry(BudgetedRetryMixin, ExponentialRetry):
+    pass
+
+
+def resilience_options(connection_name: str, settings: dict, retry_class=BudgetedRetry) -> dict:
+    """Argumentos del cliente de Blob Storage para la conexión."""
+    breaker, budget = connection_health(connection_name, settings)
+    return {
+        "retry_policy": retry_class(budget, settings),
+        # El SDK de Storage no admite per_retry_policies; estas se añaden al final
+        "_additional_pipeline_policies": [
+            DeadlinePolicy(settings["connection_timeout"], settings["read_timeout"]),
+            CircuitBreakerPolicy(breaker),
+        ],
+    }
@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Trazas por petición. Cada petición abre una traza (start_trace) y las etapas se
+# registran como spans con su duración y los bytes procesados (span,
+# traced_iter). Al terminar se añade la cabecera Server-Timing a la respuesta y,
+# si hay exportador, se exportan los spans en formato OTLP/JSON.
+#
+# Sin traza activa (TRACING_ENABLED=0) span() y traced_iter() solo consultan una
+# ContextVar, de modo que el coste es despreciable.
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+# Exportador de spans: "" (ninguno), "console" (stderr), "file" o "otel"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "contentserver")
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("trace", default=None)
+_export_lock = threading.Lock()
+_otel_tracer = None
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+def _parse_traceparent(traceparent):
+    """Devuelve (trace_id, parent_id) de una cabecera W3C traceparent válida."""
+    parts = (traceparent or "").strip().split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None, None
+
+
+def start_trace(name: str, traceparent: str = None, **attributes):
+    """
+    Abre la traza de una petición y devuelve su identificador para end_trace.
+    Si ya hay una traza activa (p. ej. el manejador síncrono llamado desde el
+    asíncrono) los spans se añaden a ella y se devuelve None.
+    """
+    if not TRACING_ENABLED or _current.get() is not None:
+        return None
+    trace_id, parent_id = _parse_traceparent(traceparent)
+    root = {
+        "name": name,
+        "span_id": _new_id(8),
+        "parent_id": parent_id,
+        "start_ns": time.perf_counter_ns(),
+        "end_ns": None,
+        "attributes": dict(attributes),
+    }
+    trace = {
+        "trace_id": trace_id or _new_id(16),
+        "wall_start_ns": time.time_ns(),
+        "perf_start_ns": root["start_ns"],
+        "root": root,
+        "spans": [],
+        "stack": [root],
+        "iter_stack": [],
+    }
+    return trace, _current.set(trace)
+
+
+def end_trace(handle, response=None) -> None:
+    """Cierra la traza, añade Server-Timing a la respuesta y exporta los spans."""
+    if handle is None:
+        return
+    trace, token = handle
+    _current.reset(token)
+    trace["root"]["end_ns"] = time.perf_counter_ns()
+    if response is not None:
+        trace["root"]["attributes"]["http.status_code"] = response.status_code
+        try:
+            response.headers["Server-Timing"] = server_timing(trace)
+        except Exception as e:
+            logger.debug("No se pudo añadir Server-Timing: %s", e)
+    if TRACE_EXPORTER:
+        try:
+            export_trace(trace)
+        except Exception as e:
+            logger.warning("No se pudo exportar la traza: %s", e)
+
+
+def current_trace():
+    return _current.get()
+
+
+class _NoSpan:
+    """Contexto vacío para cuando no hay traza activa."""
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str, **attributes):
+    """
+    Registra una etapa de la petición. Devuelve el diccionario de atributos del
+    span, donde el llamador puede añadir p. ej. 'bytes'.
+    """
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _span(trace, name, attributes)
+
+
+@contextmanager
+def _span(trace, name, attributes):
+    record = {
+        "name": name,
+        "span_id": _new_id(8),
+        "parent_id": trace["stack"][-1]["span_id"],
+        "start_ns": time.perf_counter_ns(),
+        "end_ns": None,
+        "attributes": attributes,
+    }
+    trace["stack"].append(record)
+    try:
+        yield attributes
+    finally:
+        record["end_ns"] = time.perf_counter_ns()
+        trace["stack"].pop()
+        trace["spans"].append(record)
+
+
+def traced_iter(name: str, iterable, **attributes):
+    """
+    Envuelve un iterador de bloques de bytes y registra como span el tiempo
+    dedicado a producirlos (sin contar el de otros traced_iter anidados) y los
+    bytes producidos.
+    """
+    trace = _current.get()
+    if trace is None:
+        return iterable
+    return _traced_iter(trace, name, iter(iterable), attributes)
+
+
+def _traced_iter(trace, name, iterator, attributes):
+    record = {
+        "name": name,
+        "span_id": _new_id(8),
+        "parent_id": trace["stack"][-1]["span_id"],
+        "start_ns": time.perf_counter_ns(),
+        "end_ns": None,
+        "attributes": attributes,
+        "busy_ns": 0,
+        "child_ns": 0,
+    }
+    stack = trace["iter_stack"]
+    produced = 0
+    try:
+        while True:
+            stack.append(record)
+            started = time.perf_counter_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter_ns() - started
+                stack.pop()
+                record["busy_ns"] += elapsed
+                if stack:
+                    stack[-1]["child_ns"] += elapsed
+            produced += len(item)
+            yield item
+    finally:
+        attributes["bytes"] = produced
+        # La duración es el tiempo propio, aunque el span abarque más tiempo real
+        record["end_ns"] = record["start_ns"] + record["busy_ns"] - record["child_ns"]
+        trace["spans"].append(record)
+
+
+async def traced_aiter(name: str, aiterable, **attributes):
+    """Equivalente de traced_iter para iteradores asíncronos (tiempo de espera de cada bloque)."""
+    trace = _current.get()
+    if trace is None:
+        async for item in aiterable:
+            yield item
+        return
+    record = {
+        "name": name,
+        "span_id": _new_id(8),
+        "parent_id": trace["stack"][-1]["span_id"],
+        "start_ns": time.perf_counter_ns(),
+        "end_ns": None,
+        "attributes": attributes,
+    }
+    iterator = aiterable.__aiter__()
+    busy_ns = 0
+    produced = 0
+    try:
+        while True:
+            started = time.perf_counter_ns()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                busy_ns += time.perf_counter_ns() - started
+            produced += len(item)
+            yield item
+    finally:
+        attributes["bytes"] = produced
+        record["end_ns"] = record["start_ns"] + busy_ns
+        trace["spans"].append(record)
+
+
+def run_in_executor(loop, fn, *args):
+    """
+    loop.run_in_executor que conserva la traza de la petición: el executor no
+    copia las ContextVar, así que la función se ejecuta en una copia del contexto.
+    """
+    return loop.run_in_executor(None, contextvars.copy_context().run, fn, *args)
+
+
+def _duration_ms(record) -> float:
+    return (record["end_ns"] - record["start_ns"]) / 1e6
+
+
+def server_timing(trace) -> str:
+    """Cabecera Server-Timing: duración total y suma por etapa (con bytes)."""
+    totals = {}
+    for record in trace["spans"]:
+        entry = totals.setdefault(record["name"], {"dur": 0.0, "count": 0, "bytes": 0})
+        entry["dur"] += _duration_ms(record)
+        entry["count"] += 1
+        entry["bytes"] += record["attributes"].get("bytes", 0) or 0
+
+    metrics = []
+    for name, entry in totals.items():
+        description = []
+        if entry["bytes"]:
+            description.append(f"{entry['bytes']} B")
+        if entry["count"] > 1:
+            description.append(f"x{entry['count']}")
+        metric = f"{name};dur={entry['dur']:.2f}"
+        if description:
+            metric += f';desc="{" ".join(description)}"'
+        metrics.append(metric)
+    metrics.append(f"total;dur={_duration_ms(trace['root']):.2f}")
+    return ", ".join(metrics)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(trace, record, kind: int) -> dict:
+    offset = trace["wall_start_ns"] - trace["perf_start_ns"]
+    span_json = {
+        "traceId": trace["trace_id"],
+        "spanId": record["span_id"],
+        "name": record["name"],
+        "kind": kind,
+        "startTimeUnixNano": str(record["start_ns"] + offset),
+        "endTimeUnixNano": str(record["end_ns"] + offset),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)}
+            for key, value in record["attributes"].items()
+            if value is not None
+        ],
+    }
+    if record["parent_id"]:
+        span_json["parentSpanId"] = record["parent_id"]
+    return span_json
+
+
+def to_otlp(trace) -> dict:
+    """Traza en formato OTLP/JSON (resourceSpans), legible por un collector."""
+    spans = [_otlp_span(trace, trace["root"], kind=2)]  # SPAN_KIND_SERVER
+    spans += [_otlp_span(trace, record, kind=1) for record in trace["spans"]]
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": "contentserver.tracing"}, "spans": spans}],
+            }
+        ]
+    }
+
+
+def export_trace(trace) -> None:
+    if TRACE_EXPORTER == "otel":
+        _export_otel(trace)
+        return
+    line = json.dumps(to_otlp(trace), separators=(",", ":"))
+    with _export_lock:
+        if TRACE_EXPORTER == "console":
+            sys.stderr.write(line + "\n")
+        elif TRACE_EXPORTER == "file":
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def _export_otel(trace) -> None:
+    """Reenvía los spans al SDK de OpenTelemetry configurado en el proceso."""
+    global _otel_tracer
+    from opentelemetry import trace as otel_trace
+
+    if _otel_tracer is None:
+        _otel_tracer = otel_trace.get_tracer("contentserver.tracing")
+    offset = trace["wall_start_ns"] - trace["perf_start_ns"]
+    root = trace["root"]
+    root_span = _otel_tracer.start_span(
+        root["name"],
+        kind=otel_trace.SpanKind.SERVER,
+        start_time=root["start_ns"] + offset,
+        attributes=root["attributes"],
+    )
+    spans = {root["span_id"]: root_span}
+    for record in sorted(trace["spans"], key=lambda r: r["start_ns"]):
+        parent = spans.get(record["parent_id"], root_span)
+        otel_span = _otel_tracer.start_span(
+            record["name"],
+            context=otel_trace.set_span_in_context(parent),
+            start_time=record["start_ns"] + offset,
+            attributes=record["attributes"],
+        )
+        spans[record["span_id"]] = otel_span
+        otel_span.end(end_time=record["end_ns"] + offset)
+    root_span.end(end_time=root["end_ns"] + offset)
@@ -1,6 +1,6 @@
 import azure.functions as func
 import json
-from blob_utils import load_connections, save_json_to_blob
+from blob_utils import update_config_entry, ConfigEntryNotFound, drop_blob_client
 import logging
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
@@ -19,11 +19,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         connection_name = req.route_params.get("connection_name")
         updated_data = req.get_json()
 
-        # Cargar conexiones desde el blob
-        connections = load_connections()
-
-        # Verificar si la conexión existe
-        if connection_name not in connections:
+        # Actualizar la conexión (falla si no existe)
+        try:
+            update_config_entry("connections", connection_name, updated_data)
+        except ConfigEntryNotFound:
             return func.HttpResponse(
                 "Connection not found",
                 status_code=404,
@@ -34,11 +33,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 }
             )
 
-        # Actualizar la conexión
-        connections[connection_name] = updated_data
-
-        # Guardar las conexiones actualizadas en el blob
-        save_json_to_blob("connections", "connections.json", connections)
+        # Descartar el cliente de Blob Storage en caché para esta conexión
+        drop_blob_client(connection_name)
 
         return func.HttpResponse(
             "Connection updated successfully",
@@ -1,6 +1,6 @@
 import azure.functions as func
 import json
-from blob_utils import load_destinations, save_json_to_blob
+from blob_utils import update_config_entry, destination_entry, ConfigEntryNotFound
 import logging
 
 
@@ -21,12 +21,13 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         contRep = req.route_params.get("contRep")
         updated_data = req.get_json()
 
-        # Validar que el campo necesario esté presente en los datos
-        connection_name = updated_data.get("connection_name")
+        # Validar que el campo necesario esté presente en los datos: una conexión
+        # ("connection_name") o varias réplicas ("connections")
+        destination = destination_entry(updated_data)
 
-        if not connection_name:
+        if not destination:
             return func.HttpResponse(
-                "Missing 'connection_name' in request body",
+                "Missing valid 'connection_name' or 'connections' in request body",
                 status_code=400,
                 headers={
                     "Access-Control-Allow-Origin": "*",
@@ -35,11 +36,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 },
             )
 
-        # Cargar destinos desde el blob
-        destinations = load_destinations()
-
-        # Verificar si el destino existe
-        if contRep not in destinations:
+        # Actualizar el destino (falla si no existe)
+        try:
+            update_config_entry("destinations", contRep, destination)
+        except ConfigEntryNotFound:
             return func.HttpResponse(
                 "Destination not found",
                 status_code=404,
@@ -50,12 +50,6 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 },
             )
 
-        # Actualizar el destino
-        destinations[contRep] = connection_name
-
-        # Guardar los destinos actualizados en el blob
-        save_json_to_blob("connections", "destinations.json", destinations)
-
         return func.HttpResponse(
             "Destination updated successfully",
             status_code=200,
@@ -0,0 +1,10 @@
+import logging
+import azure.functions as func
+import contentserver
+
+
+# Disparador de calentamiento (planes Premium/Dedicated): se ejecuta al añadir
+# una instancia, antes de que reciba tráfico.
+def main(warmupContext: func.Context) -> None:
+    logging.info("Precalentando el content server...")
+    contentserver.warmup()